@@ -0,0 +1,56 @@
+"""
+Throwaway certificates for the load test: a self-signed root, a server
+certificate and one client certificate per simulated client, all signed
+by the root. Every client certificate has its own serial number, so that
+the server keeps a session per simulated client.
+
+Uses the openssl command line tool and EC keys, which are quick to make.
+"""
+import os
+import subprocess
+
+_CURVE = 'prime256v1'
+_DAYS = '2'
+
+
+def _openssl(*args):
+    subprocess.check_call(('openssl',) + args, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+
+def _key(path):
+    _openssl('ecparam', '-name', _CURVE, '-genkey', '-noout', '-out', path)
+
+
+def _signed(directory, name, root_cert, root_key, serial):
+    key = os.path.join(directory, name + '.key')
+    csr = os.path.join(directory, name + '.csr')
+    cert = os.path.join(directory, name + '.pem')
+    _key(key)
+    _openssl('req', '-new', '-key', key, '-subj', '/CN=%s' % name, '-out', csr)
+    _openssl('x509', '-req', '-in', csr, '-CA', root_cert, '-CAkey', root_key,
+             '-set_serial', str(serial), '-days', _DAYS, '-sha256', '-out', cert)
+    os.remove(csr)
+    return cert, key
+
+
+class BenchCertificates():
+    """
+    the paths of the certificates created in directory
+    """
+
+    def __init__(self, directory, clients):
+        """
+        :param directory: where the keys and certificates are written
+        :param clients: (int) number of client certificates
+        """
+        os.makedirs(directory, exist_ok=True)
+        self.root_key = os.path.join(directory, 'root.key')
+        self.root_cert = os.path.join(directory, 'root.pem')
+        _key(self.root_key)
+        _openssl('req', '-new', '-x509', '-key', self.root_key, '-subj', '/CN=i13mon-bench-root',
+                 '-days', _DAYS, '-sha256', '-out', self.root_cert)
+
+        self.server_cert, self.server_key = _signed(directory, 'server', self.root_cert, self.root_key, 1)
+        # (certificate, key) of every client, serial numbers from 1000 on
+        self.clients = [_signed(directory, 'client%s' % i, self.root_cert, self.root_key, 1000 + i)
+                        for i in range(clients)]
@@ -0,0 +1,69 @@
+"""
+Compares the size and the decoding time of the pickle and the binary
+encoding of measurement messages.
+
+    python -m bench.codec_compare --batch 100 --rounds 2000
+"""
+import argparse
+import datetime
+import random
+import time
+import uuid
+from message_types import codec
+from message_types import measurement_msg
+
+
+# a client reports the measurements of a handful of devices
+DEVICES = [uuid.uuid4() for _ in range(10)]
+MAC_ADDRESSES = ['00:13:A2:00:40:9C:%02X:%02X' % (random.randrange(256), random.randrange(256)) for _ in range(10)]
+
+
+def power_measurement():
+    return {'type': 'power_measurement', 'id': uuid.uuid4(), 'deviceid': random.choice(DEVICES),
+            'ts': datetime.datetime.now(), 'power1': random.uniform(0, 3000), 'power2': random.uniform(0, 3000),
+            'power3': random.uniform(0, 3000), 'power4': random.uniform(0, 3000),
+            'vrms': random.uniform(220, 240), 'temp': random.uniform(15, 30)}
+
+
+def plug_measurement():
+    return {'type': 'plug_measurement', 'id': uuid.uuid4(), 'mac_address': random.choice(MAC_ADDRESSES),
+            'ts': datetime.datetime.now(),
+            'load': random.uniform(0, 2000), 'irms': random.uniform(0, 10), 'vrms': random.uniform(220, 240),
+            'freq': random.uniform(49.9, 50.1), 'pow': 'ON', 'work': random.uniform(0, 100)}
+
+
+def temp_hum_measurement():
+    return {'type': 'temp_hum_measurement', 'id': uuid.uuid4(), 'deviceid': random.choice(DEVICES),
+            'ts': datetime.datetime.now(), 'temp': random.uniform(15, 30), 'temp_external': random.uniform(-10, 30),
+            'humidity': random.uniform(20, 80), 'battery': random.uniform(2.5, 3.3)}
+
+
+GENERATORS = {'power': power_measurement, 'plug': plug_measurement, 'temp_hum': temp_hum_measurement}
+
+
+def compare(generator, batch, rounds):
+    """
+    :return: dict codec name -> (bytes per measurement, microseconds to decode one measurement)
+    """
+    msg = measurement_msg.MeasurementMessage(1, [generator() for _ in range(batch)])
+    results = {}
+    for msg_codec in (codec.PICKLE, codec.BINARY):
+        encoded = msg_codec.encode(msg)
+        start = time.perf_counter()
+        for _ in range(rounds):
+            msg_codec.decode(encoded)
+        elapsed = time.perf_counter() - start
+        results[msg_codec.name] = (len(encoded) / batch, elapsed / (rounds * batch) * 1e6)
+    return results
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='pickle vs binary encoding of measurement messages')
+    parser.add_argument('--batch', type=int, default=100, help='measurements per message')
+    parser.add_argument('--rounds', type=int, default=1000, help='messages decoded per measurement type and codec')
+    args = parser.parse_args()
+
+    print('%-10s %-8s %14s %14s' % ('type', 'codec', 'bytes/meas.', 'decode us/meas.'))
+    for name, generator in sorted(GENERATORS.items()):
+        for codec_name, (size, decode_time) in sorted(compare(generator, args.batch, args.rounds).items()):
+            print('%-10s %-8s %14.1f %14.2f' % (name, codec_name, size, decode_time))
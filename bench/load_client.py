@@ -0,0 +1,245 @@
+"""
+Simulated I13MonClients for the load test.
+
+A client numbers its messages from 1 on and sends one message of batch
+measurements at a fixed rate over a framed TLS connection. With gap > 0
+some messages are held back and only sent when an ack of the server asks
+for them (wanted), with lost > 0 some of those are answered with an empty
+message, as a client does which has dropped the message. GET_MSG_COUNTER
+requests are answered with the next message id. With credit the client
+never has more messages in flight than the window of the last ack. With
+sack the server answers with selective acks and every held back message
+in their missing ranges is sent at once.
+"""
+import asyncio
+import datetime
+import random
+import ssl
+import time
+import uuid
+from message_types import codec
+from message_types import framing
+from message_types import measurement_msg
+from message_types import requests
+
+# messages in flight before the first ack tells the window
+_INITIAL_WINDOW = 8
+
+
+def _measurement(device, kind):
+    now = datetime.datetime.now()
+    if kind == 'plug':
+        return {'type': 'plug_measurement', 'id': uuid.uuid4(), 'mac_address': device[1], 'ts': now,
+                'load': random.uniform(0, 2000), 'irms': random.uniform(0, 10), 'vrms': random.uniform(220, 240),
+                'freq': random.uniform(49.9, 50.1), 'pow': 'ON', 'work': random.uniform(0, 100)}
+    if kind == 'temp_hum':
+        return {'type': 'temp_hum_measurement', 'id': uuid.uuid4(), 'deviceid': device[0], 'ts': now,
+                'temp': random.uniform(15, 30), 'temp_external': random.uniform(-10, 30),
+                'humidity': random.uniform(20, 80), 'battery': random.uniform(2.5, 3.3)}
+    return {'type': 'power_measurement', 'id': uuid.uuid4(), 'deviceid': device[0], 'ts': now,
+            'power1': random.uniform(0, 3000), 'power2': random.uniform(0, 3000),
+            'power3': random.uniform(0, 3000), 'power4': random.uniform(0, 3000),
+            'vrms': random.uniform(220, 240), 'temp': random.uniform(15, 30)}
+
+
+class ClientOptions():
+    """
+    the behaviour shared by all simulated clients
+    """
+
+    def __init__(self, host, port, root_cert, rate=2.0, batch=10, kinds=('power', 'plug'), binary=True,
+                 credit=True, gap=0.0, lost=0.0, duration=30.0, drain=10.0, sack=False):
+        """
+        :param rate: (float) messages per second of one client
+        :param batch: (int) measurements per message
+        :param kinds: measurement types sent: power, plug, temp_hum
+        :param binary: negotiate the binary codec instead of pickle
+        :param credit: negotiate flow control credit
+        :param gap: (float) probability that a message is held back until the server asks for it
+        :param lost: (float) probability that a held back message is lost when the server asks for it
+        :param duration: (float) seconds of sending
+        :param drain: (float) seconds to wait for the outstanding acks afterwards
+        :param sack: negotiate selective acks
+        """
+        self.host = host
+        self.port = port
+        self.root_cert = root_cert
+        self.rate = rate
+        self.batch = batch
+        self.kinds = kinds
+        self.binary = binary
+        self.credit = credit
+        self.gap = gap
+        self.lost = lost
+        self.duration = duration
+        self.drain = drain
+        self.sack = sack
+
+
+class SimulatedClient():
+
+    def __init__(self, options, cert, key):
+        self._options = options
+        self._sslctx = ssl.create_default_context(cafile=options.root_cert)
+        self._sslctx.check_hostname = False
+        self._sslctx.load_cert_chain(cert, key)
+        self._devices = [(uuid.uuid4(), '00:13:A2:00:%02X:%02X:%02X:%02X' % tuple(random.randrange(256) for _ in range(4)))
+                         for _ in range(4)]
+        self._codec = codec.PICKLE
+        self._writer = None
+        self._next_id = 1
+        # msg id -> time sent, of the messages not acknowledged yet
+        self._in_flight = {}
+        # msg id -> message, held back until the server asks for it
+        self._held = {}
+        self._window = _INITIAL_WINDOW
+        self._acked = asyncio.Event()
+        self.stats = {'sent': 0, 'acked': 0, 'retransmitted': 0, 'lost': 0, 'requests': 0, 'errors': 0}
+        # seconds from sending a message to its ack
+        self.latencies = []
+
+    def make_message(self):
+        kind = random.choice(self._options.kinds)
+        device = random.choice(self._devices)
+        msg = measurement_msg.MeasurementMessage(self._next_id, [_measurement(device, kind)
+                                                                 for _ in range(self._options.batch)])
+        self._next_id += 1
+        return msg
+
+    def send(self, msg):
+        self._writer.write(framing.encode_frame(self._codec.encode(msg)))
+        self._in_flight[msg.get_id()] = time.monotonic()
+        self.stats['sent'] += 1
+
+    @asyncio.coroutine
+    def connect(self):
+        options = self._options
+        reader, self._writer = yield from asyncio.open_connection(options.host, options.port, ssl=self._sslctx)
+        features = ((framing.FEATURE_BINARY if options.binary else 0) | (framing.FEATURE_CREDIT if options.credit else 0) |
+                    (framing.FEATURE_SACK if options.sack else 0))
+        self._writer.write(framing.encode_preamble(framing.VERSION, features))
+        accepted = framing.parse_preamble((yield from reader.readexactly(framing.PREAMBLE_SIZE)))
+        if accepted is None:
+            raise ConnectionError('the server did not answer with a preamble')
+        features = (yield from reader.readexactly(1))[0]
+        self._codec = codec.BINARY if features & framing.FEATURE_BINARY else codec.PICKLE
+        if not features & framing.FEATURE_CREDIT:
+            self._window = None
+        return reader
+
+    @asyncio.coroutine
+    def run(self):
+        try:
+            reader = yield from self.connect()
+        except (OSError, asyncio.IncompleteReadError):
+            self.stats['errors'] += 1
+            return
+        receiving = asyncio.ensure_future(self.receive(reader))
+        options = self._options
+        interval = 1.0 / options.rate
+        # the clients do not start in lockstep
+        yield from asyncio.sleep(random.uniform(0, interval))
+        until = time.monotonic() + options.duration
+        next_send = time.monotonic()
+        try:
+            while time.monotonic() < until and not receiving.done():
+                while (self._window is not None and len(self._in_flight) >= max(self._window, 1) and
+                       not receiving.done()):
+                    self._acked.clear()
+                    yield from self._acked.wait()
+                msg = self.make_message()
+                if options.gap and random.random() < options.gap:
+                    self._held[msg.get_id()] = msg
+                else:
+                    self.send(msg)
+                    yield from self._writer.drain()
+                next_send += interval
+                yield from asyncio.sleep(max(0.0, next_send - time.monotonic()))
+
+            # wait for the acks of what has been sent
+            until = time.monotonic() + options.drain
+            while self._in_flight and time.monotonic() < until and not receiving.done():
+                yield from asyncio.sleep(0.05)
+        except ConnectionError:
+            self.stats['errors'] += 1
+        finally:
+            receiving.cancel()
+            self._writer.close()
+
+    @asyncio.coroutine
+    def receive(self, reader):
+        frame_reader = framing.FrameReader(reader)
+        try:
+            while True:
+                frames = yield from frame_reader.read_frames()
+                if not frames:
+                    return
+                for frame in frames:
+                    self.handle(self._codec.decode(frame))
+        except (asyncio.IncompleteReadError, ConnectionError):
+            return
+        finally:
+            # a sender waiting for credit notices that the connection is gone
+            self._acked.set()
+
+    def acknowledged(self, msg_id):
+        sent = self._in_flight.pop(msg_id, None)
+        if sent is not None:
+            self.latencies.append(time.monotonic() - sent)
+            self.stats['acked'] += 1
+
+    def handle(self, msg):
+        if msg.get_type() == 'ack':
+            self.acknowledged(msg.get_success())
+            if msg.get_window() is not None:
+                self._window = msg.get_window()
+            self._acked.set()
+            self.retransmit(msg.get_wanted())
+        elif msg.get_type() == 'sack':
+            for msg_id in [msg_id for msg_id in self._in_flight if msg.is_acked(msg_id)]:
+                self.acknowledged(msg_id)
+            if msg.get_window() is not None:
+                self._window = msg.get_window()
+            self._acked.set()
+            for msg_id in sorted(msg_id for msg_id in self._held if not msg.is_acked(msg_id) and
+                                 msg_id <= msg.get_last()):
+                self.retransmit(msg_id)
+        elif msg.get_type() == 'request':
+            self.stats['requests'] += 1
+            self._writer.write(framing.encode_frame(self._codec.encode(
+                requests.Request(msg.get_request(), self._next_id))))
+
+    def retransmit(self, wanted):
+        held = self._held.pop(wanted, None)
+        if held is None:
+            return
+        if self._options.lost and random.random() < self._options.lost:
+            # the client does not have the message anymore
+            self.stats['lost'] += 1
+            self._writer.write(framing.encode_frame(self._codec.encode(
+                measurement_msg.MeasurementMessage(wanted, None))))
+        else:
+            self.stats['retransmitted'] += 1
+            self.send(held)
+
+
+def run_clients(options, certificates, results):
+    """
+    runs a group of clients in the calling process, the target of a load test process
+    :param options: ClientOptions
+    :param certificates: list of (certificate, key), one per client
+    :param results: multiprocessing.Queue receiving (stats, latencies)
+    """
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    clients = [SimulatedClient(options, cert, key) for cert, key in certificates]
+    loop.run_until_complete(asyncio.gather(*[client.run() for client in clients]))
+    loop.close()
+
+    stats = {}
+    latencies = []
+    for client in clients:
+        for name, value in client.stats.items():
+            stats[name] = stats.get(name, 0) + value
+        latencies.extend(client.latencies)
+    results.put((stats, latencies))
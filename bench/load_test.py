@@ -0,0 +1,347 @@
+"""
+Load test of the whole pipeline: runs runserver.py against local stand-ins
+for carbon and Postgres (or a throwaway Postgres when initdb is on the
+PATH) and drives it with simulated TLS clients.
+
+    python -m bench.load_test --clients 100 --rate 2 --batch 10 --duration 60
+    python -m bench.load_test --clients 20 --gap 0.02 --lost 0.1 --json before.json
+
+Reports messages and measurements per second, the latency from sending
+a message to its ack and from creating a measurement to its arrival in
+the database, and the memory of the server per connection. --json writes
+the same numbers together with the git revision, to compare commits.
+"""
+import argparse
+import json
+import multiprocessing
+import os
+import shutil
+import signal
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import urllib.request
+from bench import certs
+from bench import load_client
+from bench import standins
+
+REPO = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+_CONFIG = """
+[server]
+serverAddress:127.0.0.1
+serverPort:{server_port}
+workers:{workers}
+statsInterval:0
+flowControl:{flow_control}
+selectiveAcks:true
+
+[bus]
+capacity=67108864
+
+[spool]
+enabled={spool}
+directory=spool
+
+[ssl]
+certFile:{server_cert}
+keyFile:{server_key}
+locationVerification:{root_cert}
+
+[db]
+dbname=i13mon
+user=i13mon
+password=bench
+host=127.0.0.1
+port={db_port}
+
+[dbwriter]
+mode={dbwriter}
+batchSize=500
+batchMaxAge=0.5
+shards={db_shards}
+
+[partitions]
+enabled={partitions}
+
+[rollups]
+enabled={rollups}
+
+[carbon]
+host=127.0.0.1
+port={carbon_port}
+protocol={carbon_protocol}
+retentionRate=1
+aggregation=mean
+
+[metrics]
+statsHost=127.0.0.1
+statsPort={stats_port}
+
+[logging]
+level=WARNING
+console=false
+
+[expired]
+serialNumbers=
+"""
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def wait_for_port(port, process, timeout=30.0):
+    until = time.time() + timeout
+    while time.time() < until:
+        if process.poll() is not None:
+            raise RuntimeError('runserver.py exited with %s' % process.returncode)
+        try:
+            socket.create_connection(('127.0.0.1', port), timeout=1).close()
+            return
+        except OSError:
+            time.sleep(0.2)
+    raise RuntimeError('the server did not listen on port %s within %s seconds' % (port, timeout))
+
+
+def rss(pid):
+    """
+    :return: (int) resident memory in bytes of pid and all its descendants
+    """
+    children = {}
+    for entry in os.listdir('/proc'):
+        if entry.isdigit():
+            try:
+                with open('/proc/%s/stat' % entry) as fin:
+                    # the command may contain spaces, ppid is the second field after it
+                    ppid = int(fin.read().rsplit(')', 1)[1].split()[1])
+            except (OSError, IndexError, ValueError):
+                continue
+            children.setdefault(ppid, []).append(int(entry))
+    total = 0
+    pending = [pid]
+    while pending:
+        current = pending.pop()
+        pending.extend(children.get(current, []))
+        try:
+            with open('/proc/%s/status' % current) as fin:
+                for line in fin:
+                    if line.startswith('VmRSS:'):
+                        total += int(line.split()[1]) * 1024
+        except OSError:
+            pass
+    return total
+
+
+def percentiles(values, quantiles=(0.5, 0.9, 0.99)):
+    if not values:
+        return dict(('p%d' % (q * 100), None) for q in quantiles)
+    values = sorted(values)
+    return dict(('p%d' % (q * 100), values[min(len(values) - 1, int(q * len(values)))]) for q in quantiles)
+
+
+def git_revision():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], cwd=REPO,
+                                       stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run_clients(options, certificates, processes):
+    """
+    runs the clients in processes groups
+    :return: (dict of counters, list of ack latencies)
+    """
+    results = multiprocessing.Queue()
+    groups = [certificates[i::processes] for i in range(processes)]
+    workers = [multiprocessing.Process(target=load_client.run_clients, args=(options, group, results))
+               for group in groups if group]
+    for worker in workers:
+        worker.start()
+    stats = {}
+    latencies = []
+    for _ in workers:
+        group_stats, group_latencies = results.get()
+        for name, value in group_stats.items():
+            stats[name] = stats.get(name, 0) + value
+        latencies.extend(group_latencies)
+    for worker in workers:
+        worker.join()
+    return stats, latencies
+
+
+def wait_until_stable(count, timeout):
+    """
+    waits until count() stops growing, the sinks have written what they got
+    """
+    until = time.time() + timeout
+    last = count()
+    while time.time() < until:
+        time.sleep(1.0)
+        current = count()
+        if current == last:
+            return
+        last = current
+
+
+def main(args):
+    workdir = tempfile.mkdtemp(prefix='i13mon-bench-')
+    print('working directory %s' % workdir)
+    carbon = standins.FakeCarbon(args.carbon_protocol).start()
+    if args.postgres == 'local' or (args.postgres == 'auto' and standins.LocalPostgres.available()):
+        database = standins.LocalPostgres(os.path.join(workdir, 'pg'), os.path.join(REPO, 'sql')).start()
+    else:
+        database = standins.FakePostgres().start()
+    server = None
+    try:
+        certificates = certs.BenchCertificates(os.path.join(workdir, 'certs'), args.clients)
+        server_port = free_port()
+        stats_port = free_port()
+        # the protocol stand-in has no tables to partition or roll up
+        local_postgres = str(isinstance(database, standins.LocalPostgres)).lower()
+        with open(os.path.join(workdir, 'server.config'), 'w') as fout:
+            fout.write(_CONFIG.format(
+                server_port=server_port, workers=args.workers, flow_control=str(not args.no_flow_control).lower(),
+                spool=str(args.spool).lower(), server_cert=certificates.server_cert,
+                server_key=certificates.server_key, root_cert=certificates.root_cert, db_port=database.port,
+                dbwriter=args.dbwriter, db_shards=args.db_shards, partitions=local_postgres, rollups=local_postgres,
+                carbon_port=carbon.port, carbon_protocol=args.carbon_protocol,
+                stats_port=stats_port))
+        shutil.copy(os.path.join(REPO, 'namespace.csv'), workdir)
+
+        env = dict(os.environ)
+        env['PYTHONPATH'] = os.pathsep.join([REPO] + [p for p in [env.get('PYTHONPATH')] if p])
+        server = subprocess.Popen([sys.executable, os.path.join(REPO, 'runserver.py'), '--workers', str(args.workers)],
+                                  cwd=workdir, env=env, start_new_session=True)
+        wait_for_port(server_port, server)
+        idle_memory = rss(server.pid)
+
+        options = load_client.ClientOptions(
+            '127.0.0.1', server_port, certificates.root_cert, rate=args.rate, batch=args.batch,
+            kinds=tuple(args.kinds.split(',')), binary=not args.pickle, credit=not args.no_credit,
+            gap=args.gap, lost=args.lost, duration=args.duration, drain=args.drain, sack=args.sack)
+
+        # the memory is sampled while all clients are connected
+        memory = []
+
+        def sample():
+            time.sleep(min(args.duration / 2, 10))
+            memory.append(rss(server.pid))
+
+        sampler = threading.Thread(target=sample, daemon=True)
+        sampler.start()
+        start = time.time()
+        client_stats, latencies = run_clients(options, certificates.clients, args.processes)
+        elapsed = time.time() - start
+        sampler.join()
+
+        wait_until_stable(lambda: database.rows, args.drain)
+        try:
+            server_metrics = urllib.request.urlopen('http://127.0.0.1:%s/' % stats_port, timeout=5).read().decode()
+        except OSError:
+            server_metrics = ''
+
+        report = {
+            'revision': git_revision(),
+            'clients': args.clients,
+            'workers': args.workers,
+            'seconds': round(elapsed, 2),
+            'client': client_stats,
+            'messages_per_second': client_stats.get('acked', 0) / elapsed,
+            'measurements_per_second': client_stats.get('acked', 0) * args.batch / elapsed,
+            'ack_latency': percentiles(latencies),
+            'db_rows': database.rows,
+            'db_latency': percentiles(getattr(database, 'delays', [])),
+            'carbon_datapoints': carbon.datapoints,
+            'memory_idle': idle_memory,
+            'memory_per_connection': (memory[0] - idle_memory) / args.clients if memory else None,
+            'server_metrics': dict(line.split(' ', 1) for line in server_metrics.splitlines() if ' ' in line),
+        }
+        print_report(report)
+        if args.json:
+            with open(args.json, 'w') as fout:
+                json.dump(report, fout, indent=2, sort_keys=True)
+    finally:
+        if server is not None:
+            stop_server(server)
+        carbon.stop()
+        database.stop()
+        if not args.keep:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+
+def stop_server(server, timeout=15):
+    # SIGINT ends the server like ctrl-c, the DatabaseManager flushes on the way out
+    os.killpg(server.pid, signal.SIGINT)
+    try:
+        server.wait(timeout)
+    except subprocess.TimeoutExpired:
+        os.killpg(server.pid, signal.SIGKILL)
+        server.wait()
+
+
+def _ms(value):
+    return '-' if value is None else '%.1f' % (value * 1000)
+
+
+def print_report(report):
+    client = report['client']
+    print('revision              %s' % report['revision'])
+    print('clients x workers     %s x %s' % (report['clients'], report['workers']))
+    print('messages sent/acked   %s / %s (retransmitted %s, lost %s, errors %s)' %
+          (client.get('sent', 0), client.get('acked', 0), client.get('retransmitted', 0),
+           client.get('lost', 0), client.get('errors', 0)))
+    print('messages/s            %.1f' % report['messages_per_second'])
+    print('measurements/s        %.1f' % report['measurements_per_second'])
+    for name in ('ack_latency', 'db_latency'):
+        latency = report[name]
+        print('%-21s p50 %s ms  p90 %s ms  p99 %s ms' % (name.replace('_', ' '), _ms(latency['p50']),
+                                                          _ms(latency['p90']), _ms(latency['p99'])))
+    print('rows in database      %s' % report['db_rows'])
+    print('carbon datapoints     %s' % report['carbon_datapoints'])
+    server_metrics = report['server_metrics']
+    shard = 0
+    while 'storage.shard%d.db_rows' % shard in server_metrics:
+        prefix = 'storage.shard%d.' % shard
+        print('writer %-14d rows %s (%.1f/s)  errors %s  lag %s bytes' %
+              (shard, server_metrics[prefix + 'db_rows'], int(server_metrics[prefix + 'db_rows']) / report['seconds'],
+               server_metrics[prefix + 'db_errors'], server_metrics[prefix + 'storage_lag']))
+        shard += 1
+    if report['memory_per_connection'] is not None:
+        print('memory per connection %.1f KiB (idle server %.1f MiB)' %
+              (report['memory_per_connection'] / 1024, report['memory_idle'] / 1024 / 1024))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='load test of runserver.py with simulated clients')
+    parser.add_argument('--clients', type=int, default=20, help='number of simulated clients')
+    parser.add_argument('--processes', type=int, default=max(1, multiprocessing.cpu_count() // 2),
+                        help='processes running the clients')
+    parser.add_argument('--rate', type=float, default=2.0, help='messages per second of each client')
+    parser.add_argument('--batch', type=int, default=10, help='measurements per message')
+    parser.add_argument('--kinds', default='power,plug', help='measurement types: power, plug, temp_hum')
+    parser.add_argument('--duration', type=float, default=30.0, help='seconds of sending')
+    parser.add_argument('--drain', type=float, default=10.0, help='seconds to wait for acks and sinks afterwards')
+    parser.add_argument('--gap', type=float, default=0.0, help='probability that a message is sent only when asked for')
+    parser.add_argument('--lost', type=float, default=0.0, help='probability that an asked for message is lost')
+    parser.add_argument('--pickle', action='store_true', help='use the pickle codec instead of binary')
+    parser.add_argument('--no-credit', action='store_true', help='do not negotiate flow control credit')
+    parser.add_argument('--sack', action='store_true', help='negotiate selective acks')
+    parser.add_argument('--no-flow-control', action='store_true', help='run the server without flow control')
+    parser.add_argument('--workers', type=int, default=1, help='server processes')
+    parser.add_argument('--dbwriter', default='copy', choices=('row', 'values', 'copy'))
+    parser.add_argument('--db-shards', type=int, default=1, help='database writer processes')
+    parser.add_argument('--carbon-protocol', default='pickle', choices=('plaintext', 'pickle'))
+    parser.add_argument('--spool', action='store_true', help='enable the durable spool')
+    parser.add_argument('--postgres', default='auto', choices=('auto', 'fake', 'local'),
+                        help='fake: the protocol stand-in, local: a throwaway cluster made with initdb, '
+                             'auto: local if initdb is found')
+    parser.add_argument('--json', help='write the report to this file')
+    parser.add_argument('--keep', action='store_true', help='keep the working directory')
+    main(parser.parse_args())
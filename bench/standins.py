@@ -0,0 +1,276 @@
+"""
+Local stand-ins for the services behind the server: a carbon receiver
+(line or pickle protocol) and a Postgres server speaking just enough of
+the frontend/backend protocol for psycopg2 and the DatabaseManager
+(simple queries, transactions, savepoints and COPY FROM STDIN), or a
+throwaway Postgres cluster when initdb is installed.
+
+Both count what they receive. The Postgres stand-in takes the time of
+every row from its ts column, so the load test gets the latency from the
+client creating a measurement to the measurement reaching the database.
+"""
+import asyncio
+import datetime
+import os
+import pickle
+import re
+import shutil
+import socket
+import struct
+import subprocess
+import threading
+import time
+
+# a timestamp as written by COPY (csv) or by psycopg2's adapter
+_TS = re.compile(rb"(\d{4}-\d{2}-\d{2})[ T](\d{2}:\d{2}:\d{2}(?:\.\d+)?)")
+
+_SSL_REQUEST = 80877103
+_GSSENC_REQUEST = 80877104
+_INT32 = struct.Struct('!i')
+_PICKLE_HEADER = struct.Struct('!L')
+
+_PARAMETERS = (
+    ('server_version', '13.0'),
+    ('server_encoding', 'UTF8'),
+    ('client_encoding', 'UTF8'),
+    ('DateStyle', 'ISO, MDY'),
+    ('integer_datetimes', 'on'),
+    ('standard_conforming_strings', 'on'),
+    ('TimeZone', 'UTC'),
+)
+
+
+def _parse_ts(match):
+    text = (match.group(1) + b' ' + match.group(2)).decode('ascii')
+    fmt = '%Y-%m-%d %H:%M:%S.%f' if '.' in text else '%Y-%m-%d %H:%M:%S'
+    return datetime.datetime.strptime(text, fmt)
+
+
+class StandIn():
+    """
+    runs an asyncio server in a thread of its own
+    """
+
+    def __init__(self, host='127.0.0.1', port=0):
+        self.host = host
+        self.port = port
+        self._loop = None
+        self._server = None
+        self._thread = None
+
+    def start(self):
+        started = threading.Event()
+
+        def run():
+            self._loop = asyncio.new_event_loop()
+            asyncio.set_event_loop(self._loop)
+            self._server = self._loop.run_until_complete(
+                asyncio.start_server(self.handle, self.host, self.port))
+            self.port = self._server.sockets[0].getsockname()[1]
+            started.set()
+            self._loop.run_forever()
+
+        self._thread = threading.Thread(target=run, name=type(self).__name__, daemon=True)
+        self._thread.start()
+        started.wait()
+        return self
+
+    def stop(self):
+        self._loop.call_soon_threadsafe(self._loop.stop)
+        self._thread.join()
+
+
+class FakeCarbon(StandIn):
+    """
+    a carbon line (plaintext) or pickle receiver counting datapoints
+    """
+
+    def __init__(self, protocol='pickle', host='127.0.0.1', port=0):
+        super().__init__(host, port)
+        self.protocol = protocol
+        self.datapoints = 0
+        # seconds between the timestamp of a datapoint and its arrival
+        self.delays = []
+
+    def received(self, timestamps):
+        now = time.time()
+        self.datapoints += len(timestamps)
+        self.delays.extend(now - ts for ts in timestamps)
+
+    @asyncio.coroutine
+    def handle(self, reader, writer):
+        try:
+            if self.protocol == 'pickle':
+                while True:
+                    size = _PICKLE_HEADER.unpack((yield from reader.readexactly(_PICKLE_HEADER.size)))[0]
+                    batch = pickle.loads((yield from reader.readexactly(size)))
+                    self.received([ts for _, (ts, _) in batch])
+            else:
+                while True:
+                    line = yield from reader.readline()
+                    if not line:
+                        break
+                    self.received([float(line.split()[2])])
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            writer.close()
+
+
+class FakePostgres(StandIn):
+    """
+    accepts any user and database and answers every statement with success,
+    inserted rows are counted and thrown away
+    """
+
+    def __init__(self, host='127.0.0.1', port=0):
+        super().__init__(host, port)
+        self.rows = 0
+        self.transactions = 0
+        # seconds between the ts of a row and its arrival
+        self.delays = []
+
+    def received(self, data):
+        now = datetime.datetime.now()
+        count = 0
+        for match in _TS.finditer(data):
+            self.delays.append((now - _parse_ts(match)).total_seconds())
+            count += 1
+        self.rows += count
+        return count
+
+    @staticmethod
+    def message(kind, body=b''):
+        return kind + _INT32.pack(len(body) + 4) + body
+
+    def ready(self, writer, status):
+        writer.write(self.message(b'Z', status))
+
+    @asyncio.coroutine
+    def startup(self, reader, writer):
+        while True:
+            size = _INT32.unpack((yield from reader.readexactly(4)))[0]
+            body = yield from reader.readexactly(size - 4)
+            code = _INT32.unpack(body[:4])[0]
+            if code in (_SSL_REQUEST, _GSSENC_REQUEST):
+                # no encryption, the client goes on in plaintext
+                writer.write(b'N')
+                continue
+            break
+        writer.write(self.message(b'R', _INT32.pack(0)))
+        for name, value in _PARAMETERS:
+            writer.write(self.message(b'S', name.encode() + b'\0' + value.encode() + b'\0'))
+        writer.write(self.message(b'K', struct.pack('!ii', 4242, 2424)))
+
+    @asyncio.coroutine
+    def handle(self, reader, writer):
+        status = b'I'
+        try:
+            yield from self.startup(reader, writer)
+            self.ready(writer, status)
+            while True:
+                kind = yield from reader.readexactly(1)
+                size = _INT32.unpack((yield from reader.readexactly(4)))[0]
+                body = yield from reader.readexactly(size - 4)
+                if kind == b'X':
+                    break
+                if kind != b'Q':
+                    writer.write(self.message(b'E', b'SERROR\0C0A000\0Mnot supported by the stand-in\0\0'))
+                    self.ready(writer, status)
+                    continue
+
+                query = body.rstrip(b'\0').strip()
+                command = query.split(None, 1)[0].upper() if query else b''
+                if not command:
+                    writer.write(self.message(b'I'))
+                elif command == b'COPY':
+                    count = yield from self.copy_in(reader, writer)
+                    if count is None:
+                        writer.write(self.message(b'E', b'SERROR\0C57014\0MCOPY failed\0\0'))
+                    else:
+                        writer.write(self.message(b'C', ('COPY %d\0' % count).encode()))
+                elif command == b'INSERT':
+                    writer.write(self.message(b'C', ('INSERT 0 %d\0' % self.received(query)).encode()))
+                else:
+                    if command == b'BEGIN':
+                        status = b'T'
+                    elif command == b'COMMIT' or (command == b'ROLLBACK' and b' TO ' not in query.upper()):
+                        self.transactions += command == b'COMMIT'
+                        status = b'I'
+                    writer.write(self.message(b'C', command + b'\0'))
+                self.ready(writer, status)
+                yield from writer.drain()
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            writer.close()
+
+    @asyncio.coroutine
+    def copy_in(self, reader, writer):
+        """
+        receives the data of a COPY FROM STDIN
+        :return: (int) the number of rows, None if the client gave up
+        """
+        writer.write(self.message(b'G', struct.pack('!bh', 0, 0)))
+        yield from writer.drain()
+        chunks = []
+        while True:
+            kind = yield from reader.readexactly(1)
+            size = _INT32.unpack((yield from reader.readexactly(4)))[0]
+            body = yield from reader.readexactly(size - 4)
+            if kind == b'd':
+                chunks.append(body)
+            elif kind == b'c':
+                return self.received(b''.join(chunks))
+            elif kind == b'f':
+                return None
+
+
+class LocalPostgres():
+    """
+    a throwaway cluster made with initdb, owned by the user i13mon and
+    created with the scripts in sql/, it is deleted by stop
+    rows are counted in the tables, the latency to the database is not known
+    """
+    _TABLES = ('rfmpi', 'zigbeeplugs')
+
+    def __init__(self, directory, sql_directory, port=None):
+        self.directory = directory
+        self.sql_directory = sql_directory
+        self.port = port
+        self.delays = []
+
+    @staticmethod
+    def available():
+        return all(shutil.which(tool) for tool in ('initdb', 'pg_ctl', 'psql', 'createdb'))
+
+    def _run(self, *args):
+        subprocess.check_call(args, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+    def _psql(self, *args):
+        return subprocess.check_output(('psql', '-h', '127.0.0.1', '-p', str(self.port), '-U', 'i13mon',
+                                        '-d', 'i13mon', '-v', 'ON_ERROR_STOP=1', '-qtA') + args,
+                                       stderr=subprocess.DEVNULL).decode()
+
+    def start(self):
+        if self.port is None:
+            with socket.socket() as sock:
+                sock.bind(('127.0.0.1', 0))
+                self.port = sock.getsockname()[1]
+        data = os.path.join(self.directory, 'data')
+        self._run('initdb', '-D', data, '-U', 'i13mon', '--auth=trust')
+        self._run('pg_ctl', '-D', data, '-w', '-l', os.path.join(self.directory, 'postgres.log'), 'start',
+                  '-o', '-p %s -k %s -c listen_addresses=127.0.0.1 -c fsync=off' % (self.port, self.directory))
+        self._run('createdb', '-h', '127.0.0.1', '-p', str(self.port), '-U', 'i13mon', 'i13mon')
+        for name in sorted(os.listdir(self.sql_directory)):
+            if name.endswith('.sql'):
+                self._psql('-f', os.path.join(self.sql_directory, name))
+        return self
+
+    @property
+    def rows(self):
+        query = ' + '.join('(SELECT count(*) FROM %s)' % table for table in self._TABLES)
+        return int(self._psql('-c', 'SELECT %s' % query).strip())
+
+    def stop(self):
+        self._run('pg_ctl', '-D', os.path.join(self.directory, 'data'), '-m', 'fast', 'stop')
@@ -0,0 +1,197 @@
+"""
+The sink keeping the recent samples in memory and answering queries on them.
+
+The CacheAgent reads the bus like the DatabaseManager and the CarbonClient
+and serves the RecentCache over HTTP from the same asyncio loop, the
+waiting for the next batch runs in a thread of the loop's executor so
+that the cache is only touched by the loop. Every answer is JSON, times
+are seconds since the epoch:
+
+    GET /devices                                    {device: [metric, ...]}
+    GET /latest?device=D[&metric=M]                 {metric: [time, value]}
+    GET /window?device=D&metric=M[&seconds=S]       [[time, value], ...]
+    GET /series?device=D&metric=M&step=T[&seconds=S][&aggregation=mean|min|max|last]
+                                                    [[bucket start, value], ...]
+
+The cache is not durable, the batches are committed as soon as they are read.
+"""
+import asyncio
+import json
+import logging
+import multiprocessing
+import time
+import urllib.parse
+from cache_mnger import recent_cache
+from util import columnar
+from util import metrics
+
+_logger = logging.getLogger(__name__)
+
+DEFAULT_HOST = '127.0.0.1'
+DEFAULT_PORT = 13214
+
+# seconds a get on the bus waits, and between two expiries of the series
+_GET_TIMEOUT = 1.0
+_EXPIRE_INTERVAL = 60.0
+
+_MAX_REQUEST_LINE = 8192
+
+_REASONS = {200: 'OK', 400: 'Bad Request', 404: 'Not Found', 405: 'Method Not Allowed'}
+
+
+class QueryError(Exception):
+    """
+    a query which can not be answered, status is the HTTP status of the answer
+    """
+
+    def __init__(self, status, message):
+        Exception.__init__(self, message)
+        self.status = status
+
+
+class CacheAgent(multiprocessing.Process):
+    """
+    fills a RecentCache from the bus and serves queries on it
+    """
+
+    def __init__(self, reader, cache=None, host=DEFAULT_HOST, port=DEFAULT_PORT, process_metrics=None):
+        """
+        :param reader: util.bus.BusReader delivering batches of measurements
+        :param cache: recent_cache.RecentCache, one with the default capacity and horizon if None
+        :param host: address of the query API
+        :param port: (int) port of the query API
+        :param process_metrics: util.metrics.ProcessMetrics of this process
+        """
+        multiprocessing.Process.__init__(self, daemon=True)
+        self._reader = reader
+        self._cache = cache if cache is not None else recent_cache.RecentCache()
+        self._host = host
+        self._port = port
+        self._metrics = process_metrics if process_metrics is not None else metrics.local()
+        self._next_expire = 0
+
+    def run(self):
+        """
+        runs the CacheAgent process
+        """
+        loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(loop)
+        server = loop.run_until_complete(asyncio.start_server(self.handle, self._host, self._port))
+        _logger.info("#info:serving-recent-data-on-%s:%s", self._host, self._port)
+        try:
+            loop.run_until_complete(self.consume(loop))
+        finally:
+            server.close()
+            loop.close()
+
+    @asyncio.coroutine
+    def consume(self, loop):
+        """
+        moves the batches from the bus into the cache
+        """
+        while True:
+            try:
+                batch = yield from loop.run_in_executor(None, self._reader.get, _GET_TIMEOUT)
+                now = time.time()
+                if batch is not None:
+                    if self._reader.published is not None:
+                        self._metrics.observe('cache_queue_wait', max(0.0, now - self._reader.published))
+                    self._reader.commit()
+                    self.add_batch(batch)
+                if now >= self._next_expire:
+                    self._next_expire = now + _EXPIRE_INTERVAL
+                    self._metrics.set('cache_series', self._cache.expire(now))
+                self._metrics.set('cache_lag', self._reader.lag())
+            except Exception as e:
+                _logger.error("#error:filling-the-recent-data-cache-failed")
+                _logger.exception(e)
+
+    def add_batch(self, batch):
+        added = 0
+        for columns in columnar.columns_of(batch):
+            try:
+                added += self._cache.add(columns)
+            except (KeyError, TypeError, ValueError) as e:
+                _logger.warn("#warn:can-not-cache-measurements-%s", e)
+        self._metrics.incr('cache_samples', added)
+
+    @asyncio.coroutine
+    def handle(self, reader, writer):
+        """
+        answers one HTTP request and closes the connection
+        """
+        try:
+            request_line = yield from reader.readline()
+            # the headers are not needed
+            while True:
+                line = yield from reader.readline()
+                if line in (b'\r\n', b'\n', b''):
+                    break
+            start = time.monotonic()
+            try:
+                status, body = 200, self.query(request_line)
+            except QueryError as e:
+                status, body = e.status, {'error': str(e)}
+            self._metrics.incr('cache_queries')
+            self._metrics.since('cache_query', start)
+            payload = json.dumps(body).encode()
+            writer.write(('HTTP/1.0 %d %s\r\nContent-Type: application/json\r\nContent-Length: %d\r\n\r\n' %
+                          (status, _REASONS[status], len(payload))).encode('ascii') + payload)
+            yield from writer.drain()
+        except (ConnectionError, asyncio.IncompleteReadError, ValueError) as e:
+            _logger.debug("#debug:cache-query-connection-failed:%s", e)
+        finally:
+            writer.close()
+
+    def query(self, request_line):
+        """
+        :param request_line: (bytes) e.g. b'GET /latest?device=... HTTP/1.1'
+        :return: the answer, encoded as JSON
+        """
+        if len(request_line) > _MAX_REQUEST_LINE:
+            raise QueryError(400, 'request line too long')
+        parts = request_line.decode('latin-1').split()
+        if len(parts) < 2:
+            raise QueryError(400, 'malformed request line')
+        if parts[0] != 'GET':
+            raise QueryError(405, 'only GET is supported')
+        url = urllib.parse.urlsplit(parts[1])
+        params = dict(urllib.parse.parse_qsl(url.query))
+        now = time.time()
+        cache = self._cache
+
+        if url.path == '/devices':
+            return cache.devices()
+        if url.path not in ('/latest', '/window', '/series'):
+            raise QueryError(404, 'unknown path %s' % url.path)
+        device = _param(params, 'device')
+        if url.path == '/latest':
+            return cache.latest(device, now, params.get('metric'))
+        metric = _param(params, 'metric')
+        seconds = _float_param(params, 'seconds')
+        if url.path == '/window':
+            return cache.window(device, metric, now, seconds)
+        step = _float_param(params, 'step')
+        if step is None or step <= 0:
+            raise QueryError(400, 'step must be a positive number of seconds')
+        aggregation = params.get('aggregation', recent_cache.AGGREGATION_MEAN)
+        if aggregation not in recent_cache.AGGREGATIONS:
+            raise QueryError(400, 'unknown aggregation %s' % aggregation)
+        return cache.series(device, metric, now, step, seconds, aggregation)
+
+
+def _param(params, name):
+    value = params.get(name)
+    if not value:
+        raise QueryError(400, 'missing parameter %s' % name)
+    return value
+
+
+def _float_param(params, name):
+    value = params.get(name)
+    if value is None:
+        return None
+    try:
+        return float(value)
+    except ValueError:
+        raise QueryError(400, '%s is not a number' % name)
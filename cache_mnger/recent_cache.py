@@ -0,0 +1,212 @@
+"""
+The recent samples of every device and metric, kept in memory.
+
+Each series is a ring of two array('d'), the times in seconds since the
+epoch and the values, holding at most capacity samples. A ring grows up
+to its capacity and then overwrites its oldest samples, so the memory of
+a series stays bounded and no objects are allocated per sample. Samples
+older than the horizon are not returned, series without a sample within
+the horizon are dropped by expire.
+
+Metrics are named after the columns of the database tables, like the
+rollups (dbmnger/rollups.py).
+"""
+import array
+import math
+
+DEFAULT_CAPACITY = 600
+DEFAULT_HORIZON = 600.0
+
+AGGREGATION_MEAN = 'mean'
+AGGREGATION_MIN = 'min'
+AGGREGATION_MAX = 'max'
+AGGREGATION_LAST = 'last'
+AGGREGATIONS = (AGGREGATION_MEAN, AGGREGATION_MIN, AGGREGATION_MAX, AGGREGATION_LAST)
+
+# the device key and the (metric, key in measurement) pairs of each measurement type
+_METRICS = {
+    'power_measurement': ('deviceid', (('power1', 'power1'), ('power2', 'power2'), ('power3', 'power3'),
+                                       ('power4', 'power4'), ('vrms', 'vrms'), ('temp', 'temp'))),
+    'plug_measurement': ('mac_address', (('load', 'load'), ('irms', 'irms'), ('vrms', 'vrms'),
+                                         ('freq', 'freq'), ('work', 'work'))),
+    'temp_hum_measurement': ('deviceid', (('temperature', 'temp'), ('externaltemp', 'temp_external'),
+                                          ('humidity', 'humidity'), ('battery', 'battery'))),
+}
+
+
+class SeriesRing():
+    """
+    the last capacity samples of one metric of one device, in the order they arrived
+    """
+
+    def __init__(self, capacity=DEFAULT_CAPACITY):
+        self._capacity = capacity
+        self._times = array.array('d')
+        self._values = array.array('d')
+        # the index written next once the ring is full
+        self._next = 0
+        # the sample with the latest time, retransmitted samples may arrive late
+        self.latest_time = -math.inf
+        self.latest_value = None
+
+    def __len__(self):
+        return len(self._times)
+
+    def append(self, ts, value):
+        if len(self._times) < self._capacity:
+            self._times.append(ts)
+            self._values.append(value)
+        else:
+            self._times[self._next] = ts
+            self._values[self._next] = value
+            self._next = (self._next + 1) % self._capacity
+        if ts >= self.latest_time:
+            self.latest_time = ts
+            self.latest_value = value
+
+    def window(self, since):
+        """
+        :return: list of (time, value) with time >= since, sorted by time
+        """
+        times = self._times
+        values = self._values
+        # oldest first, the samples are nearly in order so the sort is cheap
+        order = list(range(self._next, len(times))) + list(range(self._next))
+        return sorted((times[i], values[i]) for i in order if times[i] >= since)
+
+
+def downsample(samples, step, aggregation=AGGREGATION_MEAN):
+    """
+    :param samples: list of (time, value) sorted by time
+    :param step: (float) seconds per bucket, buckets start at multiples of step
+    :return: list of (bucket start, aggregated value)
+    """
+    if aggregation not in AGGREGATIONS:
+        raise ValueError('unknown aggregation %s' % aggregation)
+    series = []
+    bucket = None
+    for ts, value in samples:
+        start = math.floor(ts / step) * step
+        if start != bucket:
+            if bucket is not None:
+                series.append((bucket, _aggregate(bucket_values, aggregation)))
+            bucket = start
+            bucket_values = []
+        bucket_values.append(value)
+    if bucket is not None:
+        series.append((bucket, _aggregate(bucket_values, aggregation)))
+    return series
+
+
+def _aggregate(values, aggregation):
+    if aggregation == AGGREGATION_MIN:
+        return min(values)
+    if aggregation == AGGREGATION_MAX:
+        return max(values)
+    if aggregation == AGGREGATION_LAST:
+        return values[-1]
+    return sum(values) / len(values)
+
+
+class RecentCache():
+    """
+    the rings of all devices and metrics
+    """
+
+    def __init__(self, capacity=DEFAULT_CAPACITY, horizon=DEFAULT_HORIZON):
+        """
+        :param capacity: (int) samples kept per device and metric
+        :param horizon: (float) seconds of samples returned and kept
+        """
+        self._capacity = capacity
+        self._horizon = horizon
+        # device -> metric -> SeriesRing
+        self._devices = {}
+
+    def add(self, columns):
+        """
+        adds the values of the measurements of one type
+        :param columns: util.columnar.TypeColumns, turned off plugs have been dropped when the batch was built
+        :return: (int) number of samples added
+        """
+        spec = _METRICS.get(columns.type_name)
+        if spec is None:
+            return 0
+        metrics = spec[1]
+        times = columns.times
+        added = 0
+        for i, device in enumerate(columns.devices):
+            device = str(device)
+            series = self._devices.get(device)
+            if series is None:
+                series = self._devices[device] = {}
+            ts = times[i]
+            for metric, key in metrics:
+                value = columns.values[key][i]
+                if value is None:
+                    continue
+                ring = series.get(metric)
+                if ring is None:
+                    ring = series[metric] = SeriesRing(self._capacity)
+                ring.append(ts, float(value))
+                added += 1
+        return added
+
+    def expire(self, now):
+        """
+        drops the series without a sample within the horizon
+        :param now: (float) time.time()
+        :return: (int) number of series left
+        """
+        oldest = now - self._horizon
+        left = 0
+        for device in list(self._devices):
+            series = self._devices[device]
+            for metric in [metric for metric, ring in series.items() if ring.latest_time < oldest]:
+                del series[metric]
+            if not series:
+                del self._devices[device]
+            left += len(series)
+        return left
+
+    def devices(self):
+        """
+        :return: dict device -> sorted list of its metrics
+        """
+        return dict((device, sorted(series)) for device, series in self._devices.items())
+
+    def _ring(self, device, metric):
+        return self._devices.get(device, {}).get(metric)
+
+    def latest(self, device, now, metric=None):
+        """
+        :return: dict metric -> (time, value) of the latest sample within the horizon,
+        of one metric or all metrics of the device
+        """
+        oldest = now - self._horizon
+        series = self._devices.get(device, {})
+        metrics = [metric] if metric is not None else sorted(series)
+        latest = {}
+        for name in metrics:
+            ring = series.get(name)
+            if ring is not None and ring.latest_time >= oldest:
+                latest[name] = (ring.latest_time, ring.latest_value)
+        return latest
+
+    def window(self, device, metric, now, seconds=None):
+        """
+        :param seconds: (float) length of the window, at most the horizon
+        :return: list of (time, value) of the last seconds, sorted by time
+        """
+        ring = self._ring(device, metric)
+        if ring is None:
+            return []
+        seconds = self._horizon if seconds is None else min(seconds, self._horizon)
+        return ring.window(now - seconds)
+
+    def series(self, device, metric, now, step, seconds=None, aggregation=AGGREGATION_MEAN):
+        """
+        :param step: (float) seconds per point
+        :return: list of (bucket start, value) of the last seconds downsampled to one value per step
+        """
+        return downsample(self.window(device, metric, now, seconds), step, aggregation)
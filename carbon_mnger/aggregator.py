@@ -0,0 +1,111 @@
+"""
+carbon stores one datapoint per metric and retention bucket, a second
+datapoint sent for the same bucket overwrites the first one.
+power-measurements arrive twice per second, so instead of waiting a whole
+bucket between two sends, the samples of a bucket are merged here and
+sent once the bucket is complete.
+a sample arriving after its bucket has been sent is dropped, sending it
+would overwrite the merged datapoint with a single sample.
+"""
+import logging
+import time
+
+_logger = logging.getLogger(__name__)
+
+AGGREGATIONS = ('last', 'mean', 'min', 'max')
+
+# index of the fields of a bucket
+_START, _COUNT, _SUM, _MIN, _MAX, _LAST, _TOUCHED = range(7)
+
+
+class MetricAggregator():
+	"""
+	merges the samples of every metric per retention bucket
+	"""
+
+	def __init__(self, retention_rate=1, method='last', delay=None):
+		"""
+		:param retention_rate: (int) seconds per bucket, as set in carbon's storage-schema.conf
+		:param method: how the samples of a bucket are merged: last, mean, min or max
+		:param delay: seconds a bucket waits for further samples after its last one,
+		defaults to one retention_rate
+		"""
+		if method not in AGGREGATIONS:
+			raise ValueError('unknown aggregation method %s' % method)
+		self._rate = retention_rate
+		self._method = method
+		self._delay = retention_rate if delay is None else delay
+		self._buckets = {}
+		# the start of the last bucket sent of every metric
+		self._sent = {}
+		# samples dropped because their bucket had been sent already
+		self.late = 0
+
+	def add(self, path, value, ts):
+		"""
+		adds a sample to the bucket of its metric
+		:param path: the metric, any hashable name such as made by output.compile_path
+		:param value: the value of the sample
+		:param ts: (float) seconds since the epoch
+		:return: list of completed (path, value, bucket_start) datapoints
+		"""
+		start = int(ts // self._rate) * self._rate
+		completed = []
+		bucket = self._buckets.get(path)
+		sent = self._sent.get(path)
+		if (bucket is not None and start < bucket[_START]) or (sent is not None and start <= sent):
+			# a late sample of an already completed bucket
+			self.late += 1
+			_logger.debug("#debug:dropping-late-sample-of-%s-at-%s", path, ts)
+			return completed
+		if bucket is not None and bucket[_START] != start:
+			completed.append(self._complete(path, bucket))
+			bucket = None
+
+		if bucket is None:
+			bucket = [start, 0, 0.0, None, None, None, None]
+			self._buckets[path] = bucket
+
+		bucket[_LAST] = value
+		bucket[_TOUCHED] = time.time()
+		try:
+			number = float(value)
+		except (TypeError, ValueError):
+			return completed
+		bucket[_COUNT] += 1
+		bucket[_SUM] += number
+		if bucket[_MIN] is None or number < bucket[_MIN]:
+			bucket[_MIN] = number
+		if bucket[_MAX] is None or number > bucket[_MAX]:
+			bucket[_MAX] = number
+		return completed
+
+	def flush(self, now=None, force=False):
+		"""
+		:param now: (float) the current time, defaults to time.time()
+		:param force: complete every bucket, even if it could still receive samples
+		:return: list of completed (path, value, bucket_start) datapoints
+		"""
+		if now is None:
+			now = time.time()
+		completed = []
+		for path, bucket in list(self._buckets.items()):
+			if force or now - bucket[_TOUCHED] >= self._delay:
+				completed.append(self._complete(path, bucket))
+		return completed
+
+	def _complete(self, path, bucket):
+		del self._buckets[path]
+		self._sent[path] = bucket[_START]
+		if self._method == 'last' or not bucket[_COUNT]:
+			value = bucket[_LAST]
+		elif self._method == 'mean':
+			value = bucket[_SUM] / bucket[_COUNT]
+		elif self._method == 'min':
+			value = bucket[_MIN]
+		else:
+			value = bucket[_MAX]
+		return path, value, bucket[_START]
+
+	def __len__(self):
+		return len(self._buckets)
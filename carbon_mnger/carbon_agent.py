@@ -1,9 +1,12 @@
 import logging
-import socket
+import math
 import time
 import multiprocessing
-import os
-from util import utilities
+from carbon_mnger.aggregator import MetricAggregator
+from carbon_mnger import namespace
+from carbon_mnger import output
+from util import columnar
+from util import metrics
 
 # default carbon service configuration
 _CARBON_HOST = '0.0.0.0'
@@ -13,146 +16,226 @@ _CARBON_PORT = 2003
 """
 The retention rate which has been set in carbon's storage-schema.conf
 for our schema: in this case 'i13mon.*'
-after sending power-measurements we sleep 1 second, otherwise carbon will
-not store the next data which is sent in the same time frame of 1 second
+carbon stores only one datapoint per time frame of 1 second, so the
+samples of every metric are aggregated per time frame before sending
 (power-measurement are sent twice per second)
 """
 _RETENTION_RATE = 1
+_AGGREGATION = 'last'
+
+# seconds between two reconnects, once a reconnect gave up
+_RECONNECT_INTERVAL = 30
+
+# seconds between two reports of the pipeline metrics to carbon
+_REPORT_INTERVAL = 10
 
 _logger = logging.getLogger(__name__)
 
 
-def load_namespace_dict(filename='namespace.csv'):
+def load_namespace_dict(filename=namespace.DEFAULT_FILENAME):
 	"""
 	loads the csv file containing the mapping for deviceid/mc_address to hierarchical names
 	:param filename:
 	:return: dictionary
 	"""
-	name_dict = {}
-	with os.open(filename, mode='r+') as fin:
-		for line in fin.readlines():
-			id_name_pair = line.split(',')
-			name_dict[id_name_pair[0]] = id_name_pair[1].strip()
-	return name_dict
+	return namespace.read_namespace(filename)
 
 class CarbonClient(multiprocessing.Process):
 	"""
 	The main Class responsible for sending data to the
 	carbon storage service
 	"""
-	def __init__(self, queue, name_dict):
+	def __init__(self, reader, name_dict, host=_CARBON_HOST, port=_CARBON_PORT,
+				 retention_rate=_RETENTION_RATE, aggregation=_AGGREGATION, carbon_output=None,
+				 process_metrics=None, registry=None, report_prefix=None, report_interval=_REPORT_INTERVAL):
 		"""
-		:param queue: the shared queue for consuming data
+		:param reader: util.bus.BusReader delivering batches of measurements
 		:param name_dict: a dictionary containing mapping for device's name
-		and deviceid/mac_address
+		and deviceid/mac_address, or a namespace.NamespaceFile reloaded while running
+		:param retention_rate: seconds per datapoint in carbon's storage-schema.conf
+		:param aggregation: how samples of the same second are merged: last, mean, min or max
+		:param carbon_output: output.CarbonOutput buffering the datapoints, defaults to
+		plaintext lines sent to host:port
+		:param process_metrics: util.metrics.ProcessMetrics of this process
+		:param registry: util.metrics.MetricsRegistry of the whole pipeline, reported to carbon
+		under report_prefix (e.g. i13mon.server) every report_interval seconds if both are given
 		:return:
 		"""
 		multiprocessing.Process.__init__(self, daemon=True)
-		self._socket = socket.socket()
-		self.queue = queue
-		self.dictionary = name_dict
+		if carbon_output is None:
+			carbon_output = output.CarbonOutput(host, port)
+		self._output = carbon_output
+		self._retention_rate = retention_rate
+		self._aggregator = MetricAggregator(retention_rate, aggregation)
+		self._next_flush = 0
+		self._reader = reader
+		self._durable = getattr(reader, 'durable', False)
+		self._metrics = process_metrics if process_metrics is not None else metrics.local()
+		self._registry = registry
+		self._report_prefix = report_prefix
+		self._report_interval = report_interval
+		self._next_report = 0
+		if isinstance(name_dict, namespace.NamespaceFile):
+			self._namespace_file = name_dict
+		else:
+			self._namespace_file = None
+			self._namespace = namespace.Namespace(name_dict)
+		# the report paths compiled so far
+		self._report_paths = {}
 
 	def connect(self):
-		self._socket.connect((_CARBON_HOST, _CARBON_PORT))
-		_logger.debug('#debug:connected!')
+		self._output.connect()
 
 	def disconnect(self):
-		self._socket.close()
-
-	def get_message_filter(self, data):
-		"""
-		cheeck to see if there is a mapping for this device in file name_dict
-		:param data: dictionary representing a node (a measurement)
-		:return: string : hierarchical name for the device or deviceid/mcAddress if
-		no hierarchical name is mapped for this device
-		"""
-		if data['type'] == 'power_measurement' or data['type'] == 'temp_hum_measurement' :
-			if str(data['deviceid']) in self.dictionary:
-				return self.dictionary[str(data['deviceid'])]
-			else:
-				_logger.warn('#debug:no-name-exists-for-device:-%s' % data['deviceid'])
-				return data['deviceid']
-		elif data['type'] == 'plug_measurement':
-			if str(data['mac_address']) in self.dictionary:
-				return self.dictionary[str(data['mac_address'])]
-			else:
-				_logger.warn('#debug:no-name-exists-for-device:-%s' % data['mac_address'])
-				return data['mac_address']
-
-	def send_power_measurement(self, data, message_filter):
-		_logger.debug('#debug:sending-power=measurement-' + message_filter)
-		self.send(message_filter+'power1', data['power1'])
-		self.send(message_filter+'power2', data['power2'])
-		self.send(message_filter+'power3', data['power3'])
-		self.send(message_filter+'power4', data['power4'])
-		self.send(message_filter+'vrms', data['vrms'])
-		self.send(message_filter+'temperature', data['temp'])
-
-	def send_temp_hum_measurement(self, data, message_filter):
-		_logger.debug('#debug:sending-temp-hum-measurement' + message_filter)
-		self.send(message_filter+'temperature', data['temp'])
-		self.send(message_filter+'external_temperature', data['temp_external'])
-		self.send(message_filter+'humidity', data['humidity'])
-		self.send(message_filter+'battery', data['battery'])
-
-	def send_plug_measurement(self, data, message_filter):
-
-		# check to see if the data is worthy of storing!
-		# in order to scape storing Null values, when Zigbee
-		# is shut down and send just POW=OFF in case of load overload
-		if utilities.check_plug_measurement(data):
-			_logger.debug('#debug:sending-plug=measurement-' + message_filter)
-			self.send(message_filter+'load', data['load'])
-			self.send(message_filter+'work', data['work'])
-			self.send(message_filter+'power', data['pow'])
-			self.send(message_filter+'frequency', data['freq'])
-			self.send(message_filter+'vrms', data['vrms'])
-			self.send(message_filter+'irms', data['irms'])
-		else:
-			# TODO send an email?
-			_logger.error("#error-the-zigbee-device-has-been-turned-off-%s " % data)
+		self._output.disconnect()
 
+	def get_namespace(self):
+		"""
+		:return: namespace.Namespace resolving the devices, the latest one if the file is reloaded
+		"""
+		if self._namespace_file is not None:
+			return self._namespace_file.current
+		return self._namespace
 
-	def send(self, message_filter, data):
+	def send(self, metric, data, ts):
 		"""
-		send a measure to the carbon storage service
-		:param message_filter: hierarchical name of the measurement: eg :i13mon.kitchen.rmpi.power1
+		send a measure to the carbon storage service, the measure is merged with the
+		other measures of its retention time frame and sent when the time frame is complete
+		:param metric: the compiled hierarchical name of the measurement (output.compile_path),
+		eg: i13mon.kitchen.rmpi.power1
 		:param data: the value of that measurement
+		:param ts: (float) the time of the measurement in seconds since the epoch
 		:return:
 		"""
-		# appending a timestamp to the message and send it to carbon
-		msg = "%s %s %d\n" % (message_filter, data, int(time.time()))
-		self._socket.sendall(msg.encode('ascii'))
+		for datapoint in self._aggregator.add(metric, data, ts):
+			self.send_datapoint(*datapoint)
+
+	def send_datapoint(self, metric, data, ts):
+		self._output.add(metric, data, ts)
+
+	def send_completed(self, force=False):
+		"""
+		sends the aggregated measures of the time frames which are complete,
+		the time frames are checked at most once per retention rate unless force is set
+		"""
+		now = time.time()
+		if not force and now < self._next_flush:
+			return
+		self._next_flush = now + self._retention_rate
+		if self._namespace_file is not None:
+			self._namespace_file.check(now)
+		for datapoint in self._aggregator.flush(now, force):
+			self.send_datapoint(*datapoint)
+		self._metrics.set('carbon_buffered', len(self._output))
+		self._metrics.set('carbon_lag', self._reader.lag())
+		self.report_metrics(now)
+
+	def report_metrics(self, now):
+		"""
+		adds the metrics of the pipeline to the datapoints sent to carbon
+		"""
+		if self._registry is None or not self._report_prefix or now < self._next_report:
+			return
+		self._next_report = now + self._report_interval
+		for name, value in self._registry.snapshot().items():
+			if math.isfinite(value):
+				metric = self._report_paths.get(name)
+				if metric is None:
+					metric = output.compile_path('%s.%s' % (self._report_prefix, name))
+					self._report_paths[name] = metric
+				self.send_datapoint(metric, value, int(now))
+
+	def flush_output(self):
+		"""
+		writes the buffered datapoints to carbon
+		"""
+		start = time.monotonic()
+		count = len(self._output)
+		try:
+			self._output.flush()
+		except OSError:
+			self._metrics.incr('carbon_errors')
+			raise
+		self._metrics.incr('carbon_flushes')
+		self._metrics.incr('carbon_datapoints', count)
+		self._metrics.since('carbon_send', start)
 
 	def run(self):
 		while True:
 			try:
-				data = self.queue.get()
-				# _logger.debug("debug:-data-%s" % data)
-
-				# get a general path for the metrics which we want to send
-				message_filter = self.get_message_filter(data)
-				ty = data['type']
-				if ty == 'power_measurement':
-					self.send_power_measurement(data, message_filter)
-					time.sleep(_RETENTION_RATE)
-				elif ty == 'plug_measurement':
-					self.send_plug_measurement(data, message_filter)
-					pass
-				elif ty == 'temp_hum_measurement':
-					self.send_temp_hum_measurement(data, message_filter)
-				else:
-					_logger.warn("#warn:unknown-datatype!-%s" % data)
+				if not self._output.is_connected():
+					if not self._output.reconnect():
+						if self._durable:
+							# the measurements wait in the spool until carbon is back
+							time.sleep(_RECONNECT_INTERVAL)
+						else:
+							# keep buffering, the next reconnect is tried after the next timeout
+							self._drain_without_connection()
+						continue
+
+				self.process_next()
+				if self._output.flush_due():
+					self.flush_output()
+					if self._durable:
+						self._reader.commit()
 			except ConnectionError as e:
 
 				# Connection with the carbon webservice is lost!
+				# the buffered datapoints are sent after reconnecting
 				_logger.error("#error:disconnected-from-carbon-webservice")
 				_logger.exception(e)
-				time.sleep(2)
-				self.connect()
-				self.run()
+				self._output.disconnect()
 			except Exception as e:
 				_logger.error("#error:Unknown-exception-in-carbon-agent")
 				_logger.exception(e)
-				time.sleep(2)
-				self.run()
+
+	def _drain_without_connection(self, duration=_RECONNECT_INTERVAL):
+		"""
+		consumes the bus into the output buffer for duration seconds
+		"""
+		until = time.time() + duration
+		while time.time() < until:
+			self.process_next()
+
+	def process_next(self):
+		"""
+		waits at most one retention rate for the next batch of measurements and sends it
+		"""
+		batch = self._reader.get(timeout=self._retention_rate)
+		if batch is None:
+			self.send_completed()
+			return
+		if self._reader.published is not None:
+			self._metrics.observe('carbon_queue_wait', max(0.0, time.time() - self._reader.published))
+
+		# the datapoints are buffered by the output from here on, carbon
+		# is best effort so the batch is released right away, a durable
+		# reader is committed once the output has been flushed
+		if not self._durable:
+			self._reader.commit()
+		for columns in columnar.columns_of(batch):
+			try:
+				self.send_columns(columns)
+			except ConnectionError:
+				raise
+			except Exception as e:
+				_logger.error("#error:can-not-send-measurements-%s", columns.type_name)
+				_logger.exception(e)
+		self.send_completed()
+
+	def send_columns(self, columns):
+		"""
+		sends the measurements of one type, turned off plugs have been dropped when the batch was built
+		:param columns: util.columnar.TypeColumns
+		"""
+		ty = columns.type_name
+		if ty not in namespace.MEASUREMENTS:
+			_logger.warn("#warn:unknown-datatype!-%s", ty)
+			return
+		names = self.get_namespace()
+		values = columns.values
+		times = columns.times
+		for i, device in enumerate(columns.devices):
+			# the paths of the device, compiled at its first measurement
+			for metric, key in names.metrics(ty, device):
+				self.send(metric, values[key][i], times[i])
@@ -0,0 +1,140 @@
+"""
+The hierarchical names of the devices in carbon, from namespace.csv.
+
+Every line of the file maps a deviceid or mac_address to the prefix of
+the metric paths of the device, e.g. i13mon.smart_kitchen.rfmpi. The
+mapping is compiled per device and measurement type into a list of
+(metric, key in measurement) pairs, a metric being the path together
+with the encoded start of its plaintext line (output.compile_path). So
+sending a measurement takes one lookup and no string building.
+
+NamespaceFile checks the mtime of the file at most every check_interval
+seconds and replaces the whole mapping at once when the file has changed,
+the carbon process keeps running and keeps its buffered datapoints.
+"""
+import logging
+import os
+from carbon_mnger import output
+
+_logger = logging.getLogger(__name__)
+
+DEFAULT_FILENAME = 'namespace.csv'
+DEFAULT_CHECK_INTERVAL = 5.0
+
+# the device key and the (metric name, key in measurement) pairs sent of each measurement type
+MEASUREMENTS = {
+	'power_measurement': ('deviceid', (('power1', 'power1'), ('power2', 'power2'), ('power3', 'power3'),
+									   ('power4', 'power4'), ('vrms', 'vrms'), ('temperature', 'temp'))),
+	'temp_hum_measurement': ('deviceid', (('temperature', 'temp'), ('external_temperature', 'temp_external'),
+										  ('humidity', 'humidity'), ('battery', 'battery'))),
+	'plug_measurement': ('mac_address', (('load', 'load'), ('work', 'work'), ('power', 'pow'),
+										 ('frequency', 'freq'), ('vrms', 'vrms'), ('irms', 'irms'))),
+}
+
+
+def parse_namespace(lines):
+	"""
+	:param lines: the lines of namespace.csv
+	:return: dictionary deviceid/mac_address -> prefix of the metric paths
+	"""
+	names = {}
+	for line in lines:
+		line = line.strip()
+		if not line or line.startswith('#'):
+			continue
+		id_name_pair = line.split(',')
+		if len(id_name_pair) < 2:
+			_logger.warn('#warn:malformed-namespace-line:%s', line)
+			continue
+		names[id_name_pair[0].strip()] = id_name_pair[1].strip()
+	return names
+
+
+def read_namespace(filename=DEFAULT_FILENAME):
+	with open(filename, 'r') as fin:
+		return parse_namespace(fin)
+
+
+class Namespace():
+	"""
+	the compiled mapping of one version of namespace.csv
+	"""
+
+	def __init__(self, names):
+		"""
+		:param names: dictionary deviceid/mac_address -> prefix of the metric paths
+		"""
+		self._names = names
+		# (measurement type, device) -> list of (metric, key in measurement)
+		self._compiled = {}
+
+	def __len__(self):
+		return len(self._names)
+
+	def metrics(self, ty, device):
+		"""
+		:param ty: the type of the measurement
+		:param device: its deviceid or mac_address, as found in the measurement
+		:return: list of (metric, key in measurement), empty for unknown types
+		"""
+		compiled = self._compiled.get((ty, device))
+		if compiled is None:
+			compiled = self._compile(ty, device)
+			self._compiled[(ty, device)] = compiled
+		return compiled
+
+	def _compile(self, ty, device):
+		if ty not in MEASUREMENTS:
+			return []
+		prefix = self._names.get(str(device))
+		if prefix is None:
+			# warned once per device, the compiled fallback is reused; the bare device id is
+			# the prefix as before, e.g. <deviceid>power1
+			_logger.warn('#warn:no-name-exists-for-device:-%s', device)
+			prefix = str(device)
+		return [(output.compile_path(prefix + name), key) for name, key in MEASUREMENTS[ty][1]]
+
+
+class NamespaceFile():
+	"""
+	the Namespace of namespace.csv, reloaded when the file changes
+	"""
+
+	def __init__(self, filename=DEFAULT_FILENAME, check_interval=DEFAULT_CHECK_INTERVAL):
+		"""
+		:param check_interval: (float) seconds between two checks of the mtime, 0 disables reloading
+		"""
+		self._filename = filename
+		self._check_interval = check_interval
+		self._next_check = 0
+		self._stat = self._file_stat()
+		self.current = Namespace(read_namespace(filename))
+
+	def _file_stat(self):
+		st = os.stat(self._filename)
+		return st.st_mtime_ns, st.st_size, st.st_ino
+
+	def check(self, now):
+		"""
+		reloads the file if it has changed, a file which can not be read keeps the current mapping
+		:param now: (float) time.time()
+		:return: True if the mapping has been replaced
+		"""
+		if not self._check_interval or now < self._next_check:
+			return False
+		self._next_check = now + self._check_interval
+		try:
+			stat = self._file_stat()
+			if stat == self._stat:
+				return False
+			names = read_namespace(self._filename)
+			if self._file_stat() != stat:
+				# still being written, read it at the next check
+				return False
+		except (OSError, UnicodeDecodeError) as e:
+			_logger.error('#error:reloading-%s-failed:%s', self._filename, e)
+			return False
+		self._stat = stat
+		self.current = Namespace(names)
+		_logger.info('#info:reloaded-%s-names-from-%s', len(names), self._filename)
+		return True
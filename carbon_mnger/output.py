@@ -0,0 +1,158 @@
+import logging
+import pickle
+import socket
+import struct
+import time
+
+PROTOCOL_PLAINTEXT = 'plaintext'
+PROTOCOL_PICKLE = 'pickle'
+
+# default ports of carbon's line and pickle receivers
+DEFAULT_PORTS = {PROTOCOL_PLAINTEXT: 2003, PROTOCOL_PICKLE: 2004}
+
+DEFAULT_BUFFER_SIZE = 1000
+DEFAULT_FLUSH_INTERVAL = 1.0
+DEFAULT_MAX_BUFFERED = 100000
+DEFAULT_MAX_RETRIES = 5
+DEFAULT_RETRY_DELAY = 2
+
+# carbon refuses pickles bigger than its MAX_PICKLE_SIZE, so
+# large buffers are split into several pickles
+_PICKLE_CHUNK = 500
+_PICKLE_HEADER = struct.Struct('!L')
+
+_logger = logging.getLogger(__name__)
+
+
+def compile_path(path):
+	"""
+	compiles a hierarchical name once, so that its datapoints are encoded without formatting it
+	:param path: hierarchical name of the metric, eg: i13mon.kitchen.rmpi.power1
+	:return: the metric as given to CarbonOutput.add, the name and the encoded start of its plaintext line
+	"""
+	return path, (path + ' ').encode('utf-8')
+
+
+class CarbonOutput():
+	"""
+	buffers datapoints and writes them to carbon in batches,
+	either as plaintext lines or with carbon's pickle protocol
+	the buffer is kept while reconnecting
+	"""
+
+	def __init__(self, host, port, protocol=PROTOCOL_PLAINTEXT, buffer_size=DEFAULT_BUFFER_SIZE,
+				 flush_interval=DEFAULT_FLUSH_INTERVAL, max_buffered=DEFAULT_MAX_BUFFERED,
+				 max_retries=DEFAULT_MAX_RETRIES, retry_delay=DEFAULT_RETRY_DELAY):
+		"""
+		:param buffer_size: (int) number of datapoints which triggers a flush
+		:param flush_interval: (float) seconds after which buffered datapoints are flushed
+		:param max_buffered: (int) the oldest datapoints are dropped beyond this, e.g. while carbon is down
+		:param max_retries: (int) connection attempts per reconnect
+		:param retry_delay: (float) seconds before the first retry, doubled after each failure
+		"""
+		if protocol not in DEFAULT_PORTS:
+			raise ValueError('unknown carbon protocol %s' % protocol)
+		self._host = host
+		self._port = port
+		self._protocol = protocol
+		self._buffer_size = buffer_size
+		self._flush_interval = flush_interval
+		self._max_buffered = max_buffered
+		self._max_retries = max_retries
+		self._retry_delay = retry_delay
+		self._socket = None
+		self._datapoints = []
+		self._first_buffered = None
+
+	def connect(self):
+		self._socket = socket.create_connection((self._host, self._port))
+		_logger.debug('#debug:connected!')
+
+	def disconnect(self):
+		if self._socket is not None:
+			self._socket.close()
+			self._socket = None
+
+	def reconnect(self):
+		"""
+		tries to connect at most max_retries times with an exponential backoff
+		:return: True if the connection is established
+		"""
+		self.disconnect()
+		delay = self._retry_delay
+		for attempt in range(1, self._max_retries + 1):
+			time.sleep(delay)
+			try:
+				self.connect()
+				_logger.info("#info:reconnected-to-carbon-after-%s-attempts" % attempt)
+				return True
+			except OSError as e:
+				_logger.warn("#warn:reconnect-attempt-%s-failed:%s" % (attempt, e))
+				delay *= 2
+		_logger.error("#error:giving-up-reconnecting-%s-datapoints-buffered" % len(self._datapoints))
+		return False
+
+	def is_connected(self):
+		return self._socket is not None
+
+	def add(self, metric, value, ts):
+		"""
+		buffers a datapoint, flushes if the buffer is full
+		:param metric: the metric made by compile_path
+		:param value: the value of the metric
+		:param ts: (int) seconds since the epoch
+		"""
+		if self._first_buffered is None:
+			self._first_buffered = time.time()
+		self._datapoints.append((metric, value, ts))
+		if len(self._datapoints) > self._max_buffered:
+			dropped = len(self._datapoints) - self._max_buffered
+			del self._datapoints[:dropped]
+			_logger.warn("#warn:carbon-buffer-full-dropped-%s-datapoints" % dropped)
+		if len(self._datapoints) >= self._buffer_size and self.is_connected():
+			self.flush()
+
+	def flush_due(self):
+		return self._first_buffered is not None and time.time() - self._first_buffered >= self._flush_interval
+
+	def flush(self):
+		"""
+		writes the buffered datapoints with a single sendall per batch
+		the datapoints stay buffered if the connection fails
+		"""
+		if not self._datapoints:
+			return
+		if self._socket is None:
+			raise ConnectionError('not connected to carbon')
+		try:
+			for payload in self.encode(self._datapoints):
+				self._socket.sendall(payload)
+		except OSError:
+			self.disconnect()
+			raise
+		self._datapoints = []
+		self._first_buffered = None
+
+	def encode(self, datapoints):
+		"""
+		:return: list of bytes to be sent
+		"""
+		if self._protocol == PROTOCOL_PICKLE:
+			payloads = []
+			for i in range(0, len(datapoints), _PICKLE_CHUNK):
+				batch = []
+				for metric, value, ts in datapoints[i:i + _PICKLE_CHUNK]:
+					try:
+						batch.append((metric[0], (int(ts), float(value))))
+					except (TypeError, ValueError):
+						# carbon only stores numbers
+						continue
+				body = pickle.dumps(batch, protocol=2)
+				payloads.append(_PICKLE_HEADER.pack(len(body)) + body)
+			return payloads
+		# the path is encoded already, only the value and the time are formatted
+		return [b''.join([metric[1] + ('%s %d\n' % (value, ts)).encode('ascii')
+						  for metric, value, ts in datapoints])]
+
+	def __len__(self):
+		return len(self._datapoints)
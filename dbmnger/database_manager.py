@@ -1,11 +1,46 @@
+import csv
+import io
 import multiprocessing
 import logging
+import signal
+import time
+import zlib
 import psycopg2
 import psycopg2.extras
+from util import columnar
+from util import metrics
 from util import utilities
 
 _logger = logging.getLogger(__name__)
 
+# the table and the (column, key in measurement) pairs of each measurement type
+_TABLES = {
+    'power_measurement': ('rfmpi', (('id', 'id'), ('deviceid', 'deviceid'), ('ts', 'ts'),
+                                    ('power1', 'power1'), ('power2', 'power2'), ('power3', 'power3'),
+                                    ('power4', 'power4'), ('vrms', 'vrms'), ('temp', 'temp'))),
+    'plug_measurement': ('zigbeeplugs', (('id', 'id'), ('macaddress', 'mac_address'), ('ts', 'ts'),
+                                         ('load', 'load'), ('irms', 'irms'), ('vrms', 'vrms'),
+                                         ('freq', 'freq'), ('pow', 'pow'), ('work', 'work'))),
+    'temp_hum_measurement': ('temphum', (('id', 'id'), ('deviceid', 'deviceid'), ('ts', 'ts'),
+                                         ('temperature', 'temp'), ('externaltemp', 'temp_external'),
+                                         ('humidity', 'humidity'), ('battery', 'battery'))),
+}
+
+# write modes of the DatabaseManager
+MODE_ROW = 'row'
+MODE_VALUES = 'values'
+MODE_COPY = 'copy'
+
+DEFAULT_BATCH_SIZE = 500
+DEFAULT_BATCH_MAX_AGE = 1.0
+
+# batches buffered while flushes fail, before reading from the bus stops
+_MAX_PENDING_BATCHES = 10
+
+# seconds before reconnecting to the database, doubled after each failure up to the maximum
+_RECONNECT_DELAY = 1.0
+_MAX_RECONNECT_DELAY = 30.0
+
 
 def create_connection(dbname, user, password, host, port):
     """
@@ -14,17 +49,115 @@ def create_connection(dbname, user, password, host, port):
     """
     return psycopg2.connect(dbname=dbname, user=user, host=host, port=port, password=password)
 
+
+def shard_of(device, shards):
+    """
+    :param device: the deviceid or mac_address of a measurement
+    :param shards: (int) number of writers
+    :return: (int) the writer of the device, the same in every process
+    """
+    return zlib.crc32(str(device).encode()) % shards
+
+
+class TableBuffer():
+    """
+    the rows of one table waiting to be written in the next flush
+    """
+
+    def __init__(self, table, columns):
+        self.table = table
+        self.columns = [column for column, _ in columns]
+        self._keys = [key for _, key in columns]
+        self.rows = []
+
+    def extend(self, columns):
+        """
+        :param columns: util.columnar.TypeColumns of the measurements of the table
+        """
+        self.rows.extend(columns.rows(self._keys))
+
+    def column_list(self):
+        return ', '.join(self.columns)
+
+    def insert_statement(self):
+        return 'INSERT INTO %s (%s) VALUES (%s);' % (self.table, self.column_list(),
+                                                    ', '.join(['%s'] * len(self.columns)))
+
+    def copy_file(self):
+        """
+        :return: the rows as a csv file for COPY FROM STDIN, None is written as NULL
+        """
+        f = io.StringIO()
+        writer = csv.writer(f)
+        for row in self.rows:
+            writer.writerow(['' if value is None else str(value) for value in row])
+        f.seek(0)
+        return f
+
+
 class DatabaseManager(multiprocessing.Process):
     """
     The Class responsible for storing received measurements into
     Postgres Database
+    in row mode every measurement is inserted and committed on its own,
+    in values and copy mode measurements are buffered per table and
+    flushed with multi-row inserts or COPY in a single transaction
+    with several writers every one reads the whole bus with a cursor of
+    its own and writes the devices of its shard, so the rows of a device
+    are written in order by one connection
     """
-    def __init__(self, queue, db_connection):
-        multiprocessing.Process.__init__(self, daemon=True)
-        self._queue = queue
+    def __init__(self, reader, db_connection, mode=MODE_ROW, batch_size=DEFAULT_BATCH_SIZE,
+                 batch_max_age=DEFAULT_BATCH_MAX_AGE, process_metrics=None, partitions=None, rollups=None,
+                 shard=0, shards=1, connect=None, stats_interval=0):
+        """
+        :param reader: util.bus.BusReader delivering batches of measurements
+        :param db_connection: psycopg2 connection
+        :param mode: row, values or copy
+        :param batch_size: (int) measurements which trigger a flush in values and copy mode
+        :param batch_max_age: (float) seconds after which a batch is flushed in values and copy mode
+        :param process_metrics: util.metrics.ProcessMetrics of this process
+        :param partitions: dbmnger.partitions.PartitionManager of the time partitioned tables,
+        None if the tables are not partitioned
+        :param rollups: dbmnger.rollups.RollupWriter updating the rollups in the transaction of the rows,
+        None to write the raw rows only
+        :param shard: (int) the shard of this writer, below shards
+        :param shards: (int) number of writers sharing the measurements by device
+        :param connect: callable returning a new psycopg2 connection, used after the connection is lost,
+        None keeps retrying on db_connection
+        :param stats_interval: (float) seconds between two logs of the rows written and the lag, 0 disables them
+        """
+        multiprocessing.Process.__init__(self, daemon=True, name='database-writer-%s' % shard)
+        self._reader = reader
         self._db_connection = db_connection
+        self._mode = mode
+        self._batch_size = batch_size
+        self._batch_max_age = batch_max_age
+        self._stop_event = multiprocessing.Event()
+        self._terminated = False
+        self._buffers = {}
+        self._pending = 0
+        self._oldest = None
+        self._metrics = process_metrics if process_metrics is not None else metrics.local()
+        self._partitions = partitions
+        self._rollups = rollups
+        self._shard = shard
+        self._shards = shards
+        # device -> shard, computed once per device
+        self._device_shards = {}
+        self._connect = connect
+        self._reconnect_delay = _RECONNECT_DELAY
+        self._next_connect = 0
+        self._stats_interval = stats_interval
+        self._next_report = None
+        self._last_report = (0, 0)
         psycopg2.extras.register_uuid()
 
+    def stop(self):
+        """
+        asks the process to flush the buffered measurements and exit
+        """
+        self._stop_event.set()
+
     def insert(self,data):
         """
         insert the data into related table of the Postgress Database
@@ -55,6 +188,7 @@ class DatabaseManager(multiprocessing.Process):
                 'INSERT INTO rfmpi(id, deviceid, ts, power1, power2, power3, power4, vrms, temp)' +
                 'VALUES(%(id)s, %(deviceid)s, %(ts)s, %(power1)s, %(power2)s, %(power3)s, %(power4)s,' +
                  '%(vrms)s, %(temp)s);', data)
+            self.write_measurement_rollups(cursor, 'power_measurement', data)
         self._db_connection.commit()
 
     def insert_plug_measurement(self, data):
@@ -63,6 +197,7 @@ class DatabaseManager(multiprocessing.Process):
                 'INSERT INTO zigbeeplugs(id, macaddress, ts, load, irms, vrms, freq, pow, work)' +
                 'VALUES (%(id)s, %(mac_address)s, %(ts)s, %(load)s, %(irms)s, %(vrms)s, %(freq)s,' +
                 ' %(pow)s, %(work)s);', data)
+            self.write_measurement_rollups(cursor, 'plug_measurement', data)
         self._db_connection.commit()
 
     def insert_temp_hum_measurement(self, data):
@@ -71,24 +206,342 @@ class DatabaseManager(multiprocessing.Process):
                 'INSERT INTO temphum(id, deviceid, ts, temperature, externaltemp, humidity, battery)' +
                 ' VALUES (%(id)s, %(deviceid)s, %(ts)s, %(temp)s, %(temp_external)s, %(humidity)s, ' +
                 '%(battery)s);', data)
+            self.write_measurement_rollups(cursor, 'temp_hum_measurement', data)
+        self._db_connection.commit()
+
+    def write_measurement_rollups(self, cursor, ty, data):
+        if self._rollups is None:
+            return
+        table, columns = _TABLES[ty]
+        self.write_rollups(cursor, [(table, [column for column, _ in columns],
+                                     [tuple(data[key] for _, key in columns)])])
+
+    def write_rollups(self, cursor, tables):
+        """
+        upserts the rollups of the rows written in the current transaction
+        a failing upsert is rolled back on its own, so that the rows are still written
+        :param tables: list of (table, columns, rows)
+        """
+        if self._rollups is None:
+            return
+        cursor.execute('SAVEPOINT rollups;')
+        try:
+            self._rollups.write(cursor, tables)
+        except (psycopg2.IntegrityError, psycopg2.DataError, psycopg2.ProgrammingError,
+                TypeError, ValueError) as e:
+            _logger.error("#error:updating-rollups-failed-backfill-them-later")
+            _logger.exception(e)
+            self._metrics.incr('db_errors')
+            cursor.execute('ROLLBACK TO SAVEPOINT rollups;')
+        else:
+            cursor.execute('RELEASE SAVEPOINT rollups;')
+
+    def buffer(self, columns):
+        """
+        adds the measurements of one type to the buffer of its table
+        :param columns: util.columnar.TypeColumns, validated when the batch was built
+        """
+        ty = columns.type_name
+        if ty not in _TABLES:
+            _logger.warn("#warn:unknown-data")
+            return
+        if self._shards > 1:
+            columns = columns.select([self.in_shard(device) for device in columns.devices])
+        if not len(columns):
+            return
+
+        table_buffer = self._buffers.get(ty)
+        if table_buffer is None:
+            table, table_columns = _TABLES[ty]
+            table_buffer = TableBuffer(table, table_columns)
+            self._buffers[ty] = table_buffer
+        table_buffer.extend(columns)
+
+        if self._oldest is None:
+            self._oldest = time.time()
+        self._pending += len(columns)
+
+    def flush_due(self):
+        if self._pending >= self._batch_size:
+            return True
+        return self._oldest is not None and time.time() - self._oldest >= self._batch_max_age
+
+    def flush(self, final=False):
+        """
+        writes all buffered measurements in one transaction
+        if a duplicate key is hit, the batch is written again row by row
+        so that only the duplicated rows are lost
+        if the database is unreachable the measurements stay buffered and
+        uncommitted on the bus, the flush is retried after batch_max_age
+        :param final: commit the position on the bus right away
+        """
+        buffers = [b for b in self._buffers.values() if b.rows]
+        if not buffers:
+            return
+        if not self.ensure_connection():
+            # still down, the measurements stay buffered
+            self._oldest = time.time()
+            return
+        start = time.monotonic()
+        try:
+            with self._db_connection.cursor() as cursor:
+                for table_buffer in buffers:
+                    self.write_buffer(cursor, table_buffer)
+                self.write_rollups(cursor, [(b.table, b.columns, b.rows) for b in buffers])
+            self._db_connection.commit()
+            _logger.debug("#debug:flushed-%s-measurements", self._pending)
+        except (psycopg2.IntegrityError, psycopg2.DataError) as e:
+            _logger.warn("#warn:duplicate-or-invalid-tuple-in-batch!-falling-back-to-row-inserts")
+            self._rollback()
+            try:
+                self.write_rows(buffers)
+            except (psycopg2.OperationalError, psycopg2.InterfaceError) as e:
+                self._flush_failed(e)
+                return
+        except (psycopg2.OperationalError, psycopg2.InterfaceError) as e:
+            self._flush_failed(e)
+            return
+        except Exception as e:
+            # nothing has been written, the measurements stay buffered and are not
+            # committed on the reader, the next flush tries them again
+            _logger.error("#error:flushing-%s-measurements-failed" % self._pending)
+            _logger.exception(e)
+            self._metrics.incr('db_errors')
+            self._rollback()
+            self._oldest = time.time()
+            self._metrics.set('db_pending', self._pending)
+            return
+        else:
+            self._metrics.incr('db_flushes')
+            self._metrics.incr('db_rows', self._pending)
+            self._metrics.since('db_flush', start)
+
+        for table_buffer in buffers:
+            table_buffer.rows = []
+        self._pending = 0
+        self._oldest = None
+        self._reader.commit(force=final)
+        self._metrics.set('db_pending', 0)
+        self._metrics.set('storage_lag', self._reader.lag())
+
+    def _flush_failed(self, e):
+        _logger.error("#error:database-unreachable-keeping-%s-measurements" % self._pending)
+        _logger.exception(e)
+        self._metrics.incr('db_errors')
+        self._rollback()
+        self._oldest = time.time()
+        self._metrics.set('db_pending', self._pending)
+        self._metrics.set('storage_lag', self._reader.lag())
+
+    def _rollback(self):
+        if self._db_connection.closed:
+            return
+        try:
+            self._db_connection.rollback()
+        except psycopg2.Error as e:
+            _logger.exception(e)
+
+    def ensure_connection(self):
+        """
+        opens a new connection if the current one has been closed, at most once per reconnect delay
+        :return: True if the connection is open
+        """
+        if not self._db_connection.closed:
+            return True
+        if self._connect is None or time.time() < self._next_connect:
+            return False
+        try:
+            self._db_connection = self._connect()
+        except psycopg2.Error as e:
+            _logger.error("#error:writer-%s-reconnecting-to-the-database-failed:%s", self._shard, e)
+            self._next_connect = time.time() + self._reconnect_delay
+            self._reconnect_delay = min(self._reconnect_delay * 2, _MAX_RECONNECT_DELAY)
+            return False
+        _logger.info("#info:writer-%s-reconnected-to-the-database", self._shard)
+        self._reconnect_delay = _RECONNECT_DELAY
+        if self._partitions is not None:
+            self._partitions.use_connection(self._db_connection)
+        return True
+
+    def wait_connection(self):
+        """
+        blocks until the connection is open again or the process is asked to stop
+        :return: True if the connection is open
+        """
+        while not self.ensure_connection():
+            if self.stopping():
+                return False
+            time.sleep(max(self._next_connect - time.time(), self._batch_max_age))
+        return True
+
+    def stopping(self):
+        return self._terminated or self._stop_event.is_set()
+
+    def in_shard(self, device):
+        if self._shards == 1:
+            return True
+        shard = self._device_shards.get(device)
+        if shard is None:
+            shard = self._device_shards[device] = shard_of(device, self._shards)
+        return shard == self._shard
+
+    def report_stats(self):
+        """
+        logs the rows written by this writer and its lag once per stats interval
+        """
+        now = time.time()
+        if not self._stats_interval or (self._next_report is not None and now < self._next_report):
+            return
+        rows = self._metrics.get('db_rows')
+        last_rows, last_time = self._last_report
+        if self._next_report is not None:
+            _logger.info("#info:writer-%s-stats:rows:%d:rows/s:%.1f:pending:%d:lag:%d",
+                         self._shard, rows, (rows - last_rows) / (now - last_time), self._pending,
+                         self._reader.lag())
+        self._last_report = (rows, now)
+        self._next_report = now + self._stats_interval
+
+    def write_buffer(self, cursor, table_buffer):
+        if self._mode == MODE_COPY:
+            cursor.copy_expert('COPY %s (%s) FROM STDIN WITH (FORMAT csv)' %
+                               (table_buffer.table, table_buffer.column_list()), table_buffer.copy_file())
+        else:
+            psycopg2.extras.execute_values(
+                cursor, 'INSERT INTO %s (%s) VALUES %%s' % (table_buffer.table, table_buffer.column_list()),
+                table_buffer.rows, page_size=len(table_buffer.rows))
+
+    def write_rows(self, buffers):
+        """
+        inserts the rows one by one, each inside its own savepoint,
+        and commits them in a single transaction with the rollups of the inserted rows
+        """
+        with self._db_connection.cursor() as cursor:
+            written = []
+            for table_buffer in buffers:
+                statement = table_buffer.insert_statement()
+                inserted = []
+                written.append((table_buffer.table, table_buffer.columns, inserted))
+                for row in table_buffer.rows:
+                    cursor.execute('SAVEPOINT row_insert;')
+                    try:
+                        cursor.execute(statement, row)
+                    except (psycopg2.IntegrityError, psycopg2.DataError):
+                        _logger.warn("#warn:duplicate-or-invalid-tuple-insertion!-%s", row[0])
+                        cursor.execute('ROLLBACK TO SAVEPOINT row_insert;')
+                    else:
+                        cursor.execute('RELEASE SAVEPOINT row_insert;')
+                        inserted.append(row)
+            self.write_rollups(cursor, written)
         self._db_connection.commit()
 
     def run(self):
         """
         runs the DatabaseManager process
         """
-        while True:
+        # the parent terminates daemon processes with SIGTERM, flush what is buffered before leaving;
+        # a ctrl-c reaches the whole process group, the parent stops the writer with stop()
+        # once the server is down, so the measurements buffered meanwhile are flushed as well
+        signal.signal(signal.SIGTERM, self._handle_sigterm)
+        signal.signal(signal.SIGINT, signal.SIG_IGN)
+        self.maintain_partitions()
+        if self._mode == MODE_ROW:
+            self.run_rows()
+        else:
+            self.run_batches()
+
+    def run_rows(self):
+        while not self.stopping():
+            batch = self._reader.get(timeout=self._batch_max_age)
+            if batch is None:
+                self.report_stats()
+                continue
+            self.maintain_partitions()
+            self.received(batch)
+            for data in self.measurements(batch):
+                while True:
+                    try:
+                        # _logger.debug("debug:-data-%s" % data)
+                        self.insert(data)
+                        self._metrics.incr('db_rows')
+                    except psycopg2.IntegrityError as e:
+                        _logger.warn("#warn:duplicate-tuple-insertion!")
+                        _logger.exception(e)
+                        self._rollback()
+                    except (psycopg2.OperationalError, psycopg2.InterfaceError) as e:
+                        # the measurement is inserted again on the new connection
+                        _logger.error("#error:database-unreachable")
+                        _logger.exception(e)
+                        self._metrics.incr('db_errors')
+                        self._rollback()
+                        if self._db_connection.closed:
+                            if not self.wait_connection():
+                                # stopping, the batch is not committed on the reader
+                                _logger.info("#info:database-manager-stopped")
+                                return
+                            continue
+                    except Exception as e:
+                        self._rollback()
+                        _logger.exception(e)
+                    break
+            self._reader.commit()
+            self._metrics.set('storage_lag', self._reader.lag())
+            self.report_stats()
+        _logger.info("#info:database-manager-stopped")
+
+    def measurements(self, batch):
+        """
+        :param batch: a batch read from the bus
+        :return: the measurements of the shard of this writer as dictionaries
+        """
+        return [data for columns in columnar.columns_of(batch) for data in columns.measurements()
+                if self.in_shard(data[columns.device_key])]
+
+    def maintain_partitions(self):
+        """
+        creates upcoming and expires old partitions once per maintenance interval,
+        called between two flushes while no transaction is open
+        """
+        now = time.time()
+        if self._partitions is not None and not self._db_connection.closed and self._partitions.due(now):
             try:
-                data = self._queue.get()
-                # _logger.debug("debug:-data-%s" % data)
-                self.insert(data)
-            except psycopg2.IntegrityError as e:
-                _logger.warn("#warn:duplicate-tuple-insertion!")
+                self._partitions.maintain(now)
+            except Exception as e:
+                # the writer goes on, the partitions are maintained again after the next flush
                 _logger.exception(e)
-                self._db_connection.rollback()
-                self.run()
+
+    def received(self, batch):
+        # the batch has been published in another process, compare wall clock times
+        if self._reader.published is not None:
+            self._metrics.observe('storage_queue_wait', max(0.0, time.time() - self._reader.published))
+
+    def _handle_sigterm(self, signum, frame):
+        self._terminated = True
+
+    def run_batches(self):
+        while not self.stopping():
+            timeout = self._batch_max_age
+            if self._oldest is not None:
+                timeout = max(0, self._oldest + self._batch_max_age - time.time())
+            if self._pending >= self._batch_size * _MAX_PENDING_BATCHES:
+                # the database does not keep up or is down, leave the rest on the bus
+                time.sleep(timeout)
+                self.flush()
+                continue
+            try:
+                batch = self._reader.get(timeout=timeout)
+                if batch is not None:
+                    self.received(batch)
+                    for columns in columnar.columns_of(batch):
+                        self.buffer(columns)
+                    self._metrics.set('db_pending', self._pending)
+                if self.flush_due():
+                    self.flush()
+                    self.maintain_partitions()
             except Exception as e:
-                self._db_connection.rollback()
                 _logger.exception(e)
 
+            self.report_stats()
 
+        # final flush on shutdown
+        self.flush(final=True)
+        _logger.info("#info:database-manager-stopped")
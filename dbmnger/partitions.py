@@ -0,0 +1,169 @@
+"""
+Creation and retention of the time partitions of the measurement tables
+(sql/003_partition_by_time.sql).
+
+A partition covers a day or a week (from monday on) in UTC and is named
+after its parent and its first day, e.g. rfmpi_p20261019. Partitions are
+created from the oldest one within the retention up to premake intervals
+ahead, so measurements arriving late (a spool backlog, retransmits after an
+outage, a skewed clock) have a partition. Partitions ending before the
+retention are detached (kept as plain tables) or dropped.
+"""
+import datetime
+import logging
+import re
+import psycopg2
+
+_logger = logging.getLogger(__name__)
+
+INTERVAL_DAY = 'day'
+INTERVAL_WEEK = 'week'
+_INTERVALS = {INTERVAL_DAY: datetime.timedelta(days=1), INTERVAL_WEEK: datetime.timedelta(days=7)}
+
+RETENTION_DETACH = 'detach'
+RETENTION_DROP = 'drop'
+
+DEFAULT_TABLES = ('rfmpi', 'zigbeeplugs', 'temphum')
+DEFAULT_PREMAKE = 7
+DEFAULT_RETENTION_DAYS = 365
+DEFAULT_MAINTENANCE_INTERVAL = 3600
+
+_NAME_FORMAT = '%Y%m%d'
+_PARTITION = re.compile(r'^(?P<parent>\w+)_p(?P<start>\d{8})$')
+
+_LIST_PARTITIONS = """
+SELECT child.relname FROM pg_inherits
+JOIN pg_class parent ON parent.oid = pg_inherits.inhparent
+JOIN pg_class child ON child.oid = pg_inherits.inhrelid
+WHERE parent.relname = %s
+"""
+
+
+class PartitionManager():
+    """
+    keeps the partitions of the measurement tables in line with the calendar
+    """
+
+    def __init__(self, db_connection, tables=DEFAULT_TABLES, interval=INTERVAL_DAY, premake=DEFAULT_PREMAKE,
+                 retention_days=DEFAULT_RETENTION_DAYS, retention=RETENTION_DETACH,
+                 maintenance_interval=DEFAULT_MAINTENANCE_INTERVAL):
+        """
+        :param db_connection: psycopg2 connection
+        :param tables: the partitioned tables
+        :param interval: day or week, the time range of a partition
+        :param premake: (int) partitions created ahead of the current one
+        :param retention_days: (int) partitions ending longer ago are expired, 0 keeps everything
+        :param retention: detach or drop expired partitions
+        :param maintenance_interval: (float) seconds between two runs of maintain when due is used
+        """
+        if interval not in _INTERVALS:
+            raise ValueError('unknown partition interval %s' % interval)
+        if retention not in (RETENTION_DETACH, RETENTION_DROP):
+            raise ValueError('unknown retention %s' % retention)
+        self._db_connection = db_connection
+        self._tables = tables
+        self._interval = interval
+        self._premake = premake
+        self._retention_days = retention_days
+        self._retention = retention
+        self._maintenance_interval = maintenance_interval
+        self._next_maintenance = None
+
+    def use_connection(self, db_connection):
+        """
+        :param db_connection: psycopg2 connection replacing a lost one
+        """
+        self._db_connection = db_connection
+
+    def start_of(self, ts):
+        """
+        :return: (datetime.date) the first day of the partition holding ts
+        """
+        day = ts.date() if isinstance(ts, datetime.datetime) else ts
+        if self._interval == INTERVAL_WEEK:
+            day -= datetime.timedelta(days=day.weekday())
+        return day
+
+    def partition_name(self, table, start):
+        return '%s_p%s' % (table, start.strftime(_NAME_FORMAT))
+
+    def create_statement(self, table, start):
+        end = start + _INTERVALS[self._interval]
+        return ("CREATE TABLE IF NOT EXISTS %s PARTITION OF %s FOR VALUES FROM ('%s 00:00:00+00') TO ('%s 00:00:00+00');" %
+                (self.partition_name(table, start), table, start.isoformat(), end.isoformat()))
+
+    def due(self, now):
+        """
+        :param now: (float) time.time()
+        :return: True if maintain should run
+        """
+        return self._next_maintenance is None or now >= self._next_maintenance
+
+    def maintain(self, now):
+        """
+        creates the upcoming partitions and expires the old ones, each table in its own transaction
+        :param now: (float) time.time()
+        """
+        self._next_maintenance = now + self._maintenance_interval
+        today = datetime.datetime.utcfromtimestamp(now)
+        for table in self._tables:
+            try:
+                with self._db_connection.cursor() as cursor:
+                    self.create_partitions(cursor, table, today)
+                    self.expire_partitions(cursor, table, today)
+                self._db_connection.commit()
+            except psycopg2.Error as e:
+                _logger.error("#error:maintaining-partitions-of-%s-failed" % table)
+                _logger.exception(e)
+                if self._db_connection.closed:
+                    # the DatabaseManager reconnects, the next run is due at once
+                    self._next_maintenance = None
+                    return
+                try:
+                    self._db_connection.rollback()
+                except psycopg2.Error as e:
+                    _logger.exception(e)
+
+    def list_partitions(self, cursor, table):
+        """
+        :return: the names of the partitions of table
+        """
+        cursor.execute(_LIST_PARTITIONS, (table,))
+        return [name for (name,) in cursor.fetchall()]
+
+    def create_partitions(self, cursor, table, today):
+        """
+        creates the missing partitions from the oldest one within the retention, or within
+        DEFAULT_RETENTION_DAYS if everything is kept, up to premake intervals ahead
+        """
+        interval = _INTERVALS[self._interval]
+        oldest = today.date() - datetime.timedelta(days=self._retention_days or DEFAULT_RETENTION_DAYS)
+        start = self.start_of(oldest)
+        if start + interval <= oldest:
+            # expired already
+            start += interval
+        last = self.start_of(today) + interval * self._premake
+        existing = set(self.list_partitions(cursor, table))
+        while start <= last:
+            if self.partition_name(table, start) not in existing:
+                cursor.execute(self.create_statement(table, start))
+            start += interval
+
+    def expire_partitions(self, cursor, table, today):
+        if not self._retention_days:
+            return
+        oldest = today.date() - datetime.timedelta(days=self._retention_days)
+        for name in self.list_partitions(cursor, table):
+            match = _PARTITION.match(name)
+            if match is None or match.group('parent') != table:
+                # not made by the PartitionManager
+                continue
+            start = datetime.datetime.strptime(match.group('start'), _NAME_FORMAT).date()
+            if start + _INTERVALS[self._interval] > oldest:
+                continue
+            if self._retention == RETENTION_DROP:
+                cursor.execute('DROP TABLE %s;' % name)
+                _logger.info("#info:dropped-expired-partition-%s" % name)
+            else:
+                cursor.execute('ALTER TABLE %s DETACH PARTITION %s;' % (table, name))
+                _logger.info("#info:detached-expired-partition-%s" % name)
@@ -0,0 +1,250 @@
+"""
+Per device minute and hour rollups of the measurements (sql/004_rollups.sql).
+
+The DatabaseManager aggregates the rows of every batch it writes by device,
+metric and bucket and upserts the aggregates in the transaction of the
+batch, merging them into the rows already there. backfill rebuilds the
+rollups of a time range from the raw tables, e.g. after the rollup tables
+were created or data was written while they were disabled:
+
+    python -m dbmnger.rollups --from 2026-10-01 --to 2026-10-18
+
+The timestamps of the rows are normalized with utilities.to_timestamp,
+so strings, naive (local time) and aware datetimes can be mixed in a batch.
+Buckets are truncated in the local time zone of the writer, the database
+session should use the same one for backfill to build the same buckets.
+"""
+import argparse
+import datetime
+import logging
+import psycopg2
+import psycopg2.extras
+from dbmnger import database_manager
+from util import cfg
+from util import utilities
+
+_logger = logging.getLogger(__name__)
+
+GRANULARITY_MINUTE = 'minute'
+GRANULARITY_HOUR = 'hour'
+GRANULARITIES = (GRANULARITY_MINUTE, GRANULARITY_HOUR)
+_STEPS = {GRANULARITY_MINUTE: datetime.timedelta(minutes=1), GRANULARITY_HOUR: datetime.timedelta(hours=1)}
+
+# the raw tables with their device column and the numeric columns rolled up
+_SOURCES = {
+    'rfmpi': ('deviceid', ('power1', 'power2', 'power3', 'power4', 'vrms', 'temp')),
+    'zigbeeplugs': ('macaddress', ('load', 'irms', 'vrms', 'freq', 'work')),
+    'temphum': ('deviceid', ('temperature', 'externaltemp', 'humidity', 'battery')),
+}
+
+# the aggregates of a bucket, merged with those already stored
+_UPSERT = """
+INSERT INTO rollup_{granularity} AS r (device, metric, bucket, count, sum, min, max, last, last_ts) VALUES %s
+ON CONFLICT (device, metric, bucket) DO UPDATE SET
+  count = r.count + EXCLUDED.count,
+  sum = r.sum + EXCLUDED.sum,
+  min = LEAST(r.min, EXCLUDED.min),
+  max = GREATEST(r.max, EXCLUDED.max),
+  last = CASE WHEN EXCLUDED.last_ts >= r.last_ts THEN EXCLUDED.last ELSE r.last END,
+  last_ts = GREATEST(r.last_ts, EXCLUDED.last_ts)
+"""
+
+# the writer waits for the backfill, so no batch is counted twice or missed
+_LOCK = 'LOCK TABLE rollup_minute, rollup_hour IN SHARE ROW EXCLUSIVE MODE;'
+
+_DELETE = 'DELETE FROM rollup_{granularity} WHERE bucket >= %(start)s AND bucket < %(end)s;'
+
+_BACKFILL = """
+INSERT INTO rollup_{granularity} (device, metric, bucket, count, sum, min, max, last, last_ts)
+SELECT device, metric, date_trunc('{granularity}', ts) AS bucket, count(*), sum(value), min(value), max(value),
+       (array_agg(value ORDER BY ts DESC))[1], max(ts)
+FROM (SELECT {device}::text AS device, ts, m.metric, m.value
+      FROM {table} CROSS JOIN LATERAL (VALUES {metrics}) AS m(metric, value)
+      WHERE ts >= %(start)s AND ts < %(end)s) AS raw
+WHERE value IS NOT NULL
+GROUP BY device, metric, bucket
+"""
+
+
+def truncate(ts, granularity):
+    """
+    :return: (datetime.datetime) the start of the bucket of granularity holding ts
+    """
+    if granularity == GRANULARITY_HOUR:
+        return ts.replace(minute=0, second=0, microsecond=0)
+    return ts.replace(second=0, microsecond=0)
+
+
+def local_time(ts):
+    """
+    :param ts: the ts of a row, in any form accepted by utilities.to_timestamp
+    :return: (datetime.datetime) ts as an aware datetime in the local time zone
+    """
+    return datetime.datetime.fromtimestamp(utilities.to_timestamp(ts), datetime.timezone.utc).astimezone()
+
+
+def _merge(rollup, count, total, minimum, maximum, last, last_ts):
+    rollup[0] += count
+    rollup[1] += total
+    if minimum < rollup[2]:
+        rollup[2] = minimum
+    if maximum > rollup[3]:
+        rollup[3] = maximum
+    if last_ts >= rollup[5]:
+        rollup[4] = last
+        rollup[5] = last_ts
+
+
+def aggregate(tables):
+    """
+    :param tables: iterable of (table, columns, rows) of the rows written
+    :return: dict (device, metric, minute) -> [count, sum, min, max, last, last_ts]
+    """
+    rollups = {}
+    for table, columns, rows in tables:
+        source = _SOURCES.get(table)
+        if source is None or not rows:
+            continue
+        device_column, metrics = source
+        device_index = columns.index(device_column)
+        ts_index = columns.index('ts')
+        indexes = [(metric, columns.index(metric)) for metric in metrics if metric in columns]
+        for row in rows:
+            if row[ts_index] is None:
+                # stored without a time, it has no bucket
+                continue
+            ts = local_time(row[ts_index])
+            device = str(row[device_index])
+            bucket = truncate(ts, GRANULARITY_MINUTE)
+            for metric, index in indexes:
+                value = row[index]
+                if value is None:
+                    continue
+                value = float(value)
+                key = (device, metric, bucket)
+                rollup = rollups.get(key)
+                if rollup is None:
+                    rollups[key] = [1, value, value, value, value, ts]
+                else:
+                    _merge(rollup, 1, value, value, value, value, ts)
+    return rollups
+
+
+def coarsen(rollups, granularity):
+    """
+    :param rollups: the minute rollups made by aggregate
+    :return: the rollups merged into buckets of granularity
+    """
+    if granularity == GRANULARITY_MINUTE:
+        return rollups
+    coarse = {}
+    for (device, metric, bucket), rollup in rollups.items():
+        key = (device, metric, truncate(bucket, granularity))
+        existing = coarse.get(key)
+        if existing is None:
+            coarse[key] = list(rollup)
+        else:
+            _merge(existing, *rollup)
+    return coarse
+
+
+class RollupWriter():
+    """
+    updates the rollups from the rows written by the DatabaseManager
+    """
+
+    def __init__(self, granularities=GRANULARITIES):
+        """
+        :param granularities: the rollup tables kept up to date, minute and/or hour
+        """
+        for granularity in granularities:
+            if granularity not in GRANULARITIES:
+                raise ValueError('unknown rollup granularity %s' % granularity)
+        self._granularities = tuple(granularities)
+
+    def write(self, cursor, tables):
+        """
+        upserts the aggregates of the rows, inside the transaction which writes them
+        :param cursor: psycopg2 cursor of the transaction
+        :param tables: iterable of (table, columns, rows) of the rows written
+        :return: (int) number of minute buckets updated
+        """
+        minutes = aggregate(tables)
+        if not minutes:
+            return 0
+        for granularity in self._granularities:
+            # sorted, so concurrent writers lock the rows in the same order
+            values = [key + tuple(rollup) for key, rollup in sorted(coarsen(minutes, granularity).items())]
+            psycopg2.extras.execute_values(cursor, _UPSERT.format(granularity=granularity), values,
+                                           page_size=len(values))
+        return len(minutes)
+
+
+def backfill_statement(table, granularity):
+    device, metrics = _SOURCES[table]
+    return _BACKFILL.format(granularity=granularity, device=device, table=table,
+                            metrics=', '.join("('%s', %s::double precision)" % (metric, metric) for metric in metrics))
+
+
+def backfill(db_connection, start, end, granularities=GRANULARITIES):
+    """
+    rebuilds the rollups from start to end from the raw tables in one transaction,
+    start and end are widened to whole buckets of the coarsest granularity
+    the DatabaseManager waits while the rollup tables are locked
+    :param db_connection: psycopg2 connection
+    :param start: (datetime.datetime) first time rebuilt
+    :param end: (datetime.datetime) time after the last time rebuilt
+    :return: (int) number of rollup rows written
+    """
+    coarsest = GRANULARITY_HOUR if GRANULARITY_HOUR in granularities else GRANULARITY_MINUTE
+    start = truncate(start, coarsest)
+    if truncate(end, coarsest) != end:
+        end = truncate(end, coarsest) + _STEPS[coarsest]
+    bounds = {'start': start, 'end': end}
+    written = 0
+    try:
+        with db_connection.cursor() as cursor:
+            cursor.execute(_LOCK)
+            for granularity in granularities:
+                cursor.execute(_DELETE.format(granularity=granularity), bounds)
+                for table in sorted(_SOURCES):
+                    cursor.execute(backfill_statement(table, granularity), bounds)
+                    written += cursor.rowcount
+        db_connection.commit()
+    except psycopg2.Error:
+        db_connection.rollback()
+        raise
+    _logger.info("#info:backfilled-%s-rollups-from-%s-to-%s", written, start, end)
+    return written
+
+
+def _parse_time(value):
+    for time_format in ('%Y-%m-%d %H:%M:%S', '%Y-%m-%d %H:%M', '%Y-%m-%dT%H:%M:%S', '%Y-%m-%dT%H:%M', '%Y-%m-%d'):
+        try:
+            return datetime.datetime.strptime(value, time_format)
+        except ValueError:
+            pass
+    raise argparse.ArgumentTypeError('not a date or time: %s' % value)
+
+
+def main(args):
+    dbcfg = cfg.get_db_config()
+    db_connection = database_manager.create_connection(dbcfg['dbname'], dbcfg['user'], dbcfg['password'],
+                                                       dbcfg['host'], dbcfg['port'])
+    try:
+        written = backfill(db_connection, args.start, args.end or datetime.datetime.now(),
+                           granularities=args.granularity or GRANULARITIES)
+    finally:
+        db_connection.close()
+    print('%s rollup rows written' % written)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='rebuilds the rollups of a time range from the raw tables')
+    parser.add_argument('--from', dest='start', type=_parse_time, required=True,
+                        help='first time rebuilt, YYYY-MM-DD[ HH:MM[:SS]] in the time zone of the database')
+    parser.add_argument('--to', dest='end', type=_parse_time, help='end of the range, defaults to now')
+    parser.add_argument('--granularity', action='append', choices=GRANULARITIES,
+                        help='rollup table rebuilt, may be repeated, defaults to all')
+    logging.basicConfig(level=logging.INFO)
+    main(parser.parse_args())
@@ -0,0 +1,98 @@
+import asyncio
+import logging
+from util import metrics
+
+_logger = logging.getLogger(__name__)
+
+DEFAULT_HIGH_WATERMARK = 48 * 1024 * 1024
+DEFAULT_LOW_WATERMARK = 16 * 1024 * 1024
+DEFAULT_ACK_WINDOW = 64
+DEFAULT_CHECK_INTERVAL = 0.05
+
+
+class FlowControl():
+    """
+    throttles the clients when the sinks fall behind
+    the lag of the slowest sink is checked after every publish and every
+    check_interval seconds, above the high watermark the flow is closed:
+    the server stops reading from its connections and holds back the
+    messages and their acks, the flow opens again when the lag drops
+    below the low watermark
+    clients negotiating framing.FEATURE_CREDIT are told in every ack how
+    many messages they may send without waiting for an ack (the window),
+    it shrinks as the lag approaches the high watermark
+    """
+
+    def __init__(self, bus, high_watermark=DEFAULT_HIGH_WATERMARK, low_watermark=DEFAULT_LOW_WATERMARK,
+                 ack_window=DEFAULT_ACK_WINDOW, check_interval=DEFAULT_CHECK_INTERVAL, process_metrics=None):
+        """
+        :param bus: util.bus.BatchBus or util.spool.SpoolWriter, anything with a cheap lag()
+        :param high_watermark: (int) bytes of lag closing the flow
+        :param low_watermark: (int) bytes of lag opening it again
+        :param ack_window: (int) the largest window advertised to a client
+        :param check_interval: (float) seconds between two looks at the lag
+        :param process_metrics: util.metrics.ProcessMetrics counting how often the flow closes
+        """
+        if low_watermark > high_watermark:
+            raise ValueError('low watermark %s is above high watermark %s' % (low_watermark, high_watermark))
+        self._bus = bus
+        self._high = high_watermark
+        self._low = low_watermark
+        self._max_window = ack_window
+        self._check_interval = check_interval
+        self._lag = 0
+        self._open = None
+        self._loop = None
+        self._metrics = process_metrics if process_metrics is not None else metrics.local()
+
+    def start(self, loop):
+        """
+        starts checking the lag periodically on loop
+        """
+        self._loop = loop
+        self._open = asyncio.Event()
+        self._open.set()
+        self.check()
+
+    def check(self):
+        self.update()
+        self._loop.call_later(self._check_interval, self.check)
+
+    def update(self):
+        """
+        looks at the lag of the sinks, called after every publish
+        so that a burst of messages closes the flow in time
+        """
+        self._lag = self._bus.lag()
+        if self._open.is_set():
+            if self._lag >= self._high:
+                _logger.warn("#warn:sinks-lag-%s-bytes-behind-throttling-clients" % self._lag)
+                self._metrics.incr('throttled')
+                self._metrics.set('flow_closed', 1)
+                self._open.clear()
+        elif self._lag <= self._low:
+            _logger.info("#info:sinks-caught-up-to-%s-bytes-resuming-clients" % self._lag)
+            self._metrics.set('flow_closed', 0)
+            self._open.set()
+
+    def is_open(self):
+        return self._open.is_set()
+
+    @asyncio.coroutine
+    def wait_open(self):
+        """
+        returns at once while the flow is open, otherwise when it opens again
+        """
+        if not self._open.is_set():
+            yield from self._open.wait()
+
+    def window(self):
+        """
+        :return: (int) number of messages a client may send before its next ack,
+        0 while the flow is closed
+        """
+        if not self._open.is_set():
+            return 0
+        if self._lag <= self._low:
+            return self._max_window
+        return max(1, self._max_window * (self._high - self._lag) // (self._high - self._low))
@@ -5,12 +5,18 @@ class Acknowledgment(general_message.GeneralMessage):
 	"""
 	A class for Acknowledgment messages
 	content = {'type':'ack', 'success': (int) msg_id, 'wanted': (int) msg_id}
+	with flow control credit the content has 'window': (int) the number of
+	messages the client may send before it waits for the next ack
 	"""
-	def __init__(self, succes_id, wanted_id):
+	__slots__ = ()
+
+	def __init__(self, succes_id, wanted_id, window=None):
 		super().__init__()
 		self._content['type'] = 'ack'
 		self.set_success(succes_id)
 		self.set_wanted(wanted_id)
+		if window is not None:
+			self.set_window(window)
 
 	def get_success(self):
 		return self._content['success']
@@ -23,3 +29,12 @@ class Acknowledgment(general_message.GeneralMessage):
 
 	def set_wanted(self, id):
 		self._content['wanted'] = id
+
+	def get_window(self):
+		"""
+		:return: (int) the credit of the client or None if the server did not send one
+		"""
+		return self._content.get('window')
+
+	def set_window(self, window):
+		self._content['window'] = window
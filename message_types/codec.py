@@ -0,0 +1,329 @@
+"""
+Encodings of the message_types classes on the wire.
+
+PickleCodec is the historical format: a pickled message object, unpickled
+with a restricted unpickler which only accepts the classes a message is
+made of. BinaryCodec is a versioned struct based format with a fixed
+layout per measurement type, UUIDs as raw bytes, MAC addresses as the
+text the client sent (so both codecs store the same mac_address) and a
+bitmap for the null fields. It decodes measurements into the records of
+message_types.records, encoding takes records and dictionaries.
+"""
+import datetime
+import io
+import pickle
+import struct
+import uuid
+from message_types import ackknowledgment
+from message_types import measurement_msg
+from message_types import records
+from message_types import requests
+from message_types import selective_ack
+
+# version 2 sends the mac address as text instead of 8 bytes
+BINARY_VERSION = 2
+
+# kind of a binary message
+_MEASUREMENT = 1
+_ACK = 2
+_REQUEST = 3
+_ACK_WINDOW = 4
+_SACK = 5
+
+_MESSAGE_HEADER = struct.Struct('!BB')
+_MEASUREMENT_HEADER = struct.Struct('!QI')
+_ACK_BODY = struct.Struct('!Qq')
+_ACK_WINDOW_BODY = struct.Struct('!QqI')
+_REQUEST_BODY = struct.Struct('!Bq')
+_SACK_BODY = struct.Struct('!QQiI')
+_SACK_RANGE = struct.Struct('!QQ')
+
+# ts is sent as microseconds since 1970-01-01, naive datetimes stay naive
+_EPOCH = datetime.datetime(1970, 1, 1)
+_EPOCH_UTC = datetime.datetime(1970, 1, 1, tzinfo=datetime.timezone.utc)
+_MICROSECOND = datetime.timedelta(microseconds=1)
+
+_NONE = -1
+
+# the longest mac address, e.g. 00:12:4B:00:01:02:03:04, and the longest text field
+_MAC_SIZE = 23
+_TEXT_SIZE = 8
+
+
+class MeasurementLayout():
+	"""
+	the fixed layout of one measurement type:
+	tag, null bitmap, id, device, ts and the float fields
+	"""
+
+	def __init__(self, tag, type_name, device_key, device_format, fields, text_fields=()):
+		self.tag = tag
+		self.type_name = type_name
+		self.device_key = device_key
+		self.fields = fields
+		self.text_fields = text_fields
+		self.struct = struct.Struct('!BH16s%sq%sd%s' % (device_format, len(fields),
+		                                                ''.join('%ss' % _TEXT_SIZE for _ in text_fields)))
+		# the bits of the null bitmap: ts, the float fields, the text fields
+		self.nullable = ('ts',) + tuple(fields) + tuple(text_fields)
+		# the keys of the values following tag and null bitmap, in the order of the record
+		self.keys = ('id', device_key) + self.nullable
+		self.record = records.RECORDS[type_name]
+		self.text_positions = tuple(range(len(self.keys) - len(text_fields), len(self.keys)))
+
+
+_LAYOUTS = [
+	MeasurementLayout(1, 'power_measurement', 'deviceid', '16s',
+	                  ('power1', 'power2', 'power3', 'power4', 'vrms', 'temp')),
+	MeasurementLayout(2, 'plug_measurement', 'mac_address', '%ss' % _MAC_SIZE,
+	                  ('load', 'irms', 'vrms', 'freq', 'work'), ('pow',)),
+	MeasurementLayout(3, 'temp_hum_measurement', 'deviceid', '16s',
+	                  ('temp', 'temp_external', 'humidity', 'battery')),
+]
+_LAYOUT_BY_TYPE = dict((layout.type_name, layout) for layout in _LAYOUTS)
+_LAYOUT_BY_TAG = dict((layout.tag, layout) for layout in _LAYOUTS)
+
+
+def _uuid_bytes(value):
+	if not isinstance(value, uuid.UUID):
+		value = uuid.UUID(str(value))
+	return value.bytes
+
+
+_SafeUUID = getattr(uuid, 'SafeUUID', None)
+_UNKNOWN = _SafeUUID.unknown if _SafeUUID is not None else None
+_UUID = uuid.UUID
+_new = object.__new__
+_setattr = object.__setattr__
+_from_bytes = int.from_bytes
+
+
+def _uuid_from_bytes(raw):
+	# the way uuid.UUID unpickles itself, without validating its arguments again
+	value = _new(_UUID)
+	_setattr(value, 'int', _from_bytes(raw, 'big'))
+	if _UNKNOWN is not None:
+		_setattr(value, 'is_safe', _UNKNOWN)
+	return value
+
+
+# the devices of a server are few, their decoded ids are reused
+_DEVICE_CACHE_SIZE = 10000
+_device_cache = {}
+
+
+def _device_from_bytes(raw, decode):
+	device = _device_cache.get(raw)
+	if device is None:
+		if len(_device_cache) >= _DEVICE_CACHE_SIZE:
+			_device_cache.clear()
+		device = decode(raw)
+		_device_cache[raw] = device
+	return device
+
+
+def _text_bytes(key, value, size):
+	# struct pads and truncates silently
+	raw = str(value).encode('ascii')
+	if len(raw) > size:
+		raise ValueError('%s %s is longer than %s characters' % (key, value, size))
+	return raw
+
+
+def _text_str(raw):
+	return raw.rstrip(b'\0').decode('ascii')
+
+
+_utcfromtimestamp = datetime.datetime.utcfromtimestamp
+
+
+def _ts_datetime(micros):
+	# a double is exact to a fraction of a microsecond for the next centuries,
+	# utcfromtimestamp rounds back to the microsecond sent
+	try:
+		return _utcfromtimestamp(micros / 1000000.0)
+	except (OverflowError, OSError):
+		raise ValueError('timestamp %s is out of range' % micros)
+
+
+def _ts_micros(ts):
+	if isinstance(ts, datetime.datetime):
+		if ts.tzinfo is None:
+			return (ts - _EPOCH) // _MICROSECOND
+		return (ts - _EPOCH_UTC) // _MICROSECOND
+	return int(float(ts) * 1000000)
+
+
+class BinaryCodec():
+	"""
+	encodes MeasurementMessage, Acknowledgment, SelectiveAck and Request as bytes
+	keys of a measurement which are not part of its layout are not sent
+	"""
+	name = 'binary'
+
+	def encode(self, msg):
+		ty = msg.get_type()
+		if ty == 'measurement':
+			return self.encode_measurement_msg(msg)
+		elif ty == 'ack':
+			wanted = msg.get_wanted()
+			wanted = _NONE if wanted is None else wanted
+			window = msg.get_window()
+			if window is None:
+				return _MESSAGE_HEADER.pack(BINARY_VERSION, _ACK) + _ACK_BODY.pack(msg.get_success(), wanted)
+			# only sent to clients which negotiated framing.FEATURE_CREDIT
+			return (_MESSAGE_HEADER.pack(BINARY_VERSION, _ACK_WINDOW) +
+			        _ACK_WINDOW_BODY.pack(msg.get_success(), wanted, window))
+		elif ty == 'sack':
+			# only sent to clients which negotiated framing.FEATURE_SACK
+			window = msg.get_window()
+			missing = msg.get_missing()
+			return b''.join([_MESSAGE_HEADER.pack(BINARY_VERSION, _SACK),
+			                 _SACK_BODY.pack(msg.get_cumulative(), msg.get_last(),
+			                                 _NONE if window is None else window, len(missing))] +
+			                [_SACK_RANGE.pack(start, end) for start, end in missing])
+		elif ty == 'request':
+			name = msg.get_request().encode('utf-8')
+			response = msg.get_response()
+			return (_MESSAGE_HEADER.pack(BINARY_VERSION, _REQUEST) +
+			        _REQUEST_BODY.pack(len(name), _NONE if response is None else response) + name)
+		raise ValueError('can not encode messages of type %s' % ty)
+
+	def encode_measurement_msg(self, msg):
+		data = msg.get_data() or []
+		parts = [_MESSAGE_HEADER.pack(BINARY_VERSION, _MEASUREMENT),
+		         _MEASUREMENT_HEADER.pack(msg.get_id(), len(data))]
+		for measurement in data:
+			parts.append(self.encode_measurement(measurement))
+		return b''.join(parts)
+
+	def encode_measurement(self, data):
+		layout = _LAYOUT_BY_TYPE[data['type']]
+		nulls = 0
+		values = []
+		for bit, key in enumerate(layout.nullable):
+			value = data.get(key)
+			if value is None:
+				nulls |= 1 << bit
+			values.append(value)
+
+		ts = 0 if values[0] is None else _ts_micros(values[0])
+		floats = [0.0 if v is None else float(v) for v in values[1:1 + len(layout.fields)]]
+		texts = [b'' if v is None else _text_bytes(key, v, _TEXT_SIZE)
+		         for key, v in zip(layout.text_fields, values[1 + len(layout.fields):])]
+		if layout.device_key == 'mac_address':
+			device = _text_bytes('mac_address', data['mac_address'], _MAC_SIZE)
+		else:
+			device = _uuid_bytes(data['deviceid'])
+		return layout.struct.pack(layout.tag, nulls, _uuid_bytes(data['id']), device, ts, *(floats + texts))
+
+	def decode(self, byte_msg):
+		version, kind = _MESSAGE_HEADER.unpack_from(byte_msg)
+		if version != BINARY_VERSION:
+			raise ValueError('unsupported binary version %s' % version)
+		offset = _MESSAGE_HEADER.size
+		if kind == _MEASUREMENT:
+			return self.decode_measurement_msg(byte_msg, offset)
+		elif kind == _ACK:
+			success, wanted = _ACK_BODY.unpack_from(byte_msg, offset)
+			return ackknowledgment.Acknowledgment(success, None if wanted == _NONE else wanted)
+		elif kind == _ACK_WINDOW:
+			success, wanted, window = _ACK_WINDOW_BODY.unpack_from(byte_msg, offset)
+			return ackknowledgment.Acknowledgment(success, None if wanted == _NONE else wanted, window)
+		elif kind == _SACK:
+			cumulative, last, window, count = _SACK_BODY.unpack_from(byte_msg, offset)
+			offset += _SACK_BODY.size
+			missing = [_SACK_RANGE.unpack_from(byte_msg, offset + i * _SACK_RANGE.size) for i in range(count)]
+			return selective_ack.SelectiveAck(cumulative, last, missing, None if window == _NONE else window)
+		elif kind == _REQUEST:
+			size, response = _REQUEST_BODY.unpack_from(byte_msg, offset)
+			offset += _REQUEST_BODY.size
+			name = bytes(byte_msg[offset:offset + size]).decode('utf-8')
+			return requests.Request(name, None if response == _NONE else response)
+		raise ValueError('unknown binary message kind %s' % kind)
+
+	def decode_measurement_msg(self, byte_msg, offset):
+		msg_id, count = _MEASUREMENT_HEADER.unpack_from(byte_msg, offset)
+		offset += _MEASUREMENT_HEADER.size
+		data = []
+		for i in range(count):
+			# a truncated or corrupt frame is rejected like any other undecodable message
+			if offset >= len(byte_msg):
+				raise ValueError('message %s ends before measurement %s of %s' % (msg_id, i + 1, count))
+			layout = _LAYOUT_BY_TAG.get(byte_msg[offset])
+			if layout is None:
+				raise ValueError('unknown measurement tag %s in message %s' % (byte_msg[offset], msg_id))
+			values = layout.struct.unpack_from(byte_msg, offset)
+			offset += layout.struct.size
+			data.append(self.decode_measurement(layout, values))
+		return measurement_msg.MeasurementMessage(msg_id, data)
+
+	def decode_measurement(self, layout, values):
+		"""
+		:return: records.MeasurementRecord of the layout, e.g. records.PowerMeasurement
+		"""
+		measurement = list(values[2:])
+		measurement[0] = _uuid_from_bytes(values[2])
+		if layout.device_key == 'mac_address':
+			measurement[1] = _device_from_bytes(values[3], _text_str)
+		else:
+			measurement[1] = _device_from_bytes(values[3], _uuid_from_bytes)
+		measurement[2] = _ts_datetime(values[4])
+		for i in layout.text_positions:
+			measurement[i] = _text_str(measurement[i])
+
+		nulls = values[1]
+		if nulls:
+			# the nullable values start with ts, after id and device
+			for bit in range(len(layout.nullable)):
+				if nulls & (1 << bit):
+					measurement[2 + bit] = None
+		return layout.record(tuple(measurement))
+
+
+class _MessageUnpickler(pickle.Unpickler):
+	"""
+	only the classes a message is made of can be unpickled
+	"""
+	_allowed = {
+		('message_types.general_message', 'GeneralMessage'),
+		('message_types.measurement_msg', 'MeasurementMessage'),
+		('message_types.ackknowledgment', 'Acknowledgment'),
+		('message_types.requests', 'Request'),
+		('message_types.selective_ack', 'SelectiveAck'),
+		('message_types.records', 'PowerMeasurement'),
+		('message_types.records', 'PlugMeasurement'),
+		('message_types.records', 'TempHumMeasurement'),
+		('uuid', 'UUID'),
+		('uuid', 'SafeUUID'),
+		('datetime', 'datetime'),
+		('datetime', 'date'),
+		('datetime', 'time'),
+		('datetime', 'timedelta'),
+		('datetime', 'timezone'),
+		('decimal', 'Decimal'),
+		('copyreg', '_reconstructor'),
+		('builtins', 'object'),
+	}
+
+	def find_class(self, module, name):
+		if (module, name) in self._allowed:
+			return super().find_class(module, name)
+		raise pickle.UnpicklingError('%s.%s is not allowed in a message' % (module, name))
+
+
+class PickleCodec():
+	"""
+	pickled message objects, as sent by the first clients
+	"""
+	name = 'pickle'
+
+	def encode(self, msg):
+		return pickle.dumps(msg)
+
+	def decode(self, byte_msg):
+		return _MessageUnpickler(io.BytesIO(byte_msg)).load()
+
+
+PICKLE = PickleCodec()
+BINARY = BinaryCodec()
@@ -0,0 +1,146 @@
+"""
+Length-prefixed framing of the messages sent between server and client.
+
+A framed client starts the connection with a preamble (MAGIC + version byte,
+from version 2 on followed by a byte of feature flags), the server answers
+with the same preamble carrying the version and the features it accepted.
+After that every message is sent as a 4 byte big-endian length followed by
+the payload. Clients which do not send the preamble are legacy clients and
+are served with raw pickled messages as before.
+"""
+import asyncio
+import struct
+
+MAGIC = b'I13F'
+VERSION = 2
+
+# features negotiated from version 2 on
+FEATURE_BINARY = 0x01
+# acks carry the flow control window of the client
+FEATURE_CREDIT = 0x02
+# cumulative, coalesced acks listing every missing range (message_types.selective_ack)
+FEATURE_SACK = 0x04
+FEATURES = FEATURE_BINARY | FEATURE_CREDIT | FEATURE_SACK
+
+_HEADER = struct.Struct('!I')
+HEADER_SIZE = _HEADER.size
+PREAMBLE_SIZE = len(MAGIC) + 1
+
+DEFAULT_MAX_FRAME_SIZE = 4 * 1024 * 1024
+
+
+class FrameTooLarge(Exception):
+	"""
+	raised when the header of a frame announces more than max_frame_size bytes
+	"""
+	pass
+
+
+def encode_frame(payload):
+	"""
+	:param payload: (bytes)
+	:return: (bytes) the payload prefixed with its length
+	"""
+	return _HEADER.pack(len(payload)) + payload
+
+
+def encode_preamble(version=VERSION, features=0):
+	if version < 2:
+		return MAGIC + bytes([version])
+	return MAGIC + bytes([version, features])
+
+
+def parse_preamble(data):
+	"""
+	:param data: (bytes) the first PREAMBLE_SIZE bytes of a connection
+	:return: (int) the version proposed by the peer or None for legacy peers,
+	from version 2 on one more byte with the features of the peer follows
+	"""
+	if len(data) == PREAMBLE_SIZE and data.startswith(MAGIC):
+		return data[-1]
+	return None
+
+
+class FrameDecoder():
+	"""
+	incremental decoder: bytes are fed as they arrive and every
+	complete frame contained in them is returned at once
+	"""
+
+	def __init__(self, max_frame_size=DEFAULT_MAX_FRAME_SIZE):
+		self._max_frame_size = max_frame_size
+		self._buffer = bytearray()
+		self._frame_size = None
+
+	def feed(self, data):
+		"""
+		:param data: (bytes) received from the stream
+		:return: (list) payloads of all frames completed by data
+		"""
+		self._buffer.extend(data)
+		frames = []
+		while True:
+			if self._frame_size is None:
+				if len(self._buffer) < HEADER_SIZE:
+					break
+				size = _HEADER.unpack_from(self._buffer)[0]
+				if size > self._max_frame_size:
+					raise FrameTooLarge(size)
+				del self._buffer[:HEADER_SIZE]
+				self._frame_size = size
+			if len(self._buffer) < self._frame_size:
+				break
+			frames.append(bytes(self._buffer[:self._frame_size]))
+			del self._buffer[:self._frame_size]
+			self._frame_size = None
+		return frames
+
+	def buffered(self):
+		"""
+		:return: (int) bytes of the current header or frame received so far
+		"""
+		return len(self._buffer)
+
+	def needed(self):
+		"""
+		:return: (int) number of bytes missing to complete the current header or frame
+		"""
+		if self._frame_size is None:
+			return HEADER_SIZE - len(self._buffer)
+		return self._frame_size - len(self._buffer)
+
+
+class FrameReader():
+	"""
+	reads frames from an asyncio.StreamReader
+	small frames are pulled from one read() several at a time, the rest
+	of a large frame is read with a single readexactly()
+	"""
+
+	def __init__(self, reader, max_frame_size=DEFAULT_MAX_FRAME_SIZE, chunk_size=64 * 1024):
+		self._reader = reader
+		self._decoder = FrameDecoder(max_frame_size)
+		self._chunk_size = chunk_size
+
+	@asyncio.coroutine
+	def read_frames(self):
+		"""
+		:return: (list) at least one complete payload, an empty list at EOF
+		"""
+		while True:
+			needed = self._decoder.needed()
+			if needed > self._chunk_size:
+				data = yield from self._reader.readexactly(needed)
+			else:
+				data = yield from self._reader.read(self._chunk_size)
+				if not data:
+					return []
+			frames = self._decoder.feed(data)
+			if frames:
+				return frames
+
+	def buffered(self):
+		"""
+		:return: (int) bytes received and not returned as a frame yet
+		"""
+		return self._decoder.buffered()
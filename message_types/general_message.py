@@ -1,11 +1,20 @@
 class GeneralMessage():
 	"""
-    a class for other message types to inherit
-    """
+	a class for other message types to inherit
+	the content is the only attribute of a message, the pickles of the
+	first clients, which set it through the __dict__, are still read
+	"""
+	__slots__ = ('_content',)
 
 	def __init__(self):
 		self._content = {'type': 'General'}
 
+	def __setstate__(self, state):
+		# {'_content': ...} of a message with a __dict__, or (None, {'_content': ...}) of one with slots
+		if isinstance(state, tuple):
+			state = state[1]
+		self._content = state['_content']
+
 	def get_type(self):
 		return self._content['type']
 
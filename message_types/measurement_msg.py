@@ -4,8 +4,11 @@ from message_types import general_message
 class MeasurementMessage(general_message.GeneralMessage):
 	"""
 	A class for measurement messages which its content is a dictionary
-	{'type'='measurement', 'id': (int) msg_id, 'data': list_of_dictionaries (measurements)}
+	{'type'='measurement', 'id': (int) msg_id, 'data': list of measurements}
+	the measurements are dictionaries, or message_types.records decoded by the BinaryCodec
 	"""
+	__slots__ = ()
+
 	def __init__(self, id, data):
 		super().__init__()
 		self._content['type'] = 'measurement'
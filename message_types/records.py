@@ -0,0 +1,116 @@
+"""
+Compact records of the measurements, in place of one dictionary each.
+
+A record keeps the values of its measurement in a tuple, in the order of
+its KEYS, so a measurement costs an object and a tuple instead of a
+dictionary repeating its keys. Records pickle as their class and that
+tuple. The BinaryCodec decodes measurements into records, the pickled
+messages of the first clients still carry dictionaries.
+
+A record answers data[key] and data.get(key) like the dictionary it
+replaces, 'type' included, so the server and the columnar stage take
+both. to_dict and record_of convert at the edges.
+"""
+
+
+class MeasurementRecord():
+	"""
+	the values of one measurement, a subclass per measurement type
+	"""
+	__slots__ = ('values',)
+
+	type_name = None
+	device_key = None
+	KEYS = ()
+	_INDEX = {}
+
+	def __init__(self, values):
+		"""
+		:param values: tuple of the values, in the order of KEYS
+		"""
+		self.values = values
+
+	def __reduce__(self):
+		return self.__class__, (self.values,)
+
+	def __getitem__(self, key):
+		if key == 'type':
+			return self.type_name
+		return self.values[self._INDEX[key]]
+
+	def __contains__(self, key):
+		return key == 'type' or key in self._INDEX
+
+	def __eq__(self, other):
+		return self.__class__ is other.__class__ and self.values == other.values
+
+	def __hash__(self):
+		return hash(self.values)
+
+	def __repr__(self):
+		return '%s%r' % (self.__class__.__name__, self.values)
+
+	def get(self, key, default=None):
+		if key == 'type':
+			return self.type_name
+		index = self._INDEX.get(key)
+		return default if index is None else self.values[index]
+
+	def keys(self):
+		return ('type',) + self.KEYS
+
+	def to_dict(self):
+		"""
+		:return: the measurement as a dictionary
+		"""
+		data = dict(zip(self.KEYS, self.values))
+		data['type'] = self.type_name
+		return data
+
+	@classmethod
+	def from_dict(cls, data):
+		"""
+		:param data: dictionary representing a measurement of this type, missing keys are None
+		"""
+		return cls(tuple(data.get(key) for key in cls.KEYS))
+
+
+def _index(keys):
+	return dict((key, i) for i, key in enumerate(keys))
+
+
+class PowerMeasurement(MeasurementRecord):
+	__slots__ = ()
+	type_name = 'power_measurement'
+	device_key = 'deviceid'
+	KEYS = ('id', 'deviceid', 'ts', 'power1', 'power2', 'power3', 'power4', 'vrms', 'temp')
+	_INDEX = _index(KEYS)
+
+
+class PlugMeasurement(MeasurementRecord):
+	__slots__ = ()
+	type_name = 'plug_measurement'
+	device_key = 'mac_address'
+	KEYS = ('id', 'mac_address', 'ts', 'load', 'irms', 'vrms', 'freq', 'work', 'pow')
+	_INDEX = _index(KEYS)
+
+
+class TempHumMeasurement(MeasurementRecord):
+	__slots__ = ()
+	type_name = 'temp_hum_measurement'
+	device_key = 'deviceid'
+	KEYS = ('id', 'deviceid', 'ts', 'temp', 'temp_external', 'humidity', 'battery')
+	_INDEX = _index(KEYS)
+
+
+RECORDS = dict((record.type_name, record) for record in (PowerMeasurement, PlugMeasurement, TempHumMeasurement))
+
+
+def record_of(data):
+	"""
+	:param data: dictionary representing a measurement, or a record
+	:return: the record of the measurement
+	"""
+	if isinstance(data, MeasurementRecord):
+		return data
+	return RECORDS[data['type']].from_dict(data)
@@ -8,6 +8,8 @@ class Request(general_message.GeneralMessage):
 	{'type':request, 'request': 'GET_MSG_COUNTER', 'data': data}
 
 	"""
+	__slots__ = ()
+
 	def __init__(self, request, data):
 		super().__init__()
 		self._content['type'] = 'request'
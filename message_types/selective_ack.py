@@ -0,0 +1,48 @@
+from message_types import general_message
+
+class SelectiveAck(general_message.GeneralMessage):
+	"""
+	A class for the acknowledgments of clients which negotiated framing.FEATURE_SACK
+	content = {'type':'sack', 'cumulative': (int) msg_id, 'last': (int) msg_id,
+	'missing': list of (start, end) msg_ids, 'window': (int) or None}
+	every message up to cumulative has been received, of the messages after it
+	up to last all but the missing ranges (both ends inclusive) have been received
+	one SelectiveAck answers all messages received since the previous one
+	"""
+	__slots__ = ()
+
+	def __init__(self, cumulative, last, missing=(), window=None):
+		super().__init__()
+		self._content['type'] = 'sack'
+		self._content['cumulative'] = cumulative
+		self._content['last'] = last
+		self._content['missing'] = list(missing)
+		self._content['window'] = window
+
+	def get_cumulative(self):
+		return self._content['cumulative']
+
+	def get_last(self):
+		return self._content['last']
+
+	def get_missing(self):
+		"""
+		:return: list of (start, end) of the message ids not received yet, oldest first
+		"""
+		return self._content['missing']
+
+	def get_window(self):
+		"""
+		:return: (int) the credit of the client or None if the server did not send one
+		"""
+		return self._content['window']
+
+	def is_acked(self, msg_id):
+		"""
+		:return: True if msg_id has been received by the server
+		"""
+		if msg_id <= self.get_cumulative():
+			return True
+		if msg_id > self.get_last():
+			return False
+		return not any(start <= msg_id <= end for start, end in self.get_missing())
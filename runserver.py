@@ -1,43 +1,376 @@
+import argparse
 import logging
 import multiprocessing
+import signal
 from dbmnger import database_manager
+from dbmnger import partitions
+from dbmnger import rollups
+from message_types import framing
+import session
+import flow
 from server import Server, create_ssl_context
+from server import DEFAULT_SESSION_TICKETS, DEFAULT_MAX_HANDSHAKES, DEFAULT_HANDSHAKE_TIMEOUT
+from server import DEFAULT_ACK_DELAY, DEFAULT_ACK_COALESCE, DEFAULT_SHUTDOWN_TIMEOUT
+from server import DEFAULT_IDLE_TIMEOUT, DEFAULT_READ_BUFFER_SIZE, DEFAULT_PUBLISH_TIMEOUT
 from util import cfg
+from util.bus import BatchBus, DEFAULT_CAPACITY
+from util import spool
+from util import metrics
+from util import revocation
+from util import dedup
 from util.logger_factory import setup_logging
 from carbon_mnger import carbon_agent
+from carbon_mnger import namespace
+from carbon_mnger import output
+from cache_mnger import cache_agent
+from cache_mnger import recent_cache
 
 _logger = logging.getLogger(__name__)
 
+# names of the consumers of the bus
+STORAGE_SINK = 'storage'
+CARBON_SINK = 'carbon'
+CACHE_SINK = 'cache'
 
-def create_ssl_server(storage_queue, carbon_queue):
+# the counters and gauges reported for each database writer on its own
+_SHARD_METRICS = ('db_rows', 'db_flushes', 'db_errors', 'db_pending', 'storage_lag')
+
+_SPOOL_DIRECTORY = 'spool'
+
+
+def create_server_ssl_context():
+    """
+    Creates the ssl.SSLContext of the server from the configuration
+    """
+    ssl_config = cfg.get_ssl_config()
+    certfile = ssl_config["certFile"]
+    keyfile = ssl_config["keyFile"]
+    root_pem = ssl_config["locationVerification"]
+    session_tickets = int(ssl_config.get("sessionTickets", DEFAULT_SESSION_TICKETS))
+    return create_ssl_context(certfile, keyfile, root_pem, session_tickets)
+
+
+def load_expired_serials():
+    """
+    :return: the serials of [expired] serialNumbers and of the file serialsFile
+    """
+    expired_config = cfg.get_expired_certificates()
+    serials = revocation.parse_serials(expired_config.get("serialNumbers", ""))
+    serials_file = expired_config.get("serialsFile")
+    if serials_file:
+        with open(serials_file) as fin:
+            serials |= revocation.parse_serials(fin.read())
+    return serials
+
+
+def create_expired_serials():
+    """
+    Creates the set of expired serials, reloaded when server.config or the serialsFile change
+    """
+    expired_config = cfg.get_expired_certificates()
+    paths = [cfg.CONFIG_FILE]
+    if expired_config.get("serialsFile"):
+        paths.append(expired_config["serialsFile"])
+    return revocation.RevokedSerials(
+        load_expired_serials, paths,
+        check_interval=float(expired_config.get("checkInterval", revocation.DEFAULT_CHECK_INTERVAL)))
+
+
+def cache_enabled():
+    return cfg.get_cache_config().get('enabled', 'false').lower() in ('true', 'yes', 'on', '1')
+
+
+def db_shards():
+    return max(1, int(cfg.get_dbwriter_config().get('shards', 1)))
+
+
+def storage_sinks():
+    """
+    :return: the names of the database writers, each reads the bus with its own cursor
+    """
+    shards = db_shards()
+    if shards == 1:
+        return [STORAGE_SINK]
+    return ['%s-%d' % (STORAGE_SINK, shard) for shard in range(shards)]
+
+
+def sinks():
+    """
+    :return: the names of the consumers of the bus, the cache only reads it if it is enabled
+    """
+    names = storage_sinks() + [CARBON_SINK]
+    return names + [CACHE_SINK] if cache_enabled() else names
+
+
+def spool_enabled():
+    return cfg.get_spool_config().get('enabled', 'false').lower() in ('true', 'yes', 'on', '1')
+
+
+def create_spool_writer(worker_id=0):
+    """
+    Creates the writer of the spool partition of a server process
+    """
+    spool_config = cfg.get_spool_config()
+    return spool.SpoolWriter(spool_config.get('directory', _SPOOL_DIRECTORY), spool.partition_name(worker_id),
+                             segment_size=int(spool_config.get('segmentSize', spool.DEFAULT_SEGMENT_SIZE)),
+                             sinks=sinks())
+
+
+def create_spool_reader(sink):
+    """
+    Creates the reader of the spool of one sink
+    """
+    spool_config = cfg.get_spool_config()
+    return spool.SpoolReader(spool_config.get('directory', _SPOOL_DIRECTORY), sink, sinks(),
+                             commit_interval=float(spool_config.get('commitInterval',
+                                                                    spool.DEFAULT_COMMIT_INTERVAL)))
+
+
+def create_dedup_index():
+    """
+    :return: util.dedup.LRUIndex or BloomIndex of the recent measurement ids, None if disabled
+    """
+    dedup_config = cfg.get_dedup_config()
+    if dedup_config.get('enabled', 'false').lower() not in ('true', 'yes', 'on', '1'):
+        return None
+    return dedup.create_index(dedup_config.get('mode', dedup.MODE_LRU),
+                              int(dedup_config.get('capacity', dedup.DEFAULT_CAPACITY)),
+                              float(dedup_config.get('errorRate', dedup.DEFAULT_ERROR_RATE)),
+                              float(dedup_config.get('interval', dedup.DEFAULT_INTERVAL)))
+
+
+def checkpoint_directory():
+    """
+    :return: the directory of the session checkpoints, None if the sessions are not checkpointed
+    """
+    return cfg.get_server_config().get('sessionCheckpoint') or None
+
+
+def load_session_states(workers):
+    """
+    reads the sessions checkpointed by the last server and removes the files of workers not running anymore
+    :param workers: (int) number of server workers
+    :return: dict of session states by serial number
+    """
+    directory = checkpoint_directory()
+    if directory is None:
+        return {}
+    states = session.read_checkpoints(directory)
+    session.remove_checkpoints(directory, workers)
+    _logger.info("#info:loaded-%s-sessions-from-the-checkpoint" % len(states))
+    return states
+
+
+def create_ssl_server(bus, sslctx=None, worker_id=0, session_store=None, registry=None, session_states=None):
     """
     Creates and returns an instance of a Server communicating in secure channel
-    :param storage_queue: (multiprocessing.Queue) shared queue between server and DatabaseManager
-    :param carbon_queue: (multiprocessing.Queue) shared queue between server and CarbonAgent
+    :param bus: (util.bus.BatchBus) shared bus between server, DatabaseManager and CarbonAgent,
+    None to write to the spool partition of the worker
+    :param sslctx: ssl.SSLContext, created from the configuration if None
+    :param worker_id: (int) number of the worker process running the server
+    :param session_store: dict shared between the worker processes, None if the server runs alone
+    :param registry: util.metrics.MetricsRegistry, the server writes to the slot worker_id
+    :param session_states: dict of the sessions of the last server, see load_session_states
     :return: an instance of Server
     """
 
     # loading the configuration
     com_config = cfg.get_server_config()
-    ssl_config = cfg.get_ssl_config()
-    expired_certs = cfg.get_expired_certificates()["serialNumbers"].split(";")
+    expired_certs = create_expired_serials()
     try:
-        if com_config and ssl_config:
+        if com_config:
             host = com_config["serverAddress"]
             port = int(com_config["serverPort"])
 
-            certfile = ssl_config["certFile"]
-            keyfile = ssl_config["keyFile"]
-            root_pem = ssl_config["locationVerification"]
-            sslctx = create_ssl_context(certfile, keyfile, root_pem)
+            max_frame_size = int(com_config.get("maxFrameSize", framing.DEFAULT_MAX_FRAME_SIZE))
+            max_gap_span = int(com_config.get("maxGapSpan", session.DEFAULT_MAX_GAP_SPAN))
+            stats_interval = int(com_config.get("statsInterval", 60))
+            sync_delay = float(cfg.get_spool_config().get("syncDelay", 0.005))
+            if sslctx is None:
+                sslctx = create_server_ssl_context()
+            if bus is None:
+                # the file of the spool is opened in the process of the server
+                bus = create_spool_writer(worker_id)
+            process_metrics = registry.slot(worker_id) if registry is not None else None
+            flow_control = None
+            if com_config.get("flowControl", "false").lower() in ("true", "yes", "on", "1"):
+                flow_control = flow.FlowControl(
+                    bus,
+                    high_watermark=int(com_config.get("highWatermark", flow.DEFAULT_HIGH_WATERMARK)),
+                    low_watermark=int(com_config.get("lowWatermark", flow.DEFAULT_LOW_WATERMARK)),
+                    ack_window=int(com_config.get("ackWindow", flow.DEFAULT_ACK_WINDOW)),
+                    process_metrics=process_metrics)
+            session_checkpoint = None
+            if checkpoint_directory() is not None:
+                session_checkpoint = session.SessionCheckpoint(checkpoint_directory(), worker_id)
 
-            server = Server(sslctx, storage_queue, carbon_queue, expired_certs, host, port)
+            server = Server(sslctx, bus, expired_certs, host, port,
+                            max_frame_size, max_gap_span,
+                            worker_id=worker_id, reuse_port=session_store is not None,
+                            session_store=session_store, stats_interval=stats_interval,
+                            sync_delay=sync_delay, flow_control=flow_control,
+                            process_metrics=process_metrics,
+                            max_handshakes=int(com_config.get("maxHandshakes", DEFAULT_MAX_HANDSHAKES)),
+                            handshake_timeout=float(com_config.get("handshakeTimeout", DEFAULT_HANDSHAKE_TIMEOUT)),
+                            dedup_index=create_dedup_index(),
+                            selective_acks=com_config.get("selectiveAcks", "false").lower() in ("true", "yes", "on", "1"),
+                            ack_delay=float(com_config.get("ackDelay", DEFAULT_ACK_DELAY)),
+                            ack_coalesce=int(com_config.get("ackCoalesce", DEFAULT_ACK_COALESCE)),
+                            session_checkpoint=session_checkpoint,
+                            checkpoint_interval=float(com_config.get("checkpointInterval",
+                                                                     session.DEFAULT_CHECKPOINT_INTERVAL)),
+                            session_states=session_states,
+                            shutdown_timeout=float(com_config.get("shutdownTimeout", DEFAULT_SHUTDOWN_TIMEOUT)),
+                            idle_timeout=float(com_config.get("idleTimeout", DEFAULT_IDLE_TIMEOUT)),
+                            max_connections=int(com_config.get("maxConnections", 0)),
+                            max_client_connections=int(com_config.get("maxClientConnections", 0)),
+                            read_buffer_size=int(com_config.get("readBufferSize", DEFAULT_READ_BUFFER_SIZE)),
+                            socket_buffer_size=int(com_config.get("socketBufferSize", 0)),
+                            publish_timeout=float(com_config.get("publishTimeout", DEFAULT_PUBLISH_TIMEOUT)))
 
             return server
     except Exception as e:
         _logger.error("Configuration failed!", e)
 
 
+class Terminated(Exception):
+    """
+    raised in the main process when it receives SIGTERM
+    """
+
+
+def _raise_terminated(signum, frame):
+    raise Terminated()
+
+
+def run_worker(worker_id, bus, sslctx, session_store, registry):
+    """
+    the target of a server worker process
+    """
+    server = create_ssl_server(bus, sslctx, worker_id, session_store, registry)
+    server.run()
+
+
+def run_workers(count, bus, registry, session_states=None):
+    """
+    runs count server processes sharing the listening port with SO_REUSEPORT,
+    the kernel distributes the incoming connections between them
+    :param count: (int) number of worker processes
+    :param bus: (util.bus.BatchBus) shared by all workers, None if each worker writes to the spool
+    :param registry: util.metrics.MetricsRegistry with a slot per worker
+    :param session_states: dict of the sessions of the last server, see load_session_states
+    """
+    # the context is created before forking, so all workers share the same keys
+    sslctx = create_server_ssl_context()
+
+    # the sequence tracking state of disconnected clients, so that
+    # it follows a client to the worker accepting its next connection
+    manager = multiprocessing.Manager()
+    session_store = manager.dict()
+    if session_states:
+        session_store.update(session_states)
+
+    workers = []
+    for worker_id in range(count):
+        worker = multiprocessing.Process(target=run_worker, args=(worker_id, bus, sslctx, session_store, registry),
+                                         name='server-worker-%s' % worker_id)
+        worker.start()
+        workers.append(worker)
+    _logger.info("#info:started-%s-server-workers" % count)
+    # set once the workers are forked, they stop on SIGTERM on their own
+    signal.signal(signal.SIGTERM, _raise_terminated)
+
+    try:
+        for worker in workers:
+            worker.join()
+    except (KeyboardInterrupt, Terminated) as e:
+        signal.signal(signal.SIGTERM, signal.SIG_IGN)
+        if isinstance(e, Terminated):
+            _logger.error("#error:server-stopped-with-sigterm")
+            # forwarded, the workers stop as on ctrl-c
+            for worker in workers:
+                worker.terminate()
+        else:
+            _logger.error("#error:server-stopped-with-keyboardInterrupt")
+        # the workers drain their connections and write their checkpoints
+        timeout = float(cfg.get_server_config().get("shutdownTimeout", DEFAULT_SHUTDOWN_TIMEOUT)) + 5
+        for worker in workers:
+            worker.join(timeout)
+        for worker in workers:
+            if worker.is_alive():
+                worker.terminate()
+                worker.join()
+
+
+def create_partition_manager(db_connection):
+    """
+    Creates the PartitionManager of the DatabaseManager, None if the tables are not partitioned
+    """
+    partitions_config = cfg.get_partitions_config()
+    if partitions_config.get('enabled', 'false').lower() not in ('true', 'yes', 'on', '1'):
+        return None
+    return partitions.PartitionManager(
+        db_connection,
+        interval=partitions_config.get('interval', partitions.INTERVAL_DAY),
+        premake=int(partitions_config.get('premake', partitions.DEFAULT_PREMAKE)),
+        retention_days=int(partitions_config.get('retentionDays', partitions.DEFAULT_RETENTION_DAYS)),
+        retention=partitions_config.get('retention', partitions.RETENTION_DETACH),
+        maintenance_interval=float(partitions_config.get('maintenanceInterval',
+                                                         partitions.DEFAULT_MAINTENANCE_INTERVAL)))
+
+
+def create_rollup_writer():
+    """
+    Creates the RollupWriter of the DatabaseManager, None if no rollups are kept
+    """
+    rollups_config = cfg.get_rollups_config()
+    if rollups_config.get('enabled', 'false').lower() not in ('true', 'yes', 'on', '1'):
+        return None
+    granularities = rollups_config.get('granularities', ','.join(rollups.GRANULARITIES))
+    return rollups.RollupWriter([granularity.strip() for granularity in granularities.split(',') if granularity.strip()])
+
+
+def create_cache_agent(reader, process_metrics):
+    """
+    Creates the CacheAgent serving the recent data read by reader
+    """
+    cache_config = cfg.get_cache_config()
+    cache = recent_cache.RecentCache(
+        capacity=int(cache_config.get('capacity', recent_cache.DEFAULT_CAPACITY)),
+        horizon=float(cache_config.get('horizon', recent_cache.DEFAULT_HORIZON)))
+    return cache_agent.CacheAgent(reader, cache,
+                                  host=cache_config.get('host', cache_agent.DEFAULT_HOST),
+                                  port=int(cache_config.get('port', cache_agent.DEFAULT_PORT)),
+                                  process_metrics=process_metrics)
+
+
+def create_database_managers(readers, registry, first_slot):
+    """
+    Creates one DatabaseManager per shard, each with its own connection
+    :param readers: the readers of storage_sinks(), in the same order
+    :param registry: util.metrics.MetricsRegistry, the writers use the slots from first_slot on
+    :return: list of DatabaseManager
+    """
+    writer_config = cfg.get_dbwriter_config()
+    stats_interval = float(writer_config.get('statsInterval', cfg.get_server_config().get('statsInterval', 60)))
+    managers = []
+    for shard, reader in enumerate(readers):
+        registry.label(first_slot + shard, 'storage.shard%d' % shard, _SHARD_METRICS)
+        db_connection = create_postgres_connection()
+        managers.append(database_manager.DatabaseManager(
+            reader=reader, db_connection=db_connection,
+            mode=writer_config.get('mode', database_manager.MODE_ROW),
+            batch_size=int(writer_config.get('batchSize', database_manager.DEFAULT_BATCH_SIZE)),
+            batch_max_age=float(writer_config.get('batchMaxAge', database_manager.DEFAULT_BATCH_MAX_AGE)),
+            process_metrics=registry.slot(first_slot + shard),
+            # the partitions are maintained by the first writer only
+            partitions=create_partition_manager(db_connection) if shard == 0 else None,
+            rollups=create_rollup_writer(),
+            shard=shard, shards=len(readers), connect=create_postgres_connection,
+            stats_interval=stats_interval))
+    return managers
+
+
 def create_postgres_connection():
     """
     Creates and returns a connection to the Postgres Database
@@ -48,22 +381,97 @@ def create_postgres_connection():
 
 
 if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='I13 Mon Server')
+    parser.add_argument('--workers', type=int, default=None,
+                        help='number of server processes sharing the port (SO_REUSEPORT), '
+                             'defaults to workers in server.config or 1')
+    args = parser.parse_args()
+
     setup_logging()
 
-    storage_queue = multiprocessing.Queue(maxsize=0)
-    carbon_queue = multiprocessing.Queue(maxsize=0)
+    workers = args.workers
+    if workers is None:
+        workers = int(cfg.get_server_config().get('workers', 1))
+
+    # one slot of metrics per server worker, database writer, the CarbonClient and the CacheAgent
+    shards = db_shards()
+    registry = metrics.MetricsRegistry(workers + shards + 2)
+    storage_slot = workers
+    carbon_slot = workers + shards
+    cache_slot = workers + shards + 1
+    metrics_config = cfg.get_metrics_config()
+    stats_port = int(metrics_config.get('statsPort', 0))
+    if stats_port:
+        metrics.start_stats_server(registry, metrics_config.get('statsHost', '127.0.0.1'), stats_port)
+
+    if spool_enabled():
+        # measurements are acknowledged once they are on disk, the sinks
+        # read them from the spool and resume there after a restart
+        bus = None
+        storage_readers = [create_spool_reader(sink) for sink in storage_sinks()]
+        carbon_reader = create_spool_reader(CARBON_SINK)
+        cache_reader = create_spool_reader(CACHE_SINK) if cache_enabled() else None
+    else:
+        bus_config = cfg.get_bus_config()
+        bus = BatchBus(sinks(), capacity=int(bus_config.get('capacity', DEFAULT_CAPACITY)))
+        storage_readers = [bus.reader(sink) for sink in storage_sinks()]
+        carbon_reader = bus.reader(CARBON_SINK)
+        cache_reader = bus.reader(CACHE_SINK) if cache_enabled() else None
 
-    # setting and starting the DatabaseManager process
-    postgresconnection = create_postgres_connection()
-    dbmanager = database_manager.DatabaseManager(queue=storage_queue, db_connection=postgresconnection)
-    dbmanager.start()
+    # setting and starting the DatabaseManager processes, one per shard
+    dbmanagers = create_database_managers(storage_readers, registry, storage_slot)
+    for sink, dbmanager in zip(storage_sinks(), dbmanagers):
+        dbmanager.start()
+        # the server does not wait for a sink whose process died
+        if bus is not None:
+            bus.attach(sink, dbmanager.pid)
 
     # setting and starting the CarbonAgent process
-    name_dictionary = carbon_agent.load_namespace_dict()
-    c = carbon_agent.CarbonClient(carbon_queue, name_dictionary)
+    carbon_config = cfg.get_carbon_config()
+    # reloaded by the CarbonClient when the file changes
+    name_dictionary = namespace.NamespaceFile(
+        carbon_config.get('namespaceFile', namespace.DEFAULT_FILENAME),
+        check_interval=float(carbon_config.get('namespaceCheckInterval', namespace.DEFAULT_CHECK_INTERVAL)))
+    carbon_protocol = carbon_config.get('protocol', output.PROTOCOL_PLAINTEXT)
+    carbon_output = output.CarbonOutput(
+        carbon_config.get('host', carbon_agent._CARBON_HOST),
+        int(carbon_config.get('port', output.DEFAULT_PORTS[carbon_protocol])),
+        protocol=carbon_protocol,
+        buffer_size=int(carbon_config.get('bufferSize', output.DEFAULT_BUFFER_SIZE)),
+        flush_interval=float(carbon_config.get('flushInterval', output.DEFAULT_FLUSH_INTERVAL)),
+        max_buffered=int(carbon_config.get('maxBuffered', output.DEFAULT_MAX_BUFFERED)),
+        max_retries=int(carbon_config.get('maxRetries', output.DEFAULT_MAX_RETRIES)))
+    c = carbon_agent.CarbonClient(
+        carbon_reader, name_dictionary,
+        retention_rate=int(carbon_config.get('retentionRate', carbon_agent._RETENTION_RATE)),
+        aggregation=carbon_config.get('aggregation', carbon_agent._AGGREGATION),
+        carbon_output=carbon_output,
+        process_metrics=registry.slot(carbon_slot), registry=registry,
+        report_prefix=metrics_config.get('carbonPrefix'),
+        report_interval=float(metrics_config.get('reportInterval', carbon_agent._REPORT_INTERVAL)))
     c.connect()
     c.start()
+    if bus is not None:
+        bus.attach(CARBON_SINK, c.pid)
+
+    # setting and starting the CacheAgent process
+    if cache_reader is not None:
+        cache = create_cache_agent(cache_reader, registry.slot(cache_slot))
+        cache.start()
+        if bus is not None:
+            bus.attach(CACHE_SINK, cache.pid)
 
     # setting and starting the SSLServer
-    s = create_ssl_server(storage_queue, carbon_queue)
-    s.run()
+    try:
+        session_states = load_session_states(workers)
+        if workers > 1:
+            run_workers(workers, bus, registry, session_states)
+        else:
+            s = create_ssl_server(bus, registry=registry, session_states=session_states)
+            s.run()
+    finally:
+        # let the DatabaseManagers write what they have buffered
+        for dbmanager in dbmanagers:
+            dbmanager.stop()
+        for dbmanager in dbmanagers:
+            dbmanager.join()
@@ -1,60 +1,342 @@
 __author__ = 'arash'
 
-import copy
 import logging
 import asyncio
 import ssl
 import pickle
+import signal
+import socket
+import struct
+import time
 from message_types import ackknowledgment
+from message_types import codec
+from message_types import framing
 from message_types import measurement_msg
 from message_types import requests
+from message_types import selective_ack
+from session import SessionRegistry, DEFAULT_MAX_GAP_SPAN, DEFAULT_CHECKPOINT_INTERVAL
+from util.bus import BusFull
+from util import columnar
+from util import metrics
 
 
 _logger = logging.getLogger(__name__)
 
+# TLS 1.3 session tickets sent after a full handshake
+DEFAULT_SESSION_TICKETS = 2
 
-def create_ssl_context(certfile, keyfile, root_pem):
+# tls handshakes running at the same time, and the seconds one may take
+DEFAULT_MAX_HANDSHAKES = 32
+DEFAULT_HANDSHAKE_TIMEOUT = 10.0
+
+# a selective ack answers the messages accepted within ack_delay seconds, at most ack_coalesce of them
+DEFAULT_ACK_DELAY = 0.01
+DEFAULT_ACK_COALESCE = 64
+# missing ranges listed in one selective ack, the newer ones follow in later acks
+_MAX_SACK_RANGES = 1024
+
+# seconds a stopping server waits for the messages being accepted
+DEFAULT_SHUTDOWN_TIMEOUT = 10.0
+
+# seconds a message waits for space on a full bus before it is left unacknowledged,
+# and the seconds between two attempts, the loop is never blocked by a full bus
+DEFAULT_PUBLISH_TIMEOUT = 5.0
+_PUBLISH_RETRY_DELAY = 0.01
+
+# a connection waiting that many seconds for the next message is closed, e.g. a device which lost power
+DEFAULT_IDLE_TIMEOUT = 600.0
+# bytes read from a connection at once and buffered before reading pauses (the default of asyncio)
+DEFAULT_READ_BUFFER_SIZE = 64 * 1024
+
+
+def create_ssl_context(certfile, keyfile, root_pem, session_tickets=DEFAULT_SESSION_TICKETS):
     """
     Creates and returns a ssl.SSLContext
     certfile and root_pem must be in PEM format
+    a reconnecting client resumes its session with a ticket (TLS 1.3) or from
+    the session cache (TLS 1.2) instead of a full handshake, the keys of the
+    tickets belong to the context, so workers forked after its creation accept
+    each other's tickets
     :param certfile: path to  the certification file
     :param keyfile: path to the key
     :param root_pem: path to the root certification file
+    :param session_tickets: (int) tickets sent to a client after a full handshake, 0 disables resumption
     :return: ssl.SSLContext
     """
     sslcontext = ssl.create_default_context(purpose=ssl.Purpose.CLIENT_AUTH)
     sslcontext.load_cert_chain(certfile=certfile, keyfile=keyfile)
     sslcontext.load_verify_locations(root_pem)
     sslcontext.verify_mode = ssl.CERT_REQUIRED
+    if session_tickets:
+        sslcontext.options &= ~ssl.OP_NO_TICKET
+    else:
+        sslcontext.options |= ssl.OP_NO_TICKET
+    if hasattr(sslcontext, 'num_tickets'):
+        # python 3.8 and newer
+        sslcontext.num_tickets = session_tickets
     return sslcontext
 
 
+class _HandshakeProtocol(asyncio.Protocol):
+    """
+    the protocol of an accepted tcp connection until its tls handshake may start,
+    the client hello waits in the socket meanwhile
+    """
+
+    def __init__(self, server):
+        self._server = server
+        self.accepted = time.monotonic()
+        self.lost = False
+
+    def connection_made(self, transport):
+        if not self._server.admit(transport):
+            return
+        transport.pause_reading()
+        asyncio.ensure_future(self._server.start_tls(transport, self))
+
+    def connection_lost(self, exc):
+        self.lost = True
+
+
+class Connection():
+    """
+    the state of a single client connection
+    framed connections exchange length-prefixed messages, legacy
+    connections exchange raw pickled messages
+    the codec (pickle or binary), whether acks carry a flow control
+    window (credit) and whether they are coalesced selective acks (sack)
+    are negotiated by framed connections
+    """
+
+    def __init__(self, reader, writer, session, framed=False, msg_codec=codec.PICKLE, credit=False, sack=False):
+        self.reader = reader
+        self.writer = writer
+        self.session = session
+        self.framed = framed
+        self.codec = msg_codec
+        self.credit = credit
+        self.sack = sack
+        # time.monotonic() when the message handled now has been received
+        self.received = None
+        # the selective ack waiting to be sent, when the first message it answers has been received,
+        # the number of messages it answers and the timer sending it
+        self.pending_ack = None
+        self.pending_received = None
+        self.coalesced = 0
+        self.ack_handle = None
+        # the framing.FrameReader of a framed connection
+        self.frame_reader = None
+        # loop.time() since the connection waits for the next message, None while a message is handled
+        self.idle_since = None
+
+    def cancel_ack(self):
+        if self.ack_handle is not None:
+            self.ack_handle.cancel()
+            self.ack_handle = None
+
+    def write_msg(self, msg):
+        """
+        encodes msg and writes it in the format of the connection
+        :param msg: subclass of GeneralMessage
+        """
+        payload = self.codec.encode(msg)
+        if self.framed:
+            payload = framing.encode_frame(payload)
+        self.writer.write(payload)
+
+    @asyncio.coroutine
+    def drain(self):
+        yield from self.writer.drain()
+
+    def buffered(self):
+        """
+        :return: (int) bytes buffered for the connection, read and not handled yet or
+        not written yet, the read buffer of the tls layer aside
+        """
+        size = len(self.reader._buffer) + self.writer.transport.get_write_buffer_size()
+        if self.frame_reader is not None:
+            size += self.frame_reader.buffered()
+        return size
+
+
 class Server():
     """
     a class for communication through ssl on NonBlocking IO
-    receives measurement data from clients and pushes them into
-    shared queues to be consumed by other classes
+    receives measurement data from clients and publishes them on
+    a shared bus (util.bus.BatchBus in memory or util.spool.SpoolWriter
+    on disk) to be consumed by other classes
     """
 
-    def __init__(self, sslcontext, storage_queue, carbon_queue, expireed_certs, host="localhost", port=1234):
+    def __init__(self, sslcontext, bus, expireed_certs, host="localhost", port=1234,
+                 max_frame_size=framing.DEFAULT_MAX_FRAME_SIZE, max_gap_span=DEFAULT_MAX_GAP_SPAN,
+                 worker_id=0, reuse_port=False, session_store=None, stats_interval=60, sync_delay=0.005,
+                 flow_control=None, process_metrics=None, max_handshakes=DEFAULT_MAX_HANDSHAKES,
+                 handshake_timeout=DEFAULT_HANDSHAKE_TIMEOUT, dedup_index=None, selective_acks=False,
+                 ack_delay=DEFAULT_ACK_DELAY, ack_coalesce=DEFAULT_ACK_COALESCE, session_checkpoint=None,
+                 checkpoint_interval=DEFAULT_CHECKPOINT_INTERVAL, session_states=None,
+                 shutdown_timeout=DEFAULT_SHUTDOWN_TIMEOUT, idle_timeout=DEFAULT_IDLE_TIMEOUT,
+                 max_connections=0, max_client_connections=0, read_buffer_size=DEFAULT_READ_BUFFER_SIZE,
+                 socket_buffer_size=0, publish_timeout=DEFAULT_PUBLISH_TIMEOUT):
         self._host = host
         self._port = port
+        # several worker processes share the port with SO_REUSEPORT
+        self._worker_id = worker_id
+        self._reuse_port = reuse_port
+        self._max_frame_size = max_frame_size
         self._sslcontext = sslcontext
         self._server = None
         self._data = None
 
         # asyncio loop
         self._loop = None
-        self._storage_queue = storage_queue
-        self._carbon_queue = carbon_queue
+        self._bus = bus
+
+        # measurements published on a durable bus are synced in groups
+        self._sync_delay = sync_delay
+        self._sync_future = None
+        # seconds a message waits for space on a full bus, then the client sends it again
+        self._publish_timeout = publish_timeout
 
-        # a list containing serial numbers of expired certificates
+        # flow.FlowControl throttling the clients while the sinks lag behind, None accepts at full speed
+        self._flow = flow_control
+
+        # the serial numbers of expired certificates, a util.revocation.RevokedSerials
+        # reloading them or a plain collection
+        if isinstance(expireed_certs, (list, tuple)):
+            expireed_certs = set(expireed_certs)
         self._expired_certs = expireed_certs
 
-        # parameters for checking the messages
-        # which have not been received
-        self._not_received_list = []
-        self._last_received = 0
+        # a reconnecting fleet can not hog the loop with handshakes, at most
+        # max_handshakes run at once, the others wait before their first byte is read
+        self._max_handshakes = max_handshakes
+        self._handshake_timeout = handshake_timeout
+        self._handshakes = None
+
+        # the ids of the measurements published recently (util.dedup), a replayed
+        # measurement is acknowledged but not published again, None publishes everything
+        self._dedup = dedup_index
+
+        # clients negotiating framing.FEATURE_SACK get one cumulative ack with all missing
+        # ranges per ack_delay seconds or ack_coalesce messages, the others one ack per message
+        self._selective_acks = selective_acks
+        self._ack_delay = ack_delay
+        self._ack_coalesce = ack_coalesce
+
+        # sequence tracking of the clients, keyed by
+        # the serial number of their certificates
+        self._sessions = SessionRegistry(max_gap_span, session_store)
+        if session_states:
+            self._sessions.load(session_states)
+
+        # the sessions are written to a session.SessionCheckpoint every checkpoint_interval
+        # seconds and when the server stops, None keeps them in memory only
+        self._checkpoint = session_checkpoint
+        self._checkpoint_interval = checkpoint_interval
+        self._checkpoint_future = None
+        # the worker writing the sessions of the disconnected clients in the shared store as well
+        self._checkpoint_store = session_store is not None and worker_id == 0
+
+        # the open connections, drained by a stopping server within shutdown_timeout seconds
+        self._connections = set()
+        self._shutdown_timeout = shutdown_timeout
+
+        # the connections of each certificate serial, a client opening more than max_client_connections
+        # connections has lost the older ones (half-open after a power loss), they are closed
+        self._clients = {}
+        self._max_client_connections = max_client_connections
+        # connections in the tls handshake or waiting for it, a new tcp connection is refused
+        # while that many and the open connections reach max_connections, 0 for no limit
+        self._handshaking = 0
+        self._max_connections = max_connections
+        # connections waiting idle_timeout seconds for a message are closed, 0 keeps them open
+        self._idle_timeout = idle_timeout
+
+        # the memory of a connection: its StreamReader buffers read_buffer_size bytes before reading
+        # pauses and the socket buffers of the kernel (0 keeps the default of the system)
+        self._read_buffer_size = read_buffer_size
+        self._socket_buffer_size = socket_buffer_size
+
+        # counters and latencies of this worker (util.metrics.ProcessMetrics),
+        # the throughput is also logged every stats_interval seconds
+        self._metrics = process_metrics if process_metrics is not None else metrics.local()
+        self._stats_interval = stats_interval
+        self._last_report = (0, 0)
+
+    def create_protocol(self):
+        """
+        the protocol of a new connection, created when the tcp connection
+        is accepted, client_connected is called after the tls handshake
+        """
+        return self.create_stream_protocol(time.monotonic())
+
+    def create_stream_protocol(self, accepted):
+        """
+        :param accepted: time.monotonic() when the tcp connection has been accepted
+        """
+        def connected(reader, writer):
+            if self._handshakes is None and not self.admit(writer.transport):
+                # the handshake has been done by asyncio, the connection is refused now
+                return None
+            self._metrics.since('tls_accept', accepted)
+            ssl_object = writer.get_extra_info('ssl_object')
+            if ssl_object is not None and ssl_object.session_reused:
+                self._metrics.incr('tls_resumed')
+            return self.client_connected(reader, writer)
+
+        return asyncio.StreamReaderProtocol(asyncio.StreamReader(limit=self._read_buffer_size), connected)
+
+    def admit(self, transport):
+        """
+        refuses a new connection if max_connections are open
+        :param transport: the transport of the new connection
+        :return: True if the connection has been admitted
+        """
+        if self._max_connections and len(self._connections) + self._handshaking >= self._max_connections:
+            _logger.warn("#warn:refusing-connection-%s-connections-open", len(self._connections))
+            self._metrics.incr('refused')
+            transport.abort()
+            return False
+        if self._socket_buffer_size:
+            sock = transport.get_extra_info('socket')
+            if sock is not None:
+                sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, self._socket_buffer_size)
+                sock.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, self._socket_buffer_size)
+        if self._handshakes is not None:
+            self._handshaking += 1
+        return True
+
+    def create_handshake_protocol(self):
+        """
+        the protocol of a new connection on the plain tcp server, the tls handshake
+        is started by start_tls once a slot is free
+        """
+        return _HandshakeProtocol(self)
+
+    @asyncio.coroutine
+    def start_tls(self, transport, handshake):
+        """
+        waits for a free handshake slot and upgrades the connection to tls
+        :param handshake: the _HandshakeProtocol of the connection
+        """
+        yield from self._handshakes.acquire()
+        try:
+            if handshake.lost or transport.is_closing():
+                # the client gave up while waiting
+                return
+            protocol = self.create_stream_protocol(handshake.accepted)
+            try:
+                tls_transport = yield from self._loop.start_tls(transport, protocol, self._sslcontext,
+                                                                server_side=True,
+                                                                ssl_handshake_timeout=self._handshake_timeout)
+            except (ssl.SSLError, OSError, asyncio.TimeoutError) as e:
+                _logger.debug("#debug:tls-handshake-failed:%s", e)
+                self._metrics.incr('tls_failed')
+                transport.abort()
+                return
+        finally:
+            self._handshakes.release()
+            self._handshaking -= 1
+        protocol.connection_made(tls_transport)
 
     @asyncio.coroutine
     def client_connected(self, reader, writer):
@@ -73,162 +355,546 @@ class Server():
             return
 
         # handling messages from certified clients
-        _logger.info("#info:connection-stablished#peercert:%s" % (writer.get_extra_info("socket").getpeercert()))
+        _logger.info("#info:connection-stablished#peercert:%s" % certDict)
+        self._metrics.incr('accepted')
+        self._metrics.add('connections', 1)
+
+        serial = certDict['serialNumber']
+        conn = Connection(reader, writer, self._sessions.get(serial))
+        conn.idle_since = self._loop.time()
+        self.close_duplicates(serial)
+        self._connections.add(conn)
+        self._clients.setdefault(serial, []).append(conn)
+        try:
+            try:
+                head = yield from reader.readexactly(framing.PREAMBLE_SIZE)
+            except asyncio.IncompleteReadError as e:
+                # the client sent less than a preamble and hung up
+                head = e.partial
+                if not head:
+                    return
+
+            version = framing.parse_preamble(head)
+            if version is None:
+                _logger.debug("#debug:legacy-client-without-framing")
+                yield from self.handle_legacy_client(conn, head)
+            else:
+                version = min(version, framing.VERSION)
+                features = 0
+                if version >= 2:
+                    features = (yield from reader.readexactly(1))[0] & framing.FEATURES
+                if self._flow is None:
+                    features &= ~framing.FEATURE_CREDIT
+                if not self._selective_acks:
+                    features &= ~framing.FEATURE_SACK
+                conn.framed = True
+                conn.codec = codec.BINARY if features & framing.FEATURE_BINARY else codec.PICKLE
+                conn.credit = bool(features & framing.FEATURE_CREDIT)
+                conn.sack = bool(features & framing.FEATURE_SACK)
+                _logger.debug("#debug:framed-client-version:%s-codec:%s-credit:%s-sack:%s",
+                              version, conn.codec.name, conn.credit, conn.sack)
+                writer.write(framing.encode_preamble(version, features))
+                yield from self.handle_framed_client(conn)
+        finally:
+            # a coalesced ack is not sent anymore, the client sends the messages again
+            conn.cancel_ack()
+            self._connections.discard(conn)
+            connections = self._clients[serial]
+            connections.remove(conn)
+            if not connections:
+                # the session stays with the last connection of the client
+                del self._clients[serial]
+                self._sessions.release(serial)
+            self._metrics.add('connections', -1)
+            writer.close()
 
+    def close_duplicates(self, serial):
+        """
+        closes the oldest connections of a client, which opens more than max_client_connections
+        :param serial: serial number of the certificate of the client
+        """
+        if not self._max_client_connections:
+            return
+        connections = [conn for conn in self._clients.get(serial, ()) if not conn.writer.transport.is_closing()]
+        for conn in connections[:len(connections) - self._max_client_connections + 1]:
+            _logger.info("#info:closing-duplicate-connection-of-client:%s", serial)
+            self._metrics.incr('duplicate_connections')
+            conn.writer.transport.abort()
+
+    def close_idle(self):
+        """
+        aborts the connections waiting idle_timeout seconds for a message and schedules the next check,
+        the connection of a device which lost power stays half-open until then
+        """
+        self._loop.call_later(self._idle_timeout / 4, self.close_idle)
+        deadline = self._loop.time() - self._idle_timeout
+        for conn in [conn for conn in self._connections if conn.idle_since is not None and conn.idle_since < deadline]:
+            _logger.info("#info:closing-idle-connection-of-client:%s", conn.session.serial)
+            self._metrics.incr('idle_closed')
+            conn.writer.transport.abort()
+
+    @asyncio.coroutine
+    def handle_framed_client(self, conn):
+        """
+        reads length-prefixed messages until the client disconnects
+        :param conn: Connection
+        """
+        frame_reader = conn.frame_reader = framing.FrameReader(conn.reader, self._max_frame_size,
+                                                               self._read_buffer_size)
         while True:
+            yield from self.wait_flow()
+            conn.idle_since = self._loop.time()
             try:
-
-                # wait to receive a message from the client
-                rec = yield from reader.read(1000)
-                if not rec:
+                frames = yield from frame_reader.read_frames()
+            except (asyncio.IncompleteReadError, ConnectionError):
+                break
+            except framing.FrameTooLarge as e:
+                # the stream can not be resynchronized after an oversized header
+                _logger.error("#error:frame-too-large-closing-connection:%s" % e)
+                break
+            conn.idle_since = None
+            if not frames:
+                break
+
+            for rec in frames:
+                yield from self.handle_msg(rec, conn)
+            if conn.sack:
+                # the coalesced acks are written without waiting, the client has to read them
+                try:
+                    yield from conn.drain()
+                except ConnectionError:
                     break
 
-                # analyze the message and send ack
-                data = yield from self.analyze_msg(rec, writer)
+    @asyncio.coroutine
+    def handle_legacy_client(self, conn, head):
+        """
+        legacy clients send one pickled message per write, so every read
+        is handed to the unpickler as a whole message
+        :param conn: Connection
+        :param head: (bytes) the first bytes of the message, read while looking for a preamble
+        """
+        while True:
+            yield from self.wait_flow()
+            conn.idle_since = self._loop.time()
+            try:
+                rec = yield from conn.reader.read(1000)
+            except ConnectionError:
+                break
+            conn.idle_since = None
+            rec = head + rec
+            head = b''
+            if not rec:
+                break
+            yield from self.handle_msg(rec, conn)
 
-                # the message received is useful
-                # push it into queues
-                if data:
-                    self.push_into_queues(data)
-            except KeyboardInterrupt:
-                return
-            except Exception as e:
-                _logger.error("#error:error-while-handling-msg:%s" % rec)
-                _logger.debug("#debug:size-of-msg:%s" % len(rec))
-                _logger.exception(e)
-                continue
+    @asyncio.coroutine
+    def handle_msg(self, rec, conn):
+        try:
+            # analyze the message, publish it and send ack
+            self._metrics.incr('messages')
+            conn.received = time.monotonic()
+            yield from self.analyze_msg(rec, conn)
+        except KeyboardInterrupt:
+            raise
+        except Exception as e:
+            _logger.error("#error:error-while-handling-msg:%s" % rec)
+            _logger.debug("#debug:size-of-msg:%s", len(rec))
+            _logger.exception(e)
 
     @asyncio.coroutine
-    def analyze_msg(self, byte_msg, writer):
+    def analyze_msg(self, byte_msg, conn):
         """
         Analyzes a message received from the client to see
         if its a new message, a wanted message, or already seen message
         sends an acknowledgment if necessary
         :param byte_msg: (bytes)
-        :param writer:
+        :param conn: Connection
         :return: (list) the content of the message, which is a list
         """
         try:
-            msg = pickle.loads(byte_msg)
+            start = time.monotonic()
+            msg = conn.codec.decode(byte_msg)
+            self._metrics.since('decode', start)
+        except (pickle.UnpicklingError, struct.error, ValueError, KeyError, EOFError) as e:
+            self._metrics.incr('decode_errors')
+            _logger.error("#error:while-decoding-msg-size:%s" % len(byte_msg))
+            _logger.debug("#debug:problematic-msg:%r", byte_msg)
+            _logger.exception(e)
+            return None
 
+        try:
             # msg must be subclass of GeneralMessage
             if msg.get_type() == 'measurement':
-                return self.handle_measurement_msg(msg, writer)
+                return (yield from self.handle_measurement_msg(msg, conn))
             elif msg.get_type() == 'request':
-                return self.handle_request(msg)
+                return self.handle_request(msg, conn)
             else:
-                _logger.warn("#warn:unexpected-message-type%s" % msg.get_type())
-        except pickle.UnpicklingError as e:
-            _logger.error("#error:while-unpickling-msg-size:%s" % len(byte_msg))
-            _logger.debug("#debug:problematic-msg:%s" % str(byte_msg))
-            _logger.exception(e)
-            return None
+                _logger.warn("#warn:unexpected-message-type%s", msg.get_type())
         except KeyError as e:
             _logger.error("#error:corrupted-msg-%s" % msg)
         except AttributeError as e:
             _logger.error("#error:message-is-corrupted-%s" % msg)
 
-    def handle_measurement_msg(self, msg, writer):
+    @asyncio.coroutine
+    def handle_measurement_msg(self, msg, conn):
 
         try:
             msg_id = msg.get_id()
+            session = conn.session
 
             # check if we miss some messages
             # since the last msg received
-            if msg_id > self._last_received:
-                for i in range(self._last_received+1, msg_id):
-                    self._not_received_list.append(i)
-
-                _logger.debug("#debug:not-received_list-updated:%s" % self._not_received_list)
+            if msg_id > session.last_received:
+                session.received_new(msg_id)
 
-                # updating last_received msg id
-                self._last_received = msg_id
+                _logger.debug("#debug:not-received-updated:%s", session.not_received)
 
-                # sending acknowledgment
-                yield from self.send_ack(msg_id, writer)
+                # publishing and sending acknowledgment
+                yield from self.accept_tracked(msg_id, msg.get_data(), conn)
                 return msg.get_data()
 
             # a requested message arrived! remove it
             # from the wanted list
-            elif msg_id < self._last_received:
-                if msg_id in self._not_received_list:
+            elif msg_id < session.last_received:
+                if session.received_wanted(msg_id):
 
                     # The client send an empty data with msg_id
                     # which means the client does not have that
                     # msg anymore
                     if not msg.get_data():
-                        _logger.warn("#warn:msg:%s-is-completely-lost!-client-sent-None" % msg_id)
-
-                        # removing from wanted list
-                        self._not_received_list.remove(msg_id)
+                        _logger.warn("#warn:msg:%s-is-completely-lost!-client-sent-None", msg_id)
                         return None
 
                     else:
-                        self._not_received_list.remove(msg_id)
-                        _logger.debug("#debug:Finally!-received-msg-with-id: %s" % msg_id)
+                        _logger.debug("#debug:Finally!-received-msg-with-id: %s", msg_id)
 
-                        # sending acknowledgment
-                        yield from self.send_ack(msg_id, writer)
+                        # publishing and sending acknowledgment
+                        yield from self.accept_tracked(msg_id, msg.get_data(), conn)
                         return msg.get_data()
 
                 else:
-                    _logger.debug("#debig:msg_id:%s:-is-<-last_received-but-not-in-not_received-list" % msg_id)
+                    _logger.debug("#debig:msg_id:%s:-is-<-last_received-but-not-in-not_received-list", msg_id)
                     # requesting to get msg counter of the client
-                    yield from self.send_request(writer)
+                    yield from self.send_request(conn)
 
         except KeyError as e:
             _logger.warn("#warn:corrupted-message!")
             _logger.exception(e)
             return None
 
-    def handle_request(self, msg):
+    def handle_request(self, msg, conn):
         if msg.get_request() == 'GET_MSG_COUNTER':
-            self._last_received = msg.get_response() - 1
+            conn.session.set_counter(msg.get_response())
         else:
-            _logger.debug("#debug:unknown-request-%s: " % msg.get_request())
+            _logger.debug("#debug:unknown-request-%s: ", msg.get_request())
+
+    @asyncio.coroutine
+    def accept_tracked(self, msg_id, data, conn):
+        """
+        accept, while the session marks msg_id as accepting, so that a
+        checkpoint taken meanwhile counts the message as not received
+        """
+        conn.session.accepting = msg_id
+        try:
+            yield from self.accept(msg_id, data, conn)
+        except BusFull:
+            # not acknowledged, the client sends the message again
+            _logger.error("#error:bus-full-message-%s-not-accepted", msg_id)
+            conn.session.forget(msg_id)
+        finally:
+            # an aborted older connection of the client shares the session, it does not
+            # clear the message being accepted on the new one
+            if conn.session.accepting == msg_id:
+                conn.session.accepting = None
 
     @asyncio.coroutine
-    def send_ack(self, msg_id, writer):
+    def accept(self, msg_id, data, conn):
+        """
+        publishes the measurements of a message and acknowledges it,
+        with a durable bus the ack is sent once the measurements are on disk,
+        while the flow is closed the message and its ack are held back
+        :param msg_id: (int)
+        :param data: list of dictionaries (measurements)
+        :param conn: Connection
+        """
+        yield from self.wait_flow()
+        if data and self._dedup is not None:
+            data = self.drop_duplicates(data)
+        if data and (yield from self.publish(data)) and self._bus.durable:
+            yield from self.wait_durable()
+        yield from self.send_ack(msg_id, conn)
+
+    @asyncio.coroutine
+    def wait_flow(self):
+        """
+        waits while the sinks lag behind more than the high watermark
+        """
+        if self._flow is not None:
+            yield from self._flow.wait_open()
+
+    @asyncio.coroutine
+    def wait_durable(self):
+        """
+        waits until everything published so far is synced to disk,
+        the messages arriving within sync_delay share one sync
+        """
+        if self._sync_future is None:
+            self._sync_future = self._loop.create_future()
+            self._loop.call_later(self._sync_delay, self._sync)
+        yield from self._sync_future
+
+    def _sync(self):
+        future = self._sync_future
+        self._sync_future = None
+
+        def synced(done):
+            if done.exception() is not None:
+                future.set_exception(done.exception())
+            else:
+                future.set_result(None)
+
+        # the appends of the next group go on while the disk syncs
+        self._loop.run_in_executor(None, self._bus.sync).add_done_callback(synced)
+
+    @asyncio.coroutine
+    def send_ack(self, msg_id, conn):
         """
         sends an acknowledgment to the client
         :param msg_id: (int) the message that has been successfully received
-        :param writer:
+        :param conn: Connection
         """
 
+        if conn.sack:
+            self.coalesce_ack(conn)
+            return
+
         # check if there is a message which server missed
-        wanted = None
-        if len(self._not_received_list) > 0:
-            wanted = self._not_received_list[0]
+        wanted = conn.session.wanted()
 
         # creating and sending the acknowledgment message
-        ack = ackknowledgment.Acknowledgment(msg_id, wanted)
-        _logger.debug("#debug:sending-ack-%s" % ack)
-        byte_ack = pickle.dumps(ack)
-        writer.write(byte_ack)
-        yield from writer.drain()
+        window = self._flow.window() if conn.credit else None
+        ack = ackknowledgment.Acknowledgment(msg_id, wanted, window)
+        _logger.debug("#debug:sending-ack-%s", ack)
+        conn.write_msg(ack)
+        yield from conn.drain()
+        self._metrics.incr('acks')
+        if conn.received is not None:
+            self._metrics.since('ack', conn.received)
+
+    def coalesce_ack(self, conn):
+        """
+        updates the selective ack of the connection and sends it once ack_coalesce
+        messages are answered, otherwise ack_delay seconds after the first one
+        :param conn: Connection
+        """
+        session = conn.session
+        # taken now, a message received later is acked once it has been published as well
+        missing = session.missing(_MAX_SACK_RANGES + 1)
+        last = session.last_received
+        if len(missing) > _MAX_SACK_RANGES:
+            # nothing is said about the messages after the ranges listed
+            last = missing[_MAX_SACK_RANGES][0] - 1
+            missing = missing[:_MAX_SACK_RANGES]
+        window = self._flow.window() if conn.credit else None
+        conn.pending_ack = selective_ack.SelectiveAck(session.cumulative(), last, missing, window)
+        if conn.coalesced == 0:
+            conn.pending_received = conn.received
+        conn.coalesced += 1
+        if conn.coalesced >= self._ack_coalesce or not self._ack_delay:
+            self.flush_ack(conn)
+        elif conn.ack_handle is None:
+            conn.ack_handle = self._loop.call_later(self._ack_delay, self.flush_ack, conn)
+
+    def flush_ack(self, conn):
+        """
+        writes the selective ack of the connection, the reading loop drains the writer
+        :param conn: Connection
+        """
+        conn.cancel_ack()
+        ack = conn.pending_ack
+        if ack is None:
+            return
+        conn.pending_ack = None
+        conn.coalesced = 0
+        _logger.debug("#debug:sending-sack-%s", ack)
+        conn.write_msg(ack)
+        self._metrics.incr('acks')
+        if conn.pending_received is not None:
+            self._metrics.since('ack', conn.pending_received)
 
     @asyncio.coroutine
-    def send_request(self, writer, request='GET_MSG_COUNTER'):
+    def send_request(self, conn, request='GET_MSG_COUNTER'):
         req = requests.Request(request=request, data=None)
-        _logger.debug("#debug:sending-request-%s" % req)
-        byte_req = pickle.dumps(req)
-        writer.write(byte_req)
-        yield from writer.drain()
+        _logger.debug("#debug:sending-request-%s", req)
+        conn.write_msg(req)
+        yield from conn.drain()
+
+    def drop_duplicates(self, data):
+        """
+        :param data: list of dictionaries (measurements)
+        :return: the measurements whose id has not been seen recently
+        """
+        seen = self._dedup.seen
+        ids = set()
+        fresh = []
+        for measurement in data:
+            key = measurement.get('id')
+            if key is None:
+                fresh.append(measurement)
+            elif key not in ids and not seen(key, False):
+                # the ids are added to the index once they are published
+                ids.add(key)
+                fresh.append(measurement)
+        if len(fresh) < len(data):
+            self._metrics.incr('duplicates', len(data) - len(fresh))
+            _logger.debug("#debug:dropped-%s-duplicate-measurements", len(data) - len(fresh))
+        return fresh
 
-    def push_into_queues(self, data):
+    @asyncio.coroutine
+    def publish(self, data):
         """
-        pushes the items inside the data into shared queues
+        publishes the whole batch on the bus as a util.columnar.ColumnarBatch,
+        it is validated and serialized once and read by every consumer
+        while the bus is full the loop goes on and the batch is tried again,
+        for at most publish_timeout seconds
         :param data: list of dictionaries (measurements)
+        :return: True if any measurement has been published
+        :raise BusFull: if the bus stayed full
+        """
+        batch = columnar.ColumnarBatch.from_measurements(data)
+        self._metrics.incr('measurements', len(data))
+        if batch.rejected:
+            self._metrics.incr('rejected', batch.rejected)
+        if not len(batch):
+            return False
+        deadline = self._loop.time() + self._publish_timeout
+        while not self._bus.publish(batch, timeout=0):
+            if self._flow is not None:
+                # closes the flow, no more messages are read meanwhile
+                self._flow.update()
+            if self._loop.time() >= deadline:
+                raise BusFull('no space for %s measurements within %s seconds' % (len(batch), self._publish_timeout))
+            yield from asyncio.sleep(_PUBLISH_RETRY_DELAY)
+        if self._dedup is not None:
+            for columns in batch:
+                for key in columns.ids:
+                    if key is not None:
+                        self._dedup.seen(key)
+        if self._flow is not None:
+            self._flow.update()
+        return True
+
+    def report_stats(self):
+        """
+        logs the counters of this worker and schedules the next report
+        """
+        memory = self.connection_memory()
+        self._metrics.set('connection_memory', memory)
+        stats = dict((name, int(self._metrics.get(name)))
+                     for name in ('accepted', 'messages', 'measurements', 'throttled', 'duplicates'))
+        messages, measurements = self._last_report
+        _logger.info("#info:worker-%s-stats:accepted:%s:messages:%s:measurements:%s:messages/s:%.1f:measurements/s:%.1f:throttled:%s:duplicates:%s:connections:%s:connection-memory:%s" %
+                     (self._worker_id, stats['accepted'], stats['messages'], stats['measurements'],
+                      (stats['messages'] - messages) / self._stats_interval,
+                      (stats['measurements'] - measurements) / self._stats_interval,
+                      stats['throttled'], stats['duplicates'], len(self._connections), memory))
+        self._last_report = (stats['messages'], stats['measurements'])
+        self._loop.call_later(self._stats_interval, self.report_stats)
+
+    def connection_memory(self):
         """
-        for item in data:
-            self._storage_queue.put(copy.copy(item))
-            self._carbon_queue.put(copy.copy(item))
+        :return: (int) estimated bytes held by the open connections, their buffered data,
+        the socket buffers of the kernel aside
+        """
+        return sum(conn.buffered() for conn in self._connections)
+
+    def write_checkpoint(self):
+        """
+        writes the sessions to the checkpoint file in the background and schedules the next one,
+        the states are taken on the loop, so they match the acks sent so far
+        """
+        self._loop.call_later(self._checkpoint_interval, self.write_checkpoint)
+        if self._checkpoint_future is not None and not self._checkpoint_future.done():
+            # the disk is slow, the next checkpoint comes soon enough
+            return
+        live, released = self._sessions.states(), self.released_states()
+        self._checkpoint_future = self._loop.run_in_executor(None, self._checkpoint.write, live, released)
+        self._checkpoint_future.add_done_callback(self._checkpoint_written)
+
+    def _checkpoint_written(self, future):
+        if future.exception() is not None:
+            _logger.error("#error:writing-the-session-checkpoint-failed:%s", future.exception())
+
+    def released_states(self):
+        """
+        :return: the sessions of the disconnected clients written by this worker
+        """
+        if not self._checkpoint_store:
+            return None
+        try:
+            return self._sessions.stored()
+        except (EOFError, OSError) as e:
+            # the manager of the store is gone
+            _logger.error("#error:can-not-read-the-session-store:%s", e)
+            return None
+
+    @asyncio.coroutine
+    def shutdown(self):
+        """
+        stops accepting connections and reading messages, waits up to shutdown_timeout
+        seconds for the messages being accepted, sends their acks and writes the last checkpoint
+        """
+        self._server.close()
+        for conn in self._connections:
+            if not conn.writer.transport.is_closing():
+                conn.writer.transport.pause_reading()
+        deadline = self._loop.time() + self._shutdown_timeout
+        while any(conn.session.accepting is not None for conn in self._connections):
+            if self._loop.time() >= deadline:
+                _logger.warn("#warn:stopping-with-messages-not-acknowledged")
+                break
+            yield from asyncio.sleep(0.05)
+        for conn in list(self._connections):
+            if conn.sack:
+                self.flush_ack(conn)
+            try:
+                yield from asyncio.wait_for(conn.drain(), max(deadline - self._loop.time(), 0.1))
+            except (ConnectionError, asyncio.TimeoutError):
+                pass
+        if self._checkpoint is not None:
+            if self._checkpoint_future is not None:
+                yield from asyncio.wait([self._checkpoint_future])
+            try:
+                self._checkpoint.write(self._sessions.states(), self.released_states())
+                _logger.info("#info:worker-%s-wrote-%s-sessions-to-the-checkpoint" %
+                             (self._worker_id, len(self._sessions)))
+            except OSError as e:
+                _logger.error("#error:writing-the-session-checkpoint-failed:%s", e)
+        for conn in self._connections:
+            conn.writer.close()
 
     def run(self):
-        _logger.info('#info:starting-the-server-on-port-%s' % self._port)
+        _logger.info('#info:worker-%s-starting-the-server-on-port-%s' % (self._worker_id, self._port))
         self._loop = asyncio.get_event_loop()
-        coro = asyncio.start_server(self.client_connected, self._host, self._port, ssl=self._sslcontext)
+        if self._max_handshakes and hasattr(self._loop, 'start_tls'):
+            # python 3.7 and newer, the handshakes are limited
+            self._handshakes = asyncio.Semaphore(self._max_handshakes)
+            coro = self._loop.create_server(self.create_handshake_protocol, self._host, self._port,
+                                            reuse_port=self._reuse_port)
+        else:
+            coro = self._loop.create_server(self.create_protocol, self._host, self._port, ssl=self._sslcontext,
+                                            reuse_port=self._reuse_port)
         self._server = self._loop.run_until_complete(coro)
+        if self._flow is not None:
+            self._flow.start(self._loop)
+        if self._stats_interval:
+            self._loop.call_later(self._stats_interval, self.report_stats)
+        if self._idle_timeout:
+            self._loop.call_later(self._idle_timeout / 4, self.close_idle)
+        if self._checkpoint is not None and self._checkpoint_interval:
+            self._loop.call_later(self._checkpoint_interval, self.write_checkpoint)
+        # terminating the process stops the server the same way as ctrl-c
+        self._loop.add_signal_handler(signal.SIGTERM, self._loop.stop)
         try:
             self._loop.run_forever()
         except KeyboardInterrupt:
@@ -242,6 +908,6 @@ class Server():
 
     def disconnect(self):
         _logger.info("#info:disconnecting-the-server")
-        self._server.close()
+        self._loop.run_until_complete(self.shutdown())
         self._loop.run_until_complete(self._server.wait_closed())
         self._loop.close()
@@ -0,0 +1,293 @@
+import json
+import logging
+import os
+from util.interval_set import IntervalSet
+
+_logger = logging.getLogger(__name__)
+
+# how far behind the newest message id missing messages are still requested
+DEFAULT_MAX_GAP_SPAN = 100000
+
+# seconds between two checkpoints of the sessions
+DEFAULT_CHECKPOINT_INTERVAL = 5.0
+
+_CHECKPOINT_PREFIX = 'sessions-'
+_CHECKPOINT_SUFFIX = '.json'
+
+
+class ClientSession():
+    """
+    sequence tracking of a single client, identified by the
+    serial number of its certificate
+    keeps the id of the last message received and the ids of
+    the messages which have not been received yet
+    """
+
+    def __init__(self, serial, max_gap_span=DEFAULT_MAX_GAP_SPAN):
+        self.serial = serial
+        self.last_received = 0
+        self.not_received = IntervalSet()
+        self._max_gap_span = max_gap_span
+        # the id of the message being published and acknowledged now, None between two messages
+        self.accepting = None
+
+    def received_new(self, msg_id):
+        """
+        registers msg_id, which is newer than the last message received,
+        every id in between is marked as not received
+        :param msg_id: (int)
+        """
+        self.not_received.add_range(self.last_received + 1, msg_id - 1)
+        self.last_received = msg_id
+
+        # forget about the messages which are too old to be requested
+        dropped = self.not_received.discard_below(msg_id - self._max_gap_span)
+        if dropped:
+            _logger.warn("#warn:client-%s-gave-up-on-%s-missing-messages", self.serial, dropped)
+
+    def is_wanted(self, msg_id):
+        return msg_id in self.not_received
+
+    def received_wanted(self, msg_id):
+        """
+        removes msg_id from the not received messages
+        :return: True if the message was wanted
+        """
+        return self.not_received.remove(msg_id)
+
+    def wanted(self):
+        """
+        :return: (int) the oldest message id not received yet or None
+        """
+        return self.not_received.lowest()
+
+    def cumulative(self):
+        """
+        :return: (int) the message id up to which every message has been received
+        """
+        lowest = self.not_received.lowest()
+        return self.last_received if lowest is None else lowest - 1
+
+    def missing(self, limit=None):
+        """
+        :param limit: (int) at most that many ranges, the oldest ones
+        :return: list of (start, end) of the message ids not received yet
+        """
+        return self.not_received.ranges(limit)
+
+    def snapshot(self):
+        """
+        :return: (tuple) picklable state of the session
+        """
+        return self.last_received, self.not_received.ranges()
+
+    def checkpoint(self):
+        """
+        the state of snapshot, but the message being accepted counts as not received,
+        it may not be published when the server stops before acknowledging it
+        :return: (tuple) picklable state of the session
+        """
+        if self.accepting is None:
+            return self.snapshot()
+        return _without(self.snapshot(), self.accepting)
+
+    def forget(self, msg_id):
+        """
+        counts msg_id as not received again, e.g. when it could not be published,
+        so that the client sending it again is served
+        :param msg_id: (int)
+        """
+        self.restore(_without(self.snapshot(), msg_id))
+
+    def restore(self, state):
+        """
+        :param state: a tuple returned by snapshot
+        """
+        self.last_received, ranges = state
+        self.not_received.clear()
+        for start, end in ranges:
+            self.not_received.add_range(start, end)
+
+    def set_counter(self, counter):
+        """
+        synchronizes the session with the message counter of the client
+        :param counter: (int) the id of the next message the client will send
+        """
+        self.last_received = counter - 1
+        self.not_received.discard_below(counter - self._max_gap_span)
+
+
+def _without(state, msg_id):
+    """
+    :param state: a tuple returned by ClientSession.snapshot
+    :param msg_id: (int) a message received
+    :return: the state in which msg_id has not been received
+    """
+    last_received, ranges = state
+    if msg_id == last_received:
+        # back to the state before received_new, without the gap it opened
+        last_received = msg_id - 1
+        if ranges and ranges[-1][1] == last_received:
+            last_received = ranges.pop()[0] - 1
+        return last_received, ranges
+    not_received = IntervalSet()
+    for start, end in ranges:
+        not_received.add_range(start, end)
+    not_received.add_range(msg_id, msg_id)
+    return last_received, not_received.ranges()
+
+
+class SessionRegistry():
+    """
+    the sessions of all clients known to the server, sessions
+    stay in the registry when the client disconnects so that a
+    reconnecting client continues where it stopped
+    with a store shared between server processes, the session of a
+    disconnected client is moved to the store, so that it follows the
+    client to whichever process accepts its next connection
+    """
+
+    def __init__(self, max_gap_span=DEFAULT_MAX_GAP_SPAN, store=None):
+        """
+        :param max_gap_span: (int) see ClientSession
+        :param store: dict-like object shared between processes, e.g. a multiprocessing.Manager().dict()
+        """
+        self._sessions = {}
+        self._max_gap_span = max_gap_span
+        self._store = store
+
+    def get(self, serial):
+        """
+        :param serial: serial number of the client certificate
+        :return: ClientSession of the client, created if it does not exist
+        """
+        session = self._sessions.get(serial)
+        if session is None:
+            session = ClientSession(serial, self._max_gap_span)
+            if self._store is not None:
+                state = self._store.get(serial)
+                if state is not None:
+                    session.restore(state)
+            self._sessions[serial] = session
+        return session
+
+    def release(self, serial):
+        """
+        called when the client disconnects, hands the session over to the shared store
+        """
+        if self._store is None:
+            return
+        session = self._sessions.pop(serial, None)
+        if session is not None:
+            self._store[serial] = session.snapshot()
+
+    def states(self):
+        """
+        :return: dict of the checkpoints of the sessions of this process by serial number
+        """
+        return dict((serial, session.checkpoint()) for serial, session in self._sessions.items())
+
+    def stored(self):
+        """
+        :return: dict of the states in the shared store by serial number
+        """
+        if self._store is None:
+            return {}
+        return dict(self._store.items())
+
+    def load(self, states):
+        """
+        restores the sessions of a checkpoint, into the shared store if there is one
+        :param states: dict of states by serial number
+        """
+        if self._store is not None:
+            self._store.update(states)
+            return
+        for serial, state in states.items():
+            session = ClientSession(serial, self._max_gap_span)
+            session.restore(state)
+            self._sessions[serial] = session
+
+    def __len__(self):
+        return len(self._sessions)
+
+
+def checkpoint_name(worker_id):
+    """
+    :return: the name of the checkpoint file of a server worker
+    """
+    return '%s%s%s' % (_CHECKPOINT_PREFIX, worker_id, _CHECKPOINT_SUFFIX)
+
+
+class SessionCheckpoint():
+    """
+    the sessions of a server worker written to a small file from time to time and when the
+    server stops, so that a restarted server continues the sequence tracking of its clients
+    instead of starting at 0 and losing every gap
+    the file is replaced with an atomic rename, it holds the sessions of the worker (live)
+    and the sessions of the disconnected clients in the shared store (released)
+    """
+
+    def __init__(self, directory, worker_id=0):
+        self._directory = directory
+        self._path = os.path.join(directory, checkpoint_name(worker_id))
+        os.makedirs(directory, exist_ok=True)
+
+    def write(self, live, released=None):
+        """
+        :param live: dict of states by serial number, see SessionRegistry.states
+        :param released: dict of states by serial number, see SessionRegistry.stored
+        """
+        tmp = self._path + '.tmp'
+        with open(tmp, 'w') as fout:
+            json.dump({'live': live, 'released': released or {}}, fout)
+            fout.flush()
+            os.fsync(fout.fileno())
+        os.rename(tmp, self._path)
+
+
+def _newer(state, other):
+    return other is None or state[0] > other[0]
+
+
+def read_checkpoints(directory):
+    """
+    merges the checkpoint files of all workers, the state of a live session
+    wins over a released one, otherwise the one with the newest message
+    :param directory: the directory of the SessionCheckpoint files
+    :return: dict of states by serial number
+    """
+    live = {}
+    released = {}
+    if not os.path.isdir(directory):
+        return live
+    for name in sorted(os.listdir(directory)):
+        if not (name.startswith(_CHECKPOINT_PREFIX) and name.endswith(_CHECKPOINT_SUFFIX)):
+            continue
+        try:
+            with open(os.path.join(directory, name)) as fin:
+                checkpoint = json.load(fin)
+        except (OSError, ValueError) as e:
+            _logger.error("#error:can-not-read-session-checkpoint-%s:%s", name, e)
+            continue
+        for states, merged in ((checkpoint.get('live', {}), live), (checkpoint.get('released', {}), released)):
+            for serial, (last_received, ranges) in states.items():
+                state = (last_received, [tuple(r) for r in ranges])
+                if _newer(state, merged.get(serial)):
+                    merged[serial] = state
+    for serial, state in released.items():
+        live.setdefault(serial, state)
+    return live
+
+
+def remove_checkpoints(directory, workers):
+    """
+    removes the checkpoint files of the workers from workers on, left by a server running more workers
+    :param workers: (int) number of workers writing checkpoints now
+    """
+    if not os.path.isdir(directory):
+        return
+    current = set(checkpoint_name(worker_id) for worker_id in range(workers))
+    for name in os.listdir(directory):
+        if name.startswith(_CHECKPOINT_PREFIX) and name.endswith(_CHECKPOINT_SUFFIX) and name not in current:
+            os.remove(os.path.join(directory, name))
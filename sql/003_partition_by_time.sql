@@ -0,0 +1,113 @@
+-- Measurement tables partitioned by time (PostgreSQL 11 or newer)
+--
+-- ts becomes timestamp with time zone, the tables are partitioned by
+-- range of ts and indexed with BRIN, which stays tiny and cheap to keep
+-- up for append-only data in time order. The partitions themselves are
+-- created ahead and expired by the DatabaseManager, see [partitions] in
+-- server.config (dbmnger/partitions.py).
+--
+-- The old tables stored the time of day only, their rows can not be
+-- placed in time. They are kept as rfmpi_legacy, zigbeeplugs_legacy and,
+-- where it exists, temphum_legacy.
+--
+-- The primary key has to contain the partition key, a measurement
+-- is now unique by (id, ts). A retransmitted measurement carries the same
+-- ts and is still rejected as a duplicate.
+
+BEGIN;
+
+ALTER TABLE rfmpi RENAME TO rfmpi_legacy;
+ALTER TABLE rfmpi_legacy RENAME CONSTRAINT rfmpi_pk_id TO rfmpi_legacy_pk_id;
+ALTER INDEX rfmpi_asc_ts RENAME TO rfmpi_legacy_asc_ts;
+
+CREATE TABLE rfmpi
+(
+  id uuid NOT NULL,
+  deviceid uuid NOT NULL,
+  ts timestamp with time zone NOT NULL,
+  power1 numeric(8,3),
+  power2 numeric(8,3),
+  power3 numeric(8,3),
+  power4 numeric(8,3),
+  vrms numeric(8,3),
+  temp numeric(8,3),
+  CONSTRAINT rfmpi_pk_id_ts PRIMARY KEY (id, ts)
+) PARTITION BY RANGE (ts);
+ALTER TABLE rfmpi
+  OWNER TO i13mon;
+
+CREATE INDEX rfmpi_ts_brin
+  ON rfmpi
+  USING brin
+  (ts);
+
+
+ALTER TABLE zigbeeplugs RENAME TO zigbeeplugs_legacy;
+ALTER TABLE zigbeeplugs_legacy RENAME CONSTRAINT pkzigbeeplugs_id TO pkzigbeeplugs_legacy_id;
+ALTER INDEX zigbeeplugs_asc_ts RENAME TO zigbeeplugs_legacy_asc_ts;
+
+CREATE TABLE zigbeeplugs
+(
+  id uuid NOT NULL,
+  macaddress VARCHAR(24) NOT NULL,
+  ts timestamp with time zone NOT NULL,
+  load numeric(8,3),
+  irms numeric(8,3),
+  vrms numeric(8,3),
+  freq numeric(8,5),
+  pow VARCHAR(8),
+  work numeric(8,3),
+  CONSTRAINT pkzigbeeplugs_id_ts PRIMARY KEY (id, ts)
+) PARTITION BY RANGE (ts);
+ALTER TABLE zigbeeplugs
+  OWNER TO i13mon;
+
+CREATE INDEX zigbeeplugs_ts_brin
+  ON zigbeeplugs
+  USING brin
+  (ts);
+
+
+-- written by the DatabaseManager but missing in the scripts before, so it
+-- was created by hand where it exists and the names of its constraints and
+-- indexes are not known: every index is renamed, which renames the
+-- constraint it belongs to as well
+DO $$
+DECLARE
+  idx record;
+BEGIN
+  IF to_regclass('temphum') IS NOT NULL THEN
+    ALTER TABLE temphum RENAME TO temphum_legacy;
+    FOR idx IN SELECT c.relname
+               FROM pg_index i JOIN pg_class c ON c.oid = i.indexrelid
+               WHERE i.indrelid = 'temphum_legacy'::regclass
+    LOOP
+      EXECUTE format('ALTER INDEX %I RENAME TO %I', idx.relname,
+                     CASE WHEN idx.relname LIKE 'temphum%'
+                          THEN 'temphum_legacy' || substr(idx.relname, 8)
+                          ELSE idx.relname || '_legacy' END);
+    END LOOP;
+  END IF;
+END
+$$;
+
+CREATE TABLE temphum
+(
+  id uuid NOT NULL,
+  deviceid uuid NOT NULL,
+  ts timestamp with time zone NOT NULL,
+  temperature numeric(8,3),
+  externaltemp numeric(8,3),
+  humidity numeric(8,3),
+  battery numeric(8,3),
+  CONSTRAINT temphum_pk_id_ts PRIMARY KEY (id, ts)
+) PARTITION BY RANGE (ts);
+ALTER TABLE temphum
+  OWNER TO i13mon;
+
+CREATE INDEX temphum_ts_brin
+  ON temphum
+  USING brin
+  (ts);
+
+COMMIT;
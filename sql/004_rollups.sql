@@ -0,0 +1,54 @@
+-- Per device rollups of the measurements by minute and by hour
+--
+-- One row per device, metric (the column of the raw table) and time
+-- bucket. The DatabaseManager upserts them in the transaction writing the
+-- raw rows (dbmnger/rollups.py), python -m dbmnger.rollups rebuilds them
+-- for a time range from the raw tables. last is the value with the
+-- latest ts of the bucket, last_ts that ts; null values are not counted.
+
+BEGIN;
+
+CREATE TABLE rollup_minute
+(
+  device VARCHAR(36) NOT NULL,
+  metric VARCHAR(24) NOT NULL,
+  bucket timestamp with time zone NOT NULL,
+  count bigint NOT NULL,
+  sum double precision NOT NULL,
+  min double precision NOT NULL,
+  max double precision NOT NULL,
+  last double precision NOT NULL,
+  last_ts timestamp with time zone NOT NULL,
+  CONSTRAINT rollup_minute_pk PRIMARY KEY (device, metric, bucket)
+);
+ALTER TABLE rollup_minute
+  OWNER TO i13mon;
+
+CREATE INDEX rollup_minute_bucket
+  ON rollup_minute
+  USING brin
+  (bucket);
+
+
+CREATE TABLE rollup_hour
+(
+  device VARCHAR(36) NOT NULL,
+  metric VARCHAR(24) NOT NULL,
+  bucket timestamp with time zone NOT NULL,
+  count bigint NOT NULL,
+  sum double precision NOT NULL,
+  min double precision NOT NULL,
+  max double precision NOT NULL,
+  last double precision NOT NULL,
+  last_ts timestamp with time zone NOT NULL,
+  CONSTRAINT rollup_hour_pk PRIMARY KEY (device, metric, bucket)
+);
+ALTER TABLE rollup_hour
+  OWNER TO i13mon;
+
+CREATE INDEX rollup_hour_bucket
+  ON rollup_hour
+  USING brin
+  (bucket);
+
+COMMIT;
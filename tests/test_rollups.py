@@ -0,0 +1,51 @@
+import datetime
+import unittest
+from dbmnger import rollups
+
+_COLUMNS = ['id', 'deviceid', 'ts', 'power1', 'power2', 'power3', 'power4', 'vrms', 'temp']
+
+# 2016-01-01 11:00:05 utc
+_INSTANT = datetime.datetime(2016, 1, 1, 11, 0, 5, tzinfo=datetime.timezone.utc)
+
+
+def _row(ts, power1, device='d1'):
+    return (1, device, ts, power1, None, None, None, None, None)
+
+
+class AggregateTest(unittest.TestCase):
+
+    def test_mixed_timestamps_share_a_bucket(self):
+        naive_local = (_INSTANT + datetime.timedelta(seconds=10)).astimezone().replace(tzinfo=None)
+        rows = [_row(_INSTANT, 1.0),
+                _row('2016-01-01 12:00:10+01:00', 2.0),
+                _row('2016-01-01T11:00:20Z', 4.0),
+                _row(naive_local.strftime('%Y-%m-%d %H:%M:%S.%f'), 8.0),
+                _row(naive_local + datetime.timedelta(seconds=20), 3.0)]
+        minutes = rollups.aggregate([('rfmpi', _COLUMNS, rows)])
+        self.assertEqual(len(minutes), 1)
+        (device, metric, bucket), (count, total, minimum, maximum, last, last_ts) = list(minutes.items())[0]
+        self.assertEqual((device, metric), ('d1', 'power1'))
+        self.assertEqual(bucket, _INSTANT.replace(second=0))
+        self.assertEqual((count, total, minimum, maximum), (5, 18.0, 1.0, 8.0))
+        self.assertEqual((last, last_ts), (3.0, _INSTANT + datetime.timedelta(seconds=30)))
+
+    def test_hour_rollups_of_string_timestamps(self):
+        rows = [_row('2016-01-01T11:00:05Z', 1.0), _row('2016-01-01T11:59:00Z', 2.0),
+                _row('2016-01-01T12:00:00Z', 4.0)]
+        hours = rollups.coarsen(rollups.aggregate([('rfmpi', _COLUMNS, rows)]), rollups.GRANULARITY_HOUR)
+        counts = dict((bucket, rollup[0]) for (_, _, bucket), rollup in hours.items())
+        # local hours, which are not utc hours in every time zone
+        expected = {}
+        for ts in (row[2] for row in rows):
+            bucket = rollups.truncate(rollups.local_time(ts), rollups.GRANULARITY_HOUR)
+            expected[bucket] = expected.get(bucket, 0) + 1
+        self.assertEqual(counts, expected)
+        self.assertEqual(sum(counts.values()), 3)
+
+    def test_rows_without_ts_are_skipped(self):
+        minutes = rollups.aggregate([('rfmpi', _COLUMNS, [_row(None, 1.0)])])
+        self.assertEqual(minutes, {})
+
+
+if __name__ == '__main__':
+    unittest.main()
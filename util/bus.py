@@ -0,0 +1,220 @@
+"""
+The bus between the server and the processes consuming the measurements.
+
+Every batch of measurements is pickled once and appended to a ring buffer
+in shared memory. Each sink reads the ring with its own cursor, so any
+number of sinks can consume the same bytes. The space of a batch is
+reused once every sink has committed past it.
+
+The process of each sink is registered with attach. A sink whose process
+has died is not waited for anymore, otherwise the ring would fill up and
+the server would stop for good.
+"""
+import ctypes
+import logging
+import multiprocessing
+import os
+import pickle
+import struct
+import time
+
+_logger = logging.getLogger(__name__)
+
+DEFAULT_CAPACITY = 64 * 1024 * 1024
+
+# seconds between two looks at the processes of the sinks
+_SINK_CHECK_INTERVAL = 1.0
+
+# length of the pickled batch and the time it was published
+_HEADER = struct.Struct('!Id')
+
+
+class BusFull(Exception):
+    """
+    raised by the server when a batch could not be published in time
+    """
+    pass
+
+
+def _alive(pid):
+    """
+    :return: False if the process pid has exited, a zombie waiting for its parent included
+    """
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    try:
+        with open('/proc/%d/stat' % pid) as fin:
+            return fin.read().rsplit(')', 1)[1].split()[0] != 'Z'
+    except (OSError, IndexError):
+        return True
+
+
+class BatchBus():
+    """
+    a ring buffer in shared memory with a write position and one
+    committed position per sink, positions grow monotonically and
+    are mapped into the ring modulo its capacity
+    """
+    durable = False
+
+    def __init__(self, sinks, capacity=DEFAULT_CAPACITY):
+        """
+        :param sinks: names of the sinks reading the bus
+        :param capacity: (int) size of the ring in bytes
+        """
+        self._capacity = capacity
+        self._ring = multiprocessing.RawArray(ctypes.c_char, capacity)
+        self._view = None
+        self._write_pos = multiprocessing.RawValue(ctypes.c_uint64, 0)
+        self._committed = dict((name, multiprocessing.RawValue(ctypes.c_uint64, 0)) for name in sinks)
+        self._cond = multiprocessing.Condition()
+        # the process id of every sink, 0 until attached
+        self._pids = dict((name, multiprocessing.RawValue(ctypes.c_int, 0)) for name in sinks)
+        # the sinks found dead by this process and when the processes have been checked last
+        self._dead = set()
+        self._checked = 0
+
+    def _buffer(self):
+        # the memoryview is created lazily, in the process using it
+        if self._view is None:
+            self._view = memoryview(self._ring).cast('B')
+        return self._view
+
+    def _copy_in(self, pos, data):
+        view = self._buffer()
+        start = pos % self._capacity
+        first = min(len(data), self._capacity - start)
+        view[start:start + first] = data[:first]
+        if first < len(data):
+            view[:len(data) - first] = data[first:]
+
+    def _copy_out(self, pos, size):
+        view = self._buffer()
+        start = pos % self._capacity
+        first = min(size, self._capacity - start)
+        data = view[start:start + first].tobytes()
+        if first < size:
+            data += view[:size - first].tobytes()
+        return data
+
+    def _free(self):
+        return self._capacity - (self._write_pos.value - self._min_committed())
+
+    def _min_committed(self):
+        committed = [value.value for name, value in self._committed.items() if name not in self._dead]
+        return min(committed) if committed else self._write_pos.value
+
+    def attach(self, sink, pid):
+        """
+        registers the process reading the bus as sink, the bus stops waiting for it once it dies
+        :param sink: name of the sink, as given to the constructor
+        :param pid: (int) id of the process of the sink
+        """
+        self._pids[sink].value = pid
+
+    def check_sinks(self):
+        """
+        looks for sinks whose process has died, at most once per _SINK_CHECK_INTERVAL seconds
+        """
+        now = time.monotonic()
+        if now - self._checked < _SINK_CHECK_INTERVAL:
+            return
+        self._checked = now
+        for name, pid in self._pids.items():
+            if name not in self._dead and pid.value and not _alive(pid.value):
+                _logger.error("#error:sink-%s-died-the-bus-does-not-wait-for-it-anymore", name)
+                self._dead.add(name)
+
+    def publish(self, batch, timeout=None):
+        """
+        appends a batch for all sinks, waits while the ring is full
+        :param batch: util.columnar.ColumnarBatch or list of measurements
+        :param timeout: (float) seconds to wait for free space, None waits forever
+        :return: True if the batch has been published
+        """
+        payload = pickle.dumps(batch, pickle.HIGHEST_PROTOCOL)
+        record = _HEADER.pack(len(payload), time.time()) + payload
+        if len(record) > self._capacity:
+            raise ValueError('batch of %s bytes does not fit into the bus' % len(record))
+
+        if self._free() < len(record):
+            self.check_sinks()
+        with self._cond:
+            if not self._cond.wait_for(lambda: self._free() >= len(record), timeout):
+                return False
+            pos = self._write_pos.value
+            self._copy_in(pos, record)
+            self._write_pos.value = pos + len(record)
+            self._cond.notify_all()
+        return True
+
+    def reader(self, sink):
+        """
+        :param sink: name of the sink, as given to the constructor
+        :return: BusReader of the sink
+        """
+        return BusReader(self, sink)
+
+    def lag(self, sink=None):
+        """
+        :return: (int) bytes published but not committed yet by sink, or by the slowest living sink
+        """
+        if sink is None:
+            self.check_sinks()
+            return self._write_pos.value - self._min_committed()
+        return self._write_pos.value - self._committed[sink].value
+
+    def capacity(self):
+        return self._capacity
+
+
+class BusReader():
+    """
+    the cursor of one sink
+    batches returned by get are released for reuse by commit
+    """
+    durable = False
+
+    def __init__(self, bus, sink):
+        self._bus = bus
+        self._sink = sink
+        self._committed = bus._committed[sink]
+        self._pos = None
+        # the time the batch returned last by get has been published
+        self.published = None
+
+    def get(self, timeout=None):
+        """
+        :param timeout: (float) seconds to wait for a batch, None waits forever
+        :return: the next batch or None if the timeout expired
+        """
+        bus = self._bus
+        with bus._cond:
+            if self._pos is None:
+                self._pos = self._committed.value
+            if not bus._cond.wait_for(lambda: bus._write_pos.value > self._pos, timeout):
+                return None
+
+        # the bytes up to the write position are not overwritten before we commit them
+        size, self.published = _HEADER.unpack(bus._copy_out(self._pos, _HEADER.size))
+        payload = bus._copy_out(self._pos + _HEADER.size, size)
+        self._pos += _HEADER.size + size
+        return pickle.loads(payload)
+
+    def commit(self, force=False):
+        """
+        releases every batch returned by get so far
+        :param force: only for compatibility with util.spool.SpoolReader, the ring is always released at once
+        """
+        if self._pos is None or self._committed.value == self._pos:
+            return
+        with self._bus._cond:
+            self._committed.value = self._pos
+            self._bus._cond.notify_all()
+
+    def lag(self):
+        return self._bus.lag(self._sink)
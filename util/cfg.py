@@ -3,12 +3,25 @@ import configparser
 __author__ = 'arash'
 
 
+CONFIG_FILE = 'server.config'
+
+
 def _get_config():
     config = configparser.ConfigParser()
-    config.read('server.config')
+    config.read(CONFIG_FILE)
     return config
 
 
+def _get_optional_section(name):
+    """
+    :return: the section name of the configuration or an empty dict if it is missing
+    """
+    config = _get_config()
+    if config.has_section(name):
+        return config[name]
+    return {}
+
+
 def get_db_config():
     return _get_config()['db']
 
@@ -25,4 +38,48 @@ def get_port():
 
 
 def get_expired_certificates():
-    return _get_config()['expired']
\ No newline at end of file
+    return _get_config()['expired']
+
+
+def get_dbwriter_config():
+    return _get_optional_section('dbwriter')
+
+
+def get_carbon_config():
+    return _get_optional_section('carbon')
+
+
+def get_bus_config():
+    return _get_optional_section('bus')
+
+
+def get_spool_config():
+    return _get_optional_section('spool')
+
+
+def get_logging_config():
+    return _get_optional_section('logging')
+
+
+def get_loggers_config():
+    return _get_optional_section('loggers')
+
+
+def get_metrics_config():
+    return _get_optional_section('metrics')
+
+
+def get_partitions_config():
+    return _get_optional_section('partitions')
+
+
+def get_rollups_config():
+    return _get_optional_section('rollups')
+
+
+def get_cache_config():
+    return _get_optional_section('cache')
+
+
+def get_dedup_config():
+    return _get_optional_section('dedup')
@@ -0,0 +1,187 @@
+"""
+The batches on the bus, one set of columns per measurement type.
+
+A server worker turns the measurements of a message into a ColumnarBatch
+once, before publishing it: the batch is grouped by type, the plug rule
+(POW=OFF with null readings) is checked and the timestamps are converted
+to seconds since the epoch. The sinks take the columns as they are, the
+database writes the rows of a table from them, carbon and the cache read
+the values of a device by index. A pickled batch repeats no dictionary
+keys and the times are one array('d').
+
+The sinks call columns_of on every batch read, so batches of measurement
+dictionaries, e.g. left in the spool by an older server, are read as well.
+"""
+import array
+import logging
+from util import utilities
+
+_logger = logging.getLogger(__name__)
+
+# the device key and the value keys of each measurement type, as in the measurement dictionaries
+TYPES = {
+    'power_measurement': ('deviceid', ('power1', 'power2', 'power3', 'power4', 'vrms', 'temp')),
+    'plug_measurement': ('mac_address', ('load', 'irms', 'vrms', 'freq', 'pow', 'work')),
+    'temp_hum_measurement': ('deviceid', ('temp', 'temp_external', 'humidity', 'battery')),
+}
+
+# the readings which are all null when a plug has been turned off
+_PLUG_READINGS = ('load', 'irms', 'vrms', 'freq', 'work')
+
+
+class TypeColumns():
+    """
+    the measurements of one type of a batch, one list per key
+    """
+
+    def __init__(self, type_name):
+        self.type_name = type_name
+        self.device_key, self.value_keys = TYPES[type_name]
+        self.ids = []
+        self.devices = []
+        # the timestamps as sent, written to the database as they are
+        self.ts = []
+        # the timestamps in seconds since the epoch
+        self.times = array.array('d')
+        self.values = dict((key, []) for key in self.value_keys)
+
+    def __len__(self):
+        return len(self.ids)
+
+    def append(self, data):
+        """
+        :param data: dictionary representing a measurement of this type
+        :raise KeyError: without id or device key, nothing is appended
+        :raise ValueError: for an unsupported timestamp, nothing is appended
+        """
+        msg_id, device, ts = data['id'], data[self.device_key], data.get('ts')
+        seconds = utilities.to_timestamp(ts)
+        self.ids.append(msg_id)
+        self.devices.append(device)
+        self.ts.append(ts)
+        self.times.append(seconds)
+        for key in self.value_keys:
+            self.values[key].append(data.get(key))
+
+    def column(self, key):
+        """
+        :param key: a key of the measurement dictionaries
+        :return: the list of its values
+        """
+        if key == 'id':
+            return self.ids
+        if key == self.device_key:
+            return self.devices
+        if key == 'ts':
+            return self.ts
+        return self.values[key]
+
+    def rows(self, keys):
+        """
+        :return: list of tuples, the values of keys of each measurement
+        """
+        return list(zip(*[self.column(key) for key in keys]))
+
+    def measurements(self):
+        """
+        :return: the measurements as dictionaries
+        """
+        keys = ('id', self.device_key, 'ts') + self.value_keys
+        measurements = []
+        for row in zip(*[self.column(key) for key in keys]):
+            data = dict(zip(keys, row))
+            data['type'] = self.type_name
+            measurements.append(data)
+        return measurements
+
+    def select(self, keep):
+        """
+        :param keep: list of booleans, one per measurement
+        :return: TypeColumns of the measurements kept
+        """
+        selected = TypeColumns(self.type_name)
+        selected.ids = [v for v, k in zip(self.ids, keep) if k]
+        selected.devices = [v for v, k in zip(self.devices, keep) if k]
+        selected.ts = [v for v, k in zip(self.ts, keep) if k]
+        selected.times = array.array('d', (v for v, k in zip(self.times, keep) if k))
+        for key in self.value_keys:
+            selected.values[key] = [v for v, k in zip(self.values[key], keep) if k]
+        return selected
+
+
+class ColumnarBatch():
+    """
+    the TypeColumns of a batch, measurements of unknown types, malformed ones (no id or device,
+    an unsupported timestamp) and turned off plugs are dropped
+    """
+
+    def __init__(self):
+        self.types = {}
+        # measurements dropped while building the batch
+        self.rejected = 0
+
+    def __len__(self):
+        return sum(len(columns) for columns in self.types.values())
+
+    def __iter__(self):
+        return iter(self.types.values())
+
+    def measurements(self):
+        """
+        :return: all measurements as dictionaries, grouped by type
+        """
+        return [data for columns in self for data in columns.measurements()]
+
+    @classmethod
+    def from_measurements(cls, batch):
+        """
+        :param batch: list of dictionaries (measurements)
+        :return: ColumnarBatch
+        """
+        columnar = cls()
+        for data in batch:
+            ty = data.get('type')
+            columns = columnar.types.get(ty)
+            if columns is None:
+                if ty not in TYPES:
+                    _logger.warn("#warn:unknown-datatype!-%s", ty)
+                    columnar.rejected += 1
+                    continue
+                columns = columnar.types[ty] = TypeColumns(ty)
+            try:
+                columns.append(data)
+            except (KeyError, ValueError, TypeError) as e:
+                # one malformed measurement does not lose the others of its message
+                _logger.warn("#warn:rejecting-malformed-%s:%r", ty, e)
+                columnar.rejected += 1
+        for ty in [ty for ty, columns in columnar.types.items() if not columns]:
+            del columnar.types[ty]
+        plugs = columnar.types.get('plug_measurement')
+        if plugs is not None:
+            keep = plugs_turned_on(plugs)
+            if not all(keep):
+                _logger.error("#error:zigbee-devices-have-been-turned-off-%s",
+                              sorted(set(device for device, k in zip(plugs.devices, keep) if not k)))
+                columnar.rejected += len(keep) - sum(keep)
+                columnar.types['plug_measurement'] = plugs.select(keep)
+        return columnar
+
+
+def plugs_turned_on(plugs):
+    """
+    the rule of utilities.check_plug_measurement on whole columns
+    :param plugs: TypeColumns of plug measurements
+    :return: list of booleans, False for a plug sending POW=OFF without readings
+    """
+    readings = [plugs.values[key] for key in _PLUG_READINGS]
+    return [all(values) or power != 'OFF' for power, values in zip(plugs.values['pow'], zip(*readings))]
+
+
+def columns_of(batch):
+    """
+    :param batch: a batch read from the bus, ColumnarBatch or list of dictionaries
+    :return: ColumnarBatch
+    """
+    if isinstance(batch, ColumnarBatch):
+        return batch
+    return ColumnarBatch.from_measurements(batch)
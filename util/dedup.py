@@ -0,0 +1,150 @@
+"""
+Indexes of the measurement ids seen recently, to drop replays before they
+are published to the sinks.
+
+LRUIndex remembers exactly the last capacity ids. BloomIndex needs far
+less memory per id, it keeps two generations of a Bloom filter, each
+sized for capacity ids at error_rate, and starts a new generation when
+the current one is full or older than interval seconds. An id is seen if
+either generation holds it, so an id is remembered for at least one
+generation. A false positive drops a new measurement, error_rate is the
+chance of that per id.
+"""
+import collections
+import hashlib
+import math
+import time
+import uuid
+
+MODE_LRU = 'lru'
+MODE_BLOOM = 'bloom'
+
+DEFAULT_CAPACITY = 100000
+DEFAULT_ERROR_RATE = 0.000001
+DEFAULT_INTERVAL = 600.0
+
+_MASK64 = (1 << 64) - 1
+
+
+class LRUIndex():
+    """
+    the last capacity ids, in the order they were seen last
+    """
+
+    def __init__(self, capacity=DEFAULT_CAPACITY):
+        self._capacity = capacity
+        self._ids = collections.OrderedDict()
+
+    def __len__(self):
+        return len(self._ids)
+
+    def seen(self, key, add=True):
+        """
+        :param add: False only looks the key up, e.g. before the measurement is published
+        :return: True if key has been seen before, otherwise it is added
+        """
+        if key in self._ids:
+            self._ids.move_to_end(key)
+            return True
+        if not add:
+            return False
+        self._ids[key] = None
+        if len(self._ids) > self._capacity:
+            self._ids.popitem(last=False)
+        return False
+
+
+def _hashes(key):
+    """
+    :return: two 64 bit hashes of key, a random uuid is used as it is
+    """
+    if isinstance(key, uuid.UUID):
+        value = key.int
+    else:
+        value = int.from_bytes(hashlib.blake2b(str(key).encode(), digest_size=16).digest(), 'big')
+    # odd, so that the probes cover the whole filter
+    return value & _MASK64, (value >> 64) | 1
+
+
+class BloomIndex():
+    """
+    two generations of a Bloom filter, the older one is dropped when a new one starts
+    """
+
+    def __init__(self, capacity=DEFAULT_CAPACITY, error_rate=DEFAULT_ERROR_RATE, interval=DEFAULT_INTERVAL):
+        """
+        :param capacity: (int) ids per generation
+        :param error_rate: (float) probability that a new id is taken as seen
+        :param interval: (float) seconds after which a new generation starts, 0 only when full
+        """
+        if not 0 < error_rate < 1:
+            raise ValueError('error rate must be between 0 and 1')
+        self._capacity = capacity
+        self._interval = interval
+        self._bits = max(8, int(math.ceil(-capacity * math.log(error_rate) / math.log(2) ** 2)))
+        self._probes = max(1, int(round(self._bits / capacity * math.log(2))))
+        self._current = bytearray((self._bits + 7) // 8)
+        self._previous = bytearray(len(self._current))
+        self._count = 0
+        self._started = time.monotonic()
+
+    def __len__(self):
+        return self._count
+
+    def size(self):
+        """
+        :return: (int) bytes of both generations
+        """
+        return len(self._current) + len(self._previous)
+
+    def _rotate(self):
+        self._previous = self._current
+        self._current = bytearray(len(self._previous))
+        self._count = 0
+        self._started = time.monotonic()
+
+    def seen(self, key, add=True):
+        """
+        :param add: False only looks the key up, e.g. before the measurement is published
+        :return: True if key has (probably) been seen before, otherwise it is added
+        """
+        if self._count >= self._capacity or (self._interval and time.monotonic() - self._started >= self._interval):
+            self._rotate()
+        h1, h2 = _hashes(key)
+        bits = self._bits
+        current = self._current
+        previous = self._previous
+        in_current = True
+        in_previous = True
+        positions = []
+        for i in range(self._probes):
+            position = (h1 + i * h2) % bits
+            mask = 1 << (position & 7)
+            index = position >> 3
+            if not current[index] & mask:
+                in_current = False
+            if not previous[index] & mask:
+                in_previous = False
+            positions.append((index, mask))
+        if in_current:
+            return True
+        if not add:
+            return in_previous
+        for index, mask in positions:
+            current[index] |= mask
+        self._count += 1
+        # an id of the previous generation is carried over into the current one
+        return in_previous
+
+
+def create_index(mode=MODE_LRU, capacity=DEFAULT_CAPACITY, error_rate=DEFAULT_ERROR_RATE,
+                 interval=DEFAULT_INTERVAL):
+    """
+    :param mode: lru or bloom
+    :return: LRUIndex or BloomIndex
+    """
+    if mode == MODE_LRU:
+        return LRUIndex(capacity)
+    if mode == MODE_BLOOM:
+        return BloomIndex(capacity, error_rate, interval)
+    raise ValueError('unknown dedup mode %s' % mode)
@@ -0,0 +1,114 @@
+import bisect
+
+
+class IntervalSet():
+	"""
+	a set of integers stored as sorted, disjoint, inclusive ranges
+	a gap of a million consecutive ids costs one range instead of
+	a million list entries; lookups are binary searches over the range starts
+	"""
+
+	def __init__(self):
+		self._starts = []
+		self._ends = []
+		self._size = 0
+
+	def __len__(self):
+		return self._size
+
+	def __bool__(self):
+		return self._size > 0
+
+	def __contains__(self, value):
+		i = bisect.bisect_right(self._starts, value) - 1
+		return i >= 0 and value <= self._ends[i]
+
+	def __iter__(self):
+		for start, end in zip(self._starts, self._ends):
+			yield from range(start, end + 1)
+
+	def ranges(self, limit=None):
+		"""
+		:param limit: (int) at most that many ranges, the lowest ones, None for all
+		:return: list of (start, end) tuples, both inclusive
+		"""
+		if limit is None:
+			return list(zip(self._starts, self._ends))
+		return list(zip(self._starts[:limit], self._ends[:limit]))
+
+	def lowest(self):
+		"""
+		:return: the smallest value of the set or None if it is empty
+		"""
+		if self._starts:
+			return self._starts[0]
+		return None
+
+	def add_range(self, start, end):
+		"""
+		adds all values between start and end (both inclusive)
+		ranges overlapping or touching the new one are merged with it
+		"""
+		if start > end:
+			return
+		lo = bisect.bisect_left(self._ends, start - 1)
+		hi = bisect.bisect_right(self._starts, end + 1)
+		if lo < hi:
+			start = min(start, self._starts[lo])
+			end = max(end, self._ends[hi - 1])
+			for i in range(lo, hi):
+				self._size -= self._ends[i] - self._starts[i] + 1
+		self._starts[lo:hi] = [start]
+		self._ends[lo:hi] = [end]
+		self._size += end - start + 1
+
+	def add(self, value):
+		self.add_range(value, value)
+
+	def remove(self, value):
+		"""
+		removes value from the set, splitting its range if necessary
+		:return: True if value was in the set
+		"""
+		i = bisect.bisect_right(self._starts, value) - 1
+		if i < 0 or value > self._ends[i]:
+			return False
+		start, end = self._starts[i], self._ends[i]
+		if start == end:
+			del self._starts[i]
+			del self._ends[i]
+		elif value == start:
+			self._starts[i] = value + 1
+		elif value == end:
+			self._ends[i] = value - 1
+		else:
+			self._ends[i] = value - 1
+			self._starts.insert(i + 1, value + 1)
+			self._ends.insert(i + 1, end)
+		self._size -= 1
+		return True
+
+	def discard_below(self, value):
+		"""
+		removes every value smaller than value
+		:return: (int) number of values removed
+		"""
+		i = bisect.bisect_left(self._ends, value)
+		removed = 0
+		for j in range(i):
+			removed += self._ends[j] - self._starts[j] + 1
+		del self._starts[:i]
+		del self._ends[:i]
+		if self._starts and self._starts[0] < value:
+			removed += value - self._starts[0]
+			self._starts[0] = value
+		self._size -= removed
+		return removed
+
+	def clear(self):
+		self._starts = []
+		self._ends = []
+		self._size = 0
+
+	def __str__(self):
+		return ','.join('%s-%s' % r if r[0] != r[1] else str(r[0]) for r in self.ranges())
@@ -1,17 +1,111 @@
+"""
+Logging of the server and its consumer processes.
+
+Every process only puts its records on a multiprocessing queue, a
+QueueListener thread in the main process writes them to the log files,
+so the event loop of the server never waits for the disk. The levels of
+the root logger and of single modules are set in server.config, warnings
+and errors repeating the same message are rate limited.
+"""
+import atexit
 import logging
+import logging.handlers
+import multiprocessing
+import time
+from util import cfg
+
+DEFAULT_LEVEL = 'INFO'
+DEFAULT_FILE = 'server.log'
+DEFAULT_ERROR_FILE = 'errorlog-server.log'
+DEFAULT_RATE_LIMIT = 60.0
+
+_FORMAT = '#ts:%(asctime)s#level:%(levelname)s#name:%(name)s%(message)s'
+
+
+class RateLimitFilter(logging.Filter):
+    """
+    lets a record of level or above through at most once per interval
+    seconds per logger and message template, the next record let through
+    tells how many similar ones have been dropped
+    with deferred formatting ("...%s", value) the template is the same
+    for every value, so e.g. a warning per unknown device is limited as a whole
+    """
+
+    def __init__(self, interval=DEFAULT_RATE_LIMIT, level=logging.WARNING):
+        super().__init__()
+        self._interval = interval
+        self._level = level
+        # (logger, template) -> [time let through, dropped since]
+        self._seen = {}
+
+    def filter(self, record):
+        if record.levelno < self._level:
+            return True
+        key = (record.name, record.msg)
+        now = time.time()
+        seen = self._seen.get(key)
+        if seen is None:
+            if len(self._seen) >= 10000:
+                self._seen.clear()
+            self._seen[key] = [now, 0]
+            return True
+        if now - seen[0] < self._interval:
+            seen[1] += 1
+            return False
+        if seen[1]:
+            record.msg = '%s#suppressed:%s' % (record.msg, seen[1])
+        seen[0] = now
+        seen[1] = 0
+        return True
+
+
+def _level(name):
+    level = logging.getLevelName(name.upper())
+    if not isinstance(level, int):
+        raise ValueError('unknown log level %s' % name)
+    return level
+
 
 def setup_logging():
-    logging.basicConfig(level=logging.DEBUG)
-    formatter = logging.Formatter('#ts:%(asctime)s#level:%(levelname)s#name:%(name)s%(message)s')
+    """
+    sets up the queue based logging of the main process, the processes
+    started afterwards inherit it
+    :return: the logging.handlers.QueueListener writing the records, it is stopped at exit
+    """
+    log_config = cfg.get_logging_config()
+    formatter = logging.Formatter(_FORMAT)
 
-    err_handler = logging.FileHandler('errorlog-server.log', mode='w', delay=True)
+    err_handler = logging.FileHandler(log_config.get('errorFile', DEFAULT_ERROR_FILE), mode='w', delay=True)
     err_handler.setLevel(logging.ERROR)
     err_handler.setFormatter(formatter)
 
-    logging.getLogger('').addHandler(err_handler)
-
-    fh = logging.FileHandler('server.log')
-    fh.setLevel(logging.DEBUG)
+    fh = logging.FileHandler(log_config.get('file', DEFAULT_FILE))
     fh.setFormatter(formatter)
 
-    logging.getLogger('').addHandler(fh)
\ No newline at end of file
+    handlers = [err_handler, fh]
+    if log_config.get('console', 'true').lower() in ('true', 'yes', 'on', '1'):
+        console = logging.StreamHandler()
+        console.setFormatter(formatter)
+        handlers.append(console)
+
+    # a multiprocessing queue, so that the DatabaseManager and CarbonClient
+    # processes forked later log through the listener of this process
+    queue = multiprocessing.Queue(-1)
+    listener = logging.handlers.QueueListener(queue, *handlers, respect_handler_level=True)
+    listener.start()
+    atexit.register(listener.stop)
+
+    queue_handler = logging.handlers.QueueHandler(queue)
+    rate_limit = float(log_config.get('rateLimit', DEFAULT_RATE_LIMIT))
+    if rate_limit > 0:
+        queue_handler.addFilter(RateLimitFilter(rate_limit))
+
+    root = logging.getLogger('')
+    for handler in list(root.handlers):
+        root.removeHandler(handler)
+    root.addHandler(queue_handler)
+    root.setLevel(_level(log_config.get('level', DEFAULT_LEVEL)))
+
+    for name, level in cfg.get_loggers_config().items():
+        logging.getLogger(name).setLevel(_level(level))
+    return listener
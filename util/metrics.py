@@ -0,0 +1,236 @@
+"""
+Counters, gauges and latency histograms of the pipeline, shared by the
+server workers, the DatabaseManager, the CarbonClient and the CacheAgent.
+
+The metrics live in a RawArray allocated before the processes are forked.
+Every process writes to its own slot of the array, so no lock is needed;
+readers merge the slots by adding them up. Histograms have fixed buckets
+growing by a factor of 2 from 10 microseconds on.
+"""
+import bisect
+import ctypes
+import http.server
+import logging
+import multiprocessing
+import socketserver
+import threading
+import time
+
+_logger = logging.getLogger(__name__)
+
+COUNTERS = (
+    'accepted', 'tls_resumed', 'tls_failed', 'messages', 'measurements', 'decode_errors', 'acks', 'throttled',
+    # measurements dropped before publishing: replays and turned off plugs or unknown types
+    'duplicates', 'rejected',
+    # connections refused at max_connections, closed as duplicates of a newer one or as idle
+    'refused', 'duplicate_connections', 'idle_closed',
+    'db_rows', 'db_flushes', 'db_errors', 'carbon_datapoints', 'carbon_flushes', 'carbon_errors',
+    'cache_samples', 'cache_queries',
+)
+GAUGES = (
+    # flow_closed is the number of server workers throttling their clients
+    # connection_memory is the estimated memory of the open connections in bytes
+    'connections', 'connection_memory', 'flow_closed', 'storage_lag', 'carbon_lag', 'db_pending', 'carbon_buffered',
+    'cache_lag', 'cache_series',
+)
+HISTOGRAMS = (
+    # the tls handshake of a new connection, with the wait for a free handshake slot
+    'tls_accept',
+    # decoding one message
+    'decode',
+    # from the receipt of a message until its ack is written
+    'ack',
+    # from the publish of a batch until a sink reads it
+    'storage_queue_wait', 'carbon_queue_wait', 'cache_queue_wait',
+    # writing one batch into the database
+    'db_flush',
+    # writing the buffered datapoints to carbon
+    'carbon_send',
+    # answering a query on the recent data
+    'cache_query',
+)
+
+# upper bounds of the buckets in seconds, 10us .. ~42s, and one for the rest
+BUCKETS = tuple(0.00001 * 2 ** i for i in range(23))
+QUANTILES = (0.5, 0.9, 0.99)
+
+_COUNTER_INDEX = dict((name, i) for i, name in enumerate(COUNTERS))
+_GAUGE_INDEX = dict((name, len(COUNTERS) + i) for i, name in enumerate(GAUGES))
+# a histogram is its buckets, the overflow bucket and the sum of the values
+_HISTOGRAM_WIDTH = len(BUCKETS) + 2
+_HISTOGRAM_INDEX = dict((name, len(COUNTERS) + len(GAUGES) + i * _HISTOGRAM_WIDTH)
+                        for i, name in enumerate(HISTOGRAMS))
+_SLOT_WIDTH = len(COUNTERS) + len(GAUGES) + len(HISTOGRAMS) * _HISTOGRAM_WIDTH
+
+
+class MetricsRegistry():
+    """
+    the metrics of all processes, one slot per process
+    """
+
+    def __init__(self, slots=1):
+        """
+        :param slots: (int) number of processes writing metrics
+        """
+        self._slots = slots
+        self._array = multiprocessing.RawArray(ctypes.c_double, slots * _SLOT_WIDTH)
+        # slot -> (prefix, names) of the metrics also reported for that slot alone
+        self._labels = {}
+
+    def slot(self, index):
+        """
+        :param index: (int) the slot of the calling process, below slots
+        :return: ProcessMetrics writing to that slot
+        """
+        if not 0 <= index < self._slots:
+            raise ValueError('metrics slot %s out of range' % index)
+        return ProcessMetrics(self._array, index * _SLOT_WIDTH)
+
+    def label(self, index, prefix, names):
+        """
+        reports the counters and gauges names of one slot under prefix as well,
+        e.g. the rows of each database writer, to be called before the processes start
+        :param index: (int) the slot
+        :param prefix: (str) e.g. storage.shard0
+        :param names: the counters and gauges
+        """
+        self.slot(index)
+        self._labels[index] = (prefix, tuple(names))
+
+    def _merged(self):
+        merged = [0.0] * _SLOT_WIDTH
+        array = self._array
+        for slot in range(self._slots):
+            offset = slot * _SLOT_WIDTH
+            for i, value in enumerate(array[offset:offset + _SLOT_WIDTH]):
+                merged[i] += value
+        return merged
+
+    def snapshot(self):
+        """
+        :return: dict metric name -> value, the metrics of all slots added up,
+        a histogram h gives h.count, h.sum, h.mean and h.p50, h.p90, h.p99 in seconds
+        """
+        merged = self._merged()
+        stats = {}
+        for name, i in _COUNTER_INDEX.items():
+            stats[name] = int(merged[i])
+        for name, i in _GAUGE_INDEX.items():
+            stats[name] = merged[i]
+        for name, i in _HISTOGRAM_INDEX.items():
+            counts = merged[i:i + len(BUCKETS) + 1]
+            count = sum(counts)
+            total = merged[i + len(BUCKETS) + 1]
+            stats[name + '.count'] = int(count)
+            stats[name + '.sum'] = total
+            stats[name + '.mean'] = total / count if count else 0.0
+            for q in QUANTILES:
+                stats['%s.p%d' % (name, q * 100)] = _quantile(counts, count, q)
+        for index, (prefix, names) in self._labels.items():
+            process_metrics = self.slot(index)
+            for name in names:
+                value = process_metrics.get(name)
+                stats['%s.%s' % (prefix, name)] = int(value) if name in _COUNTER_INDEX else value
+        return stats
+
+    def lines(self):
+        """
+        :return: (str) one "name value" line per metric, sorted by name
+        """
+        return ''.join('%s %s\n' % (name, value) for name, value in sorted(self.snapshot().items()))
+
+
+def _quantile(counts, count, q):
+    """
+    :return: the upper bound of the bucket holding the q-quantile
+    """
+    if not count:
+        return 0.0
+    rank = q * count
+    seen = 0
+    for i, bucket in enumerate(counts):
+        seen += bucket
+        if seen >= rank:
+            return BUCKETS[i] if i < len(BUCKETS) else float('inf')
+    return float('inf')
+
+
+class ProcessMetrics():
+    """
+    writes the metrics of one process into its slot
+    """
+
+    def __init__(self, array, offset):
+        self._array = array
+        self._offset = offset
+
+    def incr(self, name, value=1):
+        self._array[self._offset + _COUNTER_INDEX[name]] += value
+
+    def set(self, name, value):
+        self._array[self._offset + _GAUGE_INDEX[name]] = value
+
+    def add(self, name, value):
+        self._array[self._offset + _GAUGE_INDEX[name]] += value
+
+    def get(self, name):
+        """
+        :return: the value of a counter or gauge in this slot
+        """
+        index = _COUNTER_INDEX.get(name)
+        if index is None:
+            index = _GAUGE_INDEX[name]
+        return self._array[self._offset + index]
+
+    def observe(self, name, seconds):
+        """
+        adds a latency to a histogram
+        """
+        i = self._offset + _HISTOGRAM_INDEX[name]
+        self._array[i + bisect.bisect_left(BUCKETS, seconds)] += 1
+        self._array[i + len(BUCKETS) + 1] += seconds
+
+    def since(self, name, start):
+        """
+        adds the time passed since start, a value of time.monotonic(), to a histogram
+        """
+        self.observe(name, time.monotonic() - start)
+
+
+class _StatsHandler(http.server.BaseHTTPRequestHandler):
+
+    def do_GET(self):
+        body = self.server.registry.lines().encode('ascii')
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; charset=ascii')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        _logger.debug("#debug:stats-request:%s", format % args)
+
+
+class _StatsHTTPServer(socketserver.ThreadingMixIn, http.server.HTTPServer):
+    daemon_threads = True
+
+
+def start_stats_server(registry, host='127.0.0.1', port=0):
+    """
+    serves the merged metrics as "name value" lines over HTTP from a daemon thread
+    :param registry: MetricsRegistry
+    :return: the http.server.HTTPServer, its server_address gives the port bound
+    """
+    server = _StatsHTTPServer((host, port), _StatsHandler)
+    server.registry = registry
+    thread = threading.Thread(target=server.serve_forever, name='stats-server', daemon=True)
+    thread.start()
+    _logger.info("#info:serving-stats-on-%s:%s", *server.server_address)
+    return server
+
+
+def local():
+    """
+    :return: ProcessMetrics which nobody reads, for objects created without a registry
+    """
+    return MetricsRegistry(1).slot(0)
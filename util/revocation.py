@@ -0,0 +1,98 @@
+"""
+The serial numbers of revoked (expired) client certificates.
+
+The serials are kept in a set, so checking a connecting client costs a
+hash lookup. They are read from serialNumbers in the [expired] section
+of server.config and, if given, from a file with one serial per line.
+Both files are checked for changes at most every check_interval seconds
+when a client connects, a new serial takes effect without a restart.
+"""
+import logging
+import os
+import time
+
+_logger = logging.getLogger(__name__)
+
+DEFAULT_CHECK_INTERVAL = 5.0
+
+
+def normalize(serial):
+    """
+    :return: the serial as found in the peercert of a client: upper case hex without separators
+    """
+    return serial.strip().replace(':', '').upper()
+
+
+def parse_serials(text, separator=';'):
+    """
+    :param text: serials separated by separator or newlines, lines starting with # are comments
+    :return: set of normalized serials
+    """
+    serials = set()
+    for line in text.splitlines():
+        if line.strip().startswith('#'):
+            continue
+        for serial in line.split(separator):
+            serial = normalize(serial)
+            if serial:
+                serials.add(serial)
+    return serials
+
+
+class RevokedSerials():
+    """
+    a set of serial numbers, reloaded when one of its files changes
+    """
+
+    def __init__(self, load, paths=(), check_interval=DEFAULT_CHECK_INTERVAL):
+        """
+        :param load: callable returning an iterable of the revoked serials
+        :param paths: the files read by load, a change of their mtime triggers a reload
+        :param check_interval: (float) seconds between two checks of the files, 0 disables reloading
+        """
+        self._load = load
+        self._paths = tuple(paths)
+        self._check_interval = check_interval
+        self._next_check = time.monotonic() + check_interval
+        self._stat = self._file_stats()
+        self._serials = frozenset(normalize(serial) for serial in load())
+
+    def _file_stats(self):
+        stats = []
+        for path in self._paths:
+            try:
+                st = os.stat(path)
+                stats.append((st.st_mtime_ns, st.st_size))
+            except OSError:
+                stats.append(None)
+        return stats
+
+    def __contains__(self, serial):
+        self.check()
+        return serial in self._serials
+
+    def __len__(self):
+        return len(self._serials)
+
+    def check(self, now=None):
+        """
+        reloads the serials if a file has changed, a failing load keeps the current serials
+        :return: True if the serials have been reloaded
+        """
+        if now is None:
+            now = time.monotonic()
+        if not self._check_interval or now < self._next_check:
+            return False
+        self._next_check = now + self._check_interval
+        stat = self._file_stats()
+        if stat == self._stat:
+            return False
+        try:
+            serials = frozenset(normalize(serial) for serial in self._load())
+        except Exception as e:
+            _logger.error("#error:reloading-revoked-serials-failed:%s", e)
+            return False
+        self._stat = stat
+        self._serials = serials
+        _logger.info("#info:reloaded-%s-revoked-serials", len(serials))
+        return True
@@ -0,0 +1,383 @@
+"""
+A durable, append-only spool between the server and the processes
+consuming the measurements.
+
+Each server process appends to its own partition, a directory of segment
+files named after the offset of their first byte. A record is the pickled
+batch prefixed with its length, crc32 and the time it was published. The
+server syncs the spool before it acknowledges a message, syncs of
+concurrent messages are grouped.
+
+Every sink reads all partitions with its own offsets, persisted in
+offsets/<sink> with an atomic rename, and resumes from them after a
+restart. Segments which every sink has consumed are deleted.
+"""
+import json
+import logging
+import os
+import pickle
+import struct
+import threading
+import time
+import zlib
+
+DEFAULT_SEGMENT_SIZE = 64 * 1024 * 1024
+DEFAULT_POLL_INTERVAL = 0.05
+DEFAULT_COMMIT_INTERVAL = 1.0
+# seconds the writer caches the offsets of the sinks for lag
+_OFFSETS_REFRESH = 0.1
+
+# length and crc32 of the pickled batch, the time it was published
+_HEADER = struct.Struct('!IId')
+_SEGMENT_SUFFIX = '.seg'
+_PARTITION_PREFIX = 'p'
+_OFFSETS_DIR = 'offsets'
+
+_logger = logging.getLogger(__name__)
+
+
+def _segment_name(base):
+    return '%020d%s' % (base, _SEGMENT_SUFFIX)
+
+
+def list_segments(directory):
+    """
+    :return: sorted list of the base offsets of the segments in directory
+    """
+    try:
+        names = os.listdir(directory)
+    except FileNotFoundError:
+        return []
+    return sorted(int(name[:-len(_SEGMENT_SUFFIX)]) for name in names if name.endswith(_SEGMENT_SUFFIX))
+
+
+def list_partitions(root):
+    try:
+        names = os.listdir(root)
+    except FileNotFoundError:
+        return []
+    return sorted(name for name in names if name.startswith(_PARTITION_PREFIX) and
+                  os.path.isdir(os.path.join(root, name)))
+
+
+def partition_name(worker_id):
+    return '%s%s' % (_PARTITION_PREFIX, worker_id)
+
+
+def read_offsets(root, sink):
+    """
+    :return: dict partition -> committed offset of sink
+    """
+    try:
+        with open(os.path.join(root, _OFFSETS_DIR, sink)) as fin:
+            return json.load(fin)
+    except FileNotFoundError:
+        return {}
+
+
+def _scan_valid_end(path):
+    """
+    :return: the size of the valid prefix of a segment, records torn by a crash are cut off
+    """
+    end = 0
+    with open(path, 'rb') as fin:
+        while True:
+            header = fin.read(_HEADER.size)
+            if len(header) < _HEADER.size:
+                return end
+            size, crc, _ = _HEADER.unpack(header)
+            payload = fin.read(size)
+            if len(payload) < size or zlib.crc32(payload) != crc:
+                return end
+            end += _HEADER.size + size
+
+
+class SpoolWriter():
+    """
+    appends batches to one partition of the spool
+    """
+    durable = True
+
+    def __init__(self, root, partition, segment_size=DEFAULT_SEGMENT_SIZE, sinks=None):
+        """
+        :param root: directory of the spool
+        :param partition: name of the partition of this writer, see partition_name
+        :param segment_size: (int) bytes after which a new segment file is started
+        :param sinks: names of the sinks reading the spool, the lag is taken over them only,
+        offsets left by sinks which are not configured anymore are ignored, None takes every offset
+        """
+        self._root = root
+        self._partition = partition
+        self._sinks = sinks
+        self._directory = os.path.join(root, partition)
+        self._segment_size = segment_size
+        os.makedirs(self._directory, exist_ok=True)
+        os.makedirs(os.path.join(root, _OFFSETS_DIR), exist_ok=True)
+
+        self._sink_offsets_cache = []
+        self._sink_offsets_time = 0
+        self._fd = None
+        # the server syncs in an executor thread while appending
+        self._lock = threading.Lock()
+        self._base = 0
+        self._size = 0
+        segments = list_segments(self._directory)
+        if segments:
+            # continue the last segment behind its last complete record
+            self._base = segments[-1]
+            path = os.path.join(self._directory, _segment_name(self._base))
+            self._size = _scan_valid_end(path)
+            if self._size != os.path.getsize(path):
+                _logger.warn("#warn:truncating-torn-spool-record-in:%s" % path)
+                os.truncate(path, self._size)
+        self._open_segment()
+
+    def _open_segment(self):
+        path = os.path.join(self._directory, _segment_name(self._base))
+        self._fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_APPEND, 0o644)
+
+    def _roll(self):
+        os.fsync(self._fd)
+        os.close(self._fd)
+        self._base += self._size
+        self._size = 0
+        self._open_segment()
+        # make the new segment file itself durable
+        dir_fd = os.open(self._directory, os.O_RDONLY)
+        try:
+            os.fsync(dir_fd)
+        finally:
+            os.close(dir_fd)
+
+    def publish(self, batch, timeout=None):
+        """
+        appends a batch, it is durable after the next sync
+        :param batch: util.columnar.ColumnarBatch or list of measurements
+        :param timeout: only for compatibility with util.bus.BatchBus, the spool is never full
+        :return: True
+        """
+        payload = pickle.dumps(batch, pickle.HIGHEST_PROTOCOL)
+        record = _HEADER.pack(len(payload), zlib.crc32(payload), time.time()) + payload
+        if self._size and self._size + len(record) > self._segment_size:
+            with self._lock:
+                self._roll()
+        os.write(self._fd, record)
+        self._size += len(record)
+        return True
+
+    def sync(self):
+        """
+        makes every batch published so far durable
+        """
+        with self._lock:
+            os.fsync(self._fd)
+
+    def position(self):
+        return self._base + self._size
+
+    def lag(self):
+        """
+        :return: (int) bytes of this partition not committed yet by the slowest sink,
+        a sink without an offset in the partition is at its oldest segment
+        """
+        first = list_segments(self._directory)[0]
+        offsets = [o.get(self._partition, first) for o in self._sink_offsets()]
+        return self.position() - min(offsets or [first])
+
+    def _sink_offsets(self):
+        now = time.time()
+        if now - self._sink_offsets_time >= _OFFSETS_REFRESH:
+            names = self._sinks
+            if names is None:
+                names = [name for name in os.listdir(os.path.join(self._root, _OFFSETS_DIR))
+                         if not name.endswith('.tmp')]
+            self._sink_offsets_cache = [read_offsets(self._root, name) for name in names]
+            self._sink_offsets_time = now
+        return self._sink_offsets_cache
+
+    def close(self):
+        with self._lock:
+            if self._fd is not None:
+                os.fsync(self._fd)
+                os.close(self._fd)
+                self._fd = None
+
+
+class _PartitionCursor():
+    """
+    the read position of a sink in one partition
+    """
+
+    def __init__(self, directory, offset):
+        self.directory = directory
+        self.offset = offset
+        self._file = None
+        self._base = None
+
+    def _open(self):
+        segments = list_segments(self.directory)
+        candidates = [base for base in segments if base <= self.offset]
+        if not candidates:
+            if segments and segments[0] > self.offset:
+                # the segments before were deleted, nothing to read there
+                _logger.warn("#warn:spool-offset-%s-is-gone-continuing-at-%s" % (self.offset, segments[0]))
+                self.offset = segments[0]
+                candidates = [segments[0]]
+            else:
+                return False
+        self._base = candidates[-1]
+        self._file = open(os.path.join(self.directory, _segment_name(self._base)), 'rb')
+        self._file.seek(self.offset - self._base)
+        return True
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+    def _next_segment_exists(self):
+        return any(base > self._base for base in list_segments(self.directory))
+
+    def read(self):
+        """
+        :return: (payload, offset after the record, time published) or None if no complete record is available
+        """
+        if self._file is None and not self._open():
+            return None
+        self._file.seek(self.offset - self._base)
+        header = self._file.read(_HEADER.size)
+        if len(header) == _HEADER.size:
+            size, crc, published = _HEADER.unpack(header)
+            payload = self._file.read(size)
+            if len(payload) == size:
+                if zlib.crc32(payload) == crc:
+                    return payload, self.offset + _HEADER.size + size, published
+                _logger.error("#error:corrupted-spool-record-at-%s-in-%s" % (self.offset, self.directory))
+                self._skip_segment()
+                return None
+        if not header and self._next_segment_exists():
+            # the writer rolled over, continue in the next segment
+            self.close()
+            self.offset = min(base for base in list_segments(self.directory) if base > self._base)
+            return self.read()
+        return None
+
+    def _skip_segment(self):
+        later = [base for base in list_segments(self.directory) if base > self._base]
+        if later:
+            self.close()
+            self.offset = later[0]
+
+
+class SpoolReader():
+    """
+    reads the batches of all partitions for one sink
+    batches returned by get are consumed durably by commit
+    """
+    durable = True
+
+    def __init__(self, root, sink, sinks, poll_interval=DEFAULT_POLL_INTERVAL,
+                 commit_interval=DEFAULT_COMMIT_INTERVAL):
+        """
+        :param root: directory of the spool
+        :param sink: name of this sink
+        :param sinks: names of all sinks, a segment is deleted when all of them have consumed it
+        :param poll_interval: (float) seconds between two looks for new records
+        :param commit_interval: (float) offsets are written at most once per commit_interval seconds
+        """
+        self._root = root
+        self._sink = sink
+        self._sinks = sinks
+        self._poll_interval = poll_interval
+        self._commit_interval = commit_interval
+        self._cursors = None
+        self._read = {}
+        self._committed = {}
+        self._last_commit = 0
+        self._next = 0
+        # the time the batch returned last by get has been published
+        self.published = None
+
+    def _refresh_partitions(self):
+        if self._cursors is None:
+            self._cursors = {}
+            self._committed = read_offsets(self._root, self._sink)
+        for partition in list_partitions(self._root):
+            if partition not in self._cursors:
+                offset = self._committed.get(partition, 0)
+                self._cursors[partition] = _PartitionCursor(os.path.join(self._root, partition), offset)
+                self._read[partition] = offset
+
+    def get(self, timeout=None):
+        """
+        :param timeout: (float) seconds to wait for a batch, None waits forever
+        :return: the next batch or None if the timeout expired
+        """
+        deadline = None if timeout is None else time.time() + timeout
+        while True:
+            self._refresh_partitions()
+            partitions = sorted(self._cursors)
+            # round robin over the partitions, so no server process is starved
+            for i in range(len(partitions)):
+                partition = partitions[(self._next + i) % len(partitions)]
+                cursor = self._cursors[partition]
+                record = cursor.read()
+                if record is not None:
+                    payload, cursor.offset, self.published = record
+                    self._read[partition] = cursor.offset
+                    self._next = (self._next + i + 1) % len(partitions)
+                    return pickle.loads(payload)
+            if deadline is not None and time.time() >= deadline:
+                return None
+            time.sleep(self._poll_interval)
+
+    def commit(self, force=False):
+        """
+        persists the offsets of every batch returned by get so far,
+        at most once per commit_interval unless force is set
+        """
+        if self._read == self._committed:
+            return
+        now = time.time()
+        if not force and now - self._last_commit < self._commit_interval:
+            return
+        self._last_commit = now
+        self._committed = dict(self._read)
+
+        directory = os.path.join(self._root, _OFFSETS_DIR)
+        path = os.path.join(directory, self._sink)
+        tmp = path + '.tmp'
+        with open(tmp, 'w') as fout:
+            json.dump(self._committed, fout)
+            fout.flush()
+            os.fsync(fout.fileno())
+        os.rename(tmp, path)
+        self.delete_consumed()
+
+    def delete_consumed(self):
+        """
+        deletes the segments which have been consumed by every sink
+        """
+        offsets = [read_offsets(self._root, sink) for sink in self._sinks]
+        for partition in list_partitions(self._root):
+            consumed = min(o.get(partition, 0) for o in offsets)
+            directory = os.path.join(self._root, partition)
+            segments = list_segments(directory)
+            # a segment is consumed when the next one starts at or before the consumed offset
+            for base, next_base in zip(segments, segments[1:]):
+                if next_base > consumed:
+                    break
+                os.remove(os.path.join(directory, _segment_name(base)))
+                _logger.debug("#debug:deleted-consumed-spool-segment-%s-%s" % (partition, base))
+
+    def lag(self):
+        """
+        :return: (int) bytes spooled but not committed by this sink
+        """
+        total = 0
+        for partition in list_partitions(self._root):
+            segments = list_segments(os.path.join(self._root, partition))
+            if segments:
+                last = os.path.join(self._root, partition, _segment_name(segments[-1]))
+                total += segments[-1] + os.path.getsize(last) - self._committed.get(partition, 0)
+        return total
@@ -1,3 +1,14 @@
+import datetime
+import re
+import time
+
+# the utc offset at the end of an iso formatted string, +01:00, +0100 or -05:00
+_OFFSET = re.compile(r'([+-])(\d\d):?(\d\d)$')
+_FORMATS = ('%Y-%m-%d %H:%M:%S.%f', '%Y-%m-%d %H:%M:%S', '%Y-%m-%dT%H:%M:%S.%f', '%Y-%m-%dT%H:%M:%S', '%Y-%m-%d')
+# a time without date is of today, as stored in the time columns of the old tables
+_TIME_FORMATS = ('%H:%M:%S.%f', '%H:%M:%S')
+
+
 def check_plug_measurement(data):
 	"""
 	checks if a plug measurement includes
@@ -10,4 +21,48 @@ def check_plug_measurement(data):
 			data['freq'] and data['work']) and data['pow'] == 'OFF':
 			return False
 	else:
-		return True
\ No newline at end of file
+		return True
+
+def to_timestamp(ts):
+	"""
+	converts the timestamp of a measurement into seconds since the epoch
+	:param ts: datetime.datetime (naive ones are local time), datetime.date or datetime.time
+	of today, number of seconds, an iso formatted string of a date and time, a date or a time
+	of today (without offset it is local time, a trailing Z is utc) or None for now
+	:return: float
+	:raise ValueError: for a timestamp of any other form
+	"""
+	if ts is None:
+		return time.time()
+	if isinstance(ts, (int, float)):
+		return float(ts)
+	if isinstance(ts, datetime.datetime):
+		return ts.timestamp()
+	if isinstance(ts, datetime.date):
+		return datetime.datetime.combine(ts, datetime.time()).timestamp()
+	if isinstance(ts, datetime.time):
+		return datetime.datetime.combine(datetime.date.today(), ts).timestamp()
+	if isinstance(ts, str):
+		text, tz = ts.strip(), None
+		if text.endswith('Z'):
+			text, tz = text[:-1], datetime.timezone.utc
+		else:
+			match = _OFFSET.search(text)
+			if match and match.start() > 10:
+				sign, hours, minutes = match.groups()
+				offset = datetime.timedelta(hours=int(hours), minutes=int(minutes))
+				text, tz = text[:match.start()], datetime.timezone(-offset if sign == '-' else offset)
+		for fmt in _FORMATS:
+			try:
+				parsed = datetime.datetime.strptime(text, fmt)
+			except ValueError:
+				continue
+			return (parsed if tz is None else parsed.replace(tzinfo=tz)).timestamp()
+		for fmt in _TIME_FORMATS:
+			try:
+				parsed = datetime.datetime.strptime(text, fmt)
+			except ValueError:
+				continue
+			parsed = datetime.datetime.combine(datetime.date.today(), parsed.time())
+			return (parsed if tz is None else parsed.replace(tzinfo=tz)).timestamp()
+	raise ValueError('unsupported timestamp %r' % (ts,))